@@ -0,0 +1,132 @@
+import os
+import time
+import numpy as np
+from framebuffer import Framebuffer
+from image_writer import ImageWriter
+from renderer_shared_mem import Renderer
+from screen import load_pygame
+
+
+class Keyframe:
+    # The position (x, y, z) and rotation (x, y and z degrees, as taken by Transform.set_rotation) a transform has at frame. Either can be
+    # None to leave that part of the transform to the other keyframes.
+    __slots__ = ('frame', 'position', 'rotation')
+
+    def __init__(self, frame, position=None, rotation=None):
+        self.frame = frame
+        self.position = None if position is None else np.array(position, dtype=np.float64)
+        self.rotation = None if rotation is None else np.array(rotation, dtype=np.float64)
+
+
+class Animation:
+    # Keyframes for any number of transforms, those of meshes, the camera or the light. Between two keyframes of a transform its position
+    # and rotation angles are interpolated linearly, before its first keyframe and after its last one they are held.
+    def __init__(self):
+        # [transform, keyframes in frame order, position applied last, rotation applied last] of every animated transform, keyed on the
+        # id of the transform
+        self.tracks = {}
+
+    # This method adds a keyframe (see Keyframe) for transform at frame and returns it.
+    def add(self, transform, frame, position=None, rotation=None):
+        track = self.tracks.setdefault(id(transform), [transform, [], None, None])
+        keyframe = Keyframe(frame, position, rotation)
+        track[1].append(keyframe)
+        track[1].sort(key=lambda key: key.frame)
+        return keyframe
+
+    # This method returns the number of frames of the animation, up to and including its last keyframe.
+    def frame_count(self):
+        return max([keyframes[-1].frame + 1 for _, keyframes, _, _ in self.tracks.values()], default=0)
+
+    # This method moves every animated transform to where it is at frame. Transforms whose position or rotation is the same as the last
+    # time apply was called are left alone, so their version does not change and the vertex stage results of their meshes stay cached
+    # (see VertexCache).
+    def apply(self, frame):
+        for track in self.tracks.values():
+            transform, keyframes, last_position, last_rotation = track
+            position = Animation.interpolate(keyframes, frame, 'position')
+            if position is not None and (last_position is None or not np.array_equal(position, last_position)):
+                transform.set_position(*position)
+                track[2] = position
+            rotation = Animation.interpolate(keyframes, frame, 'rotation')
+            if rotation is not None and (last_rotation is None or not np.array_equal(rotation, last_rotation)):
+                transform.set_rotation(*rotation)
+                track[3] = rotation
+
+    # This static method returns the value of the member called name (position or rotation) at frame, interpolated between the keyframes
+    # that set it, or None if none of them do.
+    @staticmethod
+    def interpolate(keyframes, frame, name):
+        keys = [key for key in keyframes if getattr(key, name) is not None]
+        if not keys:
+            return None
+        if frame <= keys[0].frame:
+            return getattr(keys[0], name)
+        for before, after in zip(keys, keys[1:]):
+            if frame <= after.frame:
+                weight = (frame - before.frame) / (after.frame - before.frame)
+                return (1 - weight) * getattr(before, name) + weight * getattr(after, name)
+        return getattr(keys[-1], name)
+
+
+class AnimationRenderer:
+    # Renders every frame of an Animation of a scene with the tile renderer (see renderer_shared_mem.Renderer) and its pool of workers.
+    # The arguments are the same as the tile renderer's. The frames are pipelined: the vertex stage and binning of a frame run in this
+    # process while the workers are still rasterizing the frame before it, and each finished frame is written to disk while the next
+    # one is rasterized. The workers are kept for later calls to render until close is called.
+    def __init__(self, screen, camera, meshes, light, tile_size=64, processes=None, pool=None):
+        self.renderer = Renderer(screen, camera, meshes, light, tile_size, processes, pool)
+
+    # This method stops the worker processes started by the renderer.
+    def close(self):
+        self.renderer.close()
+
+    # This method renders the frames of animation (by default all of them, frames can be given as any sequence of frame numbers) with the
+    # shading parameters of Renderer.render. If output_dir is given, every frame is saved there as it finishes, with a file name made
+    # by formatting file_pattern with the frame number (its extension picks the image format, see write_frame). It returns the number
+    # of frames rendered per second.
+    def render(self, animation, shading, bg_color, ambient_light, output_dir=None, deferred=True, frames=None, file_pattern='frame_{:04d}.png',
+               depth_source='vertices'):
+        if self.renderer.camera.ratio() != self.renderer.screen.ratio():
+            exit(1)
+        frames = range(animation.frame_count()) if frames is None else frames
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        self.renderer.start_pool()
+
+        start_time = time.time()
+        # the frame being rasterized by the workers, as (frame number, handle), and the one before it uses the other of two image buffers
+        in_flight = None
+        for count, frame in enumerate(frames):
+            animation.apply(frame)
+            handle = self.renderer.begin_frame(shading, bg_color, ambient_light, deferred, buffer_name='animation_' + str(count % 2),
+                                               depth_source=depth_source)
+            if in_flight is not None:
+                self.finish(in_flight, output_dir, file_pattern)
+            in_flight = (frame, handle)
+        if in_flight is not None:
+            self.finish(in_flight, output_dir, file_pattern)
+
+        end_time = time.time()
+        frames_per_second = len(frames) / (end_time - start_time) if len(frames) > 0 else 0.0
+        print(str(len(frames)) + ' frames in ' + str(round(end_time - start_time, 3)) + 's, ' + str(round(frames_per_second, 2)) + ' fps')
+        return frames_per_second
+
+    # This method waits for a (frame number, handle) frame begun by render and saves it to output_dir, if given.
+    def finish(self, in_flight, output_dir, file_pattern):
+        frame, handle = in_flight
+        framebuffer = self.renderer.finish_frame(handle)
+        if output_dir is not None:
+            AnimationRenderer.write_frame(os.path.join(output_dir, file_pattern.format(frame)), framebuffer)
+
+    # This static method saves image, a Framebuffer or an image buffer indexed [x, y] like the ones passed to Screen.draw, to path as an
+    # image that looks the same as the screen would. The format is chosen by the extension: png, ppm and raw are written by ImageWriter
+    # without pygame, the other formats pygame can save (bmp, tga or jpg) load pygame to write them.
+    @staticmethod
+    def write_frame(path, image):
+        if path.rsplit('.', 1)[-1].lower() in ('png', 'ppm', 'raw'):
+            ImageWriter.write(path, image)
+            return
+        pygame = load_pygame()
+        framebuffer = image if isinstance(image, Framebuffer) else Framebuffer.from_pixels(image)
+        pygame.image.save(pygame.image.frombuffer(framebuffer.color, (framebuffer.width, framebuffer.height), 'RGB'), path)
@@ -0,0 +1,379 @@
+import numpy as np
+from ray import Ray
+from world_triangles import WorldTriangles
+
+# Relative cost of visiting one BVH node compared to testing one triangle, used by the surface area heuristic
+TRAVERSAL_COST = 0.125
+# Node boxes are grown by this fraction of the largest coordinate in the tree, so rounding in the ray transforms can never make a ray
+# miss the box of a triangle it hits
+BOX_PADDING = 1e-6
+
+# Bottom-level BVHs already built, keyed on the id of the verts array of the geometry they were built for (kept alongside so the id
+# stays valid), so that meshes sharing geometry, and every frame of a mesh, share one tree
+_mesh_bvhs = {}
+
+
+class BVH:
+    # A bounding volume hierarchy over a set of primitives given by their axis aligned bounding boxes, flattened into arrays.
+    # Node i has the box bounds_min[i], bounds_max[i]. If counts[i] is 0 it is an interior node whose two children are the nodes
+    # offsets[i] and offsets[i] + 1, otherwise it is a leaf holding the primitives primitives[offsets[i]:offsets[i] + counts[i]].
+    # Node 0 is the root.
+    __slots__ = ('bounds_min', 'bounds_max', 'offsets', 'counts', 'primitives', 'nodes')
+
+    def __init__(self, bounds_min, bounds_max, offsets, counts, primitives):
+        self.bounds_min = bounds_min
+        self.bounds_max = bounds_max
+        self.offsets = offsets
+        self.counts = counts
+        self.primitives = primitives
+        # the arrays above as Python lists, which are much faster to index one element at a time during traversal (see node_lists)
+        self.nodes = None
+
+    # The lists used for traversal are rebuilt where they are needed instead of being pickled along with the arrays.
+    def __getstate__(self):
+        return (self.bounds_min, self.bounds_max, self.offsets, self.counts, self.primitives)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    # This static method builds a BVH over the primitives with the (N, 3) box corners bounds_min and bounds_max. Nodes are split with
+    # the binned surface area heuristic: every axis is cut into bins by the box centres, and the cut with the lowest expected cost of
+    # traversing both halves is taken, unless keeping the node as a leaf is cheaper. Nodes with leaf_size or fewer primitives are never
+    # split, nodes with more than max_leaf_size always are (unless all their centres coincide).
+    # Without any primitives the tree is a single empty node with a zero-size box, which traversal never enters.
+    @staticmethod
+    def build(bounds_min, bounds_max, leaf_size=2, max_leaf_size=16, bins=16):
+        if len(bounds_min) == 0:
+            return BVH(np.zeros((1, 3)), np.zeros((1, 3)), np.zeros(1, dtype=np.int32), np.zeros(1, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        bounds_min = np.asarray(bounds_min, dtype=np.float64)
+        bounds_max = np.asarray(bounds_max, dtype=np.float64)
+        centroids = (bounds_min + bounds_max) / 2
+        primitives = np.arange(len(bounds_min))
+        padding = BOX_PADDING * max(1.0, float(np.abs(np.concatenate((bounds_min, bounds_max))).max(initial=0.0)))
+
+        node_min = [None]
+        node_max = [None]
+        offsets = [0]
+        counts = [0]
+        # nodes still to be filled in, with the range of primitives they cover
+        stack = [(0, 0, len(primitives))]
+        while stack:
+            node, start, end = stack.pop()
+            items = primitives[start:end]
+            node_min[node] = bounds_min[items].min(axis=0, initial=np.inf) - padding
+            node_max[node] = bounds_max[items].max(axis=0, initial=-np.inf) + padding
+
+            left = None
+            if end - start > leaf_size:
+                left = BVH.split(bounds_min[items], bounds_max[items], centroids[items], bins, end - start > max_leaf_size)
+            if left is None:
+                offsets[node] = start
+                counts[node] = end - start
+                continue
+
+            # keep the primitives of each child next to each other, left child first
+            primitives[start:end] = np.concatenate((items[left], items[~left]))
+            middle = start + int(np.count_nonzero(left))
+            offsets[node] = len(offsets)
+            for _ in range(2):
+                node_min.append(None)
+                node_max.append(None)
+                offsets.append(0)
+                counts.append(0)
+            stack.append((offsets[node], start, middle))
+            stack.append((offsets[node] + 1, middle, end))
+
+        return BVH(np.array(node_min).reshape(-1, 3), np.array(node_max).reshape(-1, 3), np.array(offsets, dtype=np.int32),
+                   np.array(counts, dtype=np.int32), primitives.astype(np.int32))
+
+    # This static method returns the surface area of the boxes with corners bounds_min and bounds_max (the last axis holds x, y and z).
+    @staticmethod
+    def area(bounds_min, bounds_max):
+        size = bounds_max - bounds_min
+        return 2 * (size[..., 0] * size[..., 1] + size[..., 1] * size[..., 2] + size[..., 2] * size[..., 0])
+
+    # This static method finds the best binned SAH split of a node whose primitives have the given boxes and centres. It returns a
+    # boolean mask of the primitives that go to the left child, or None if the node should stay a leaf. With force set the best split
+    # is taken even if it is more expensive than a leaf.
+    @staticmethod
+    def split(bounds_min, bounds_max, centroids, bins, force=False):
+        count = len(centroids)
+        leaf_cost = count * BVH.area(bounds_min.min(axis=0), bounds_max.max(axis=0))
+        best_cost = np.inf
+        best_mask = None
+        low = centroids.min(axis=0)
+        high = centroids.max(axis=0)
+        for axis in range(3):
+            extent = high[axis] - low[axis]
+            if extent <= 0:
+                continue
+            bin_index = np.minimum(((centroids[:, axis] - low[axis]) * (bins / extent)).astype(np.int64), bins - 1)
+            bin_min = np.full((bins, 3), np.inf)
+            bin_max = np.full((bins, 3), -np.inf)
+            np.minimum.at(bin_min, bin_index, bounds_min)
+            np.maximum.at(bin_max, bin_index, bounds_max)
+
+            # cutting after bin i puts bins 0..i on the left and the rest on the right
+            left_counts = np.cumsum(np.bincount(bin_index, minlength=bins))[:-1]
+            right_counts = count - left_counts
+            left_area = BVH.area(np.minimum.accumulate(bin_min)[:-1], np.maximum.accumulate(bin_max)[:-1])
+            right_area = BVH.area(np.minimum.accumulate(bin_min[::-1])[::-1][1:], np.maximum.accumulate(bin_max[::-1])[::-1][1:])
+            with np.errstate(invalid='ignore'):
+                cost = np.where((left_counts > 0) & (right_counts > 0), left_area * left_counts + right_area * right_counts, np.inf)
+            cut = int(np.argmin(cost))
+            if cost[cut] < best_cost:
+                best_cost = cost[cut]
+                best_mask = bin_index <= cut
+
+        if best_mask is None:
+            return None
+        if not force and best_cost + TRAVERSAL_COST * leaf_cost >= leaf_cost:
+            return None
+        return best_mask
+
+    # This static method builds a BVH over the faces of mesh in object space. The primitives are the face indices. The boxes of the faces
+    # are found block by block (see Mesh.face_chunks), without gathering the corners of every face at once.
+    @staticmethod
+    def from_mesh(mesh):
+        bounds_min = np.empty((len(mesh.faces), 3))
+        bounds_max = np.empty((len(mesh.faces), 3))
+        for start, faces in mesh.face_chunks():
+            corners = mesh.verts[faces]
+            bounds_min[start:start + len(faces)] = corners.min(axis=1)
+            bounds_max[start:start + len(faces)] = corners.max(axis=1)
+        return BVH.build(bounds_min, bounds_max)
+
+    # This method returns the node arrays as Python lists (see nodes), creating them on first use.
+    def node_lists(self):
+        if self.nodes is None:
+            self.nodes = (self.bounds_min.tolist(), self.bounds_max.tolist(), self.offsets.tolist(), self.counts.tolist(), self.primitives.tolist())
+        return self.nodes
+
+    # This method walks the tree along the rays origin + t * direction for t between 0 and t_max, many rays at once, testing every node
+    # box against all the rays still inside it with numpy array operations (see box_hits). origins and directions are (N, 3) arrays, rays
+    # is the array of indices of the rays to walk, and t_max an (N,) array of the distance to search up to along each ray. visit is called
+    # with the list of primitives of each leaf reached and the array of indices of the rays that reached it, and updates t_max in place
+    # as it finds closer hits, so that nodes further away than that are skipped.
+    def traverse_packet(self, origins, directions, rays, t_max, visit):
+        if len(self.primitives) == 0:
+            return
+        bounds_min, bounds_max, offsets, counts, primitives = self.node_lists()
+        with np.errstate(divide='ignore'):
+            inverse = 1.0 / directions
+        parallel = directions == 0
+        # children are visited in the order the packet as a whole meets them
+        mean_direction = directions[rays].mean(axis=0) if len(rays) > 0 else np.zeros(3)
+
+        stack = [(0, rays)]
+        while stack:
+            node, rays = stack.pop()
+            rays = rays[BVH.box_hits(bounds_min[node], bounds_max[node], origins[rays], inverse[rays], parallel[rays], t_max[rays])]
+            if len(rays) == 0:
+                continue
+            if counts[node] > 0:
+                start = offsets[node]
+                visit(primitives[start:start + counts[node]], rays)
+                continue
+            left = offsets[node]
+            left_centre = np.add(bounds_min[left], bounds_max[left])
+            right_centre = np.add(bounds_min[left + 1], bounds_max[left + 1])
+            if np.dot(left_centre - right_centre, mean_direction) > 0:
+                stack.append((left, rays))
+                stack.append((left + 1, rays))
+            else:
+                stack.append((left + 1, rays))
+                stack.append((left, rays))
+
+    # This static method returns a boolean mask of the rays that pass through the box with corners box_min and box_max between 0 and
+    # t_max. inverse holds 1 / direction for every ray and axis, and parallel marks the axes where the direction is 0 (the ray then has
+    # to start between the two planes of that axis).
+    @staticmethod
+    def box_hits(box_min, box_max, origins, inverse, parallel, t_max):
+        with np.errstate(invalid='ignore'):
+            t0 = (np.asarray(box_min) - origins) * inverse
+            t1 = (np.asarray(box_max) - origins) * inverse
+        near = np.minimum(t0, t1)
+        far = np.maximum(t0, t1)
+        if parallel.any():
+            inside = (origins >= box_min) & (origins <= box_max)
+            near = np.where(parallel, np.where(inside, -np.inf, np.inf), near)
+            far = np.where(parallel, np.where(inside, np.inf, -np.inf), far)
+        return np.maximum(near.max(axis=1), 0.0) <= np.minimum(far.min(axis=1), t_max)
+
+
+class SceneBVH:
+    # A two-level BVH over a list of meshes. Every mesh has a bottom-level BVH over its triangles in object space, which only depends on
+    # its geometry and is shared by every mesh and frame using that geometry (see mesh_bvh). The top-level BVH is built over the world
+    # space bounds of the meshes each frame. Rays are moved into the object space of a mesh before walking its bottom-level tree, so the
+    # distance t along a ray is the same in both spaces. The triangles found there are tested in world space, against the WorldTriangles
+    # of the meshes computed once per frame.
+    __slots__ = ('meshes', 'top', 'bottoms', 'inverses', 'triangles')
+
+    def __init__(self, meshes, top, bottoms, inverses, triangles):
+        self.meshes = meshes
+        self.top = top
+        self.bottoms = bottoms
+        # the inverse transform matrix of every mesh, as nested lists
+        self.inverses = inverses
+        self.triangles = triangles
+
+    # This static method builds the SceneBVH for meshes in their current positions.
+    @staticmethod
+    def build(meshes):
+        bottoms = [SceneBVH.mesh_bvh(mesh) for mesh in meshes]
+        world_min = []
+        world_max = []
+        for mesh, bottom in zip(meshes, bottoms):
+            # the world space box of a mesh is the box around the 8 transformed corners of its object space box
+            box = np.stack((bottom.bounds_min[0], bottom.bounds_max[0]))
+            corners = np.array([[box[i, 0], box[j, 1], box[k, 2]] for i in range(2) for j in range(2) for k in range(2)])
+            corners = mesh.transform.apply_to_points(corners)
+            world_min.append(corners.min(axis=0))
+            world_max.append(corners.max(axis=0))
+        top = BVH.build(world_min, world_max, leaf_size=1)
+        inverses = [mesh.transform.inverse_matrix().tolist() for mesh in meshes]
+        return SceneBVH(meshes, top, bottoms, inverses, WorldTriangles.build(meshes))
+
+    # This static method returns the bottom-level BVH of the geometry of mesh, building it the first time the geometry is seen.
+    @staticmethod
+    def mesh_bvh(mesh):
+        entry = _mesh_bvhs.get(id(mesh.verts))
+        if entry is None or entry[0] is not mesh.verts:
+            entry = (mesh.verts, BVH.from_mesh(mesh))
+            _mesh_bvhs[id(mesh.verts)] = entry
+        return entry[1]
+
+    # This static method drops the bottom-level BVHs kept for every geometry seen so far.
+    @staticmethod
+    def clear_cache():
+        _mesh_bvhs.clear()
+
+    # This method finds the closest triangle hit by the rays with the given (N, 3) arrays of origins and directions. It returns three (N,)
+    # arrays: the distance t to the closest hit of every ray (inf if it hits nothing) and the mesh and face index of the triangle hit (-1
+    # if none). skip, if given, is an (N,) array of the mesh index each ray should ignore (-1 for none).
+    # The triangles of every leaf reached are tested against all the rays that reached it at once (see Ray.intersect_edges), in world
+    # space, so the hits are exactly the ones testing every triangle would find. When several triangles are hit at the same distance,
+    # the last one in mesh and face order is returned, as drawing them all in that order would leave it on top.
+    def closest_hits(self, origins, directions, skip=None):
+        origins = np.asarray(origins, dtype=np.float64)
+        directions = np.asarray(directions, dtype=np.float64)
+        closest = np.full(len(origins), np.inf)
+        mesh_hits = np.full(len(origins), -1)
+        face_hits = np.full(len(origins), -1)
+        vertices = self.triangles.vertices
+        edges = self.triangles.edges
+
+        def visit_meshes(mesh_indices, rays):
+            for mesh_index in mesh_indices:
+                mesh_rays = rays if skip is None else rays[skip[rays] != mesh_index]
+                inverse = np.array(self.inverses[mesh_index])
+                local_origins = np.matmul(origins, inverse[0:3, 0:3].T) + inverse[0:3, 3]
+                local_directions = np.matmul(directions, inverse[0:3, 0:3].T)
+
+                def visit_faces(face_indices, rays):
+                    face_indices = np.sort(face_indices)
+                    triangles = self.triangles.offsets[mesh_index] + face_indices
+                    # (rays, faces) arrays of every ray against every triangle of the leaf
+                    hits, t, _, _ = Ray.intersect_edges(origins[rays, None], directions[rays, None], vertices[triangles, 0], edges[triangles, 0], edges[triangles, 1])
+                    t = np.where(hits, t, np.inf)
+                    nearest = t.min(axis=1)
+                    # the last face of the leaf at the nearest distance, counting from the end of the sorted faces
+                    at_nearest = hits & (t == nearest[:, None])
+                    face_index = face_indices[len(face_indices) - 1 - np.argmax(at_nearest[:, ::-1], axis=1)]
+                    # a hit at the same distance as the closest one so far replaces it if it comes later in mesh and face order
+                    later = (mesh_hits[rays] < mesh_index) | ((mesh_hits[rays] == mesh_index) & (face_hits[rays] < face_index))
+                    closer = at_nearest.any(axis=1) & ((nearest < closest[rays]) | ((nearest == closest[rays]) & later))
+                    closest[rays[closer]] = nearest[closer]
+                    mesh_hits[rays[closer]] = mesh_index
+                    face_hits[rays[closer]] = face_index[closer]
+
+                self.bottoms[mesh_index].traverse_packet(local_origins, local_directions, mesh_rays, closest, visit_faces)
+
+        self.top.traverse_packet(origins, directions, np.arange(len(origins)), closest, visit_meshes)
+        return closest, mesh_hits, face_hits
+
+    # This method is the shadow ray query: it returns an (N,) boolean array marking the rays with the given (N, 3) arrays of origins and
+    # directions that hit any triangle at all (t > 0), which is exactly the rays closest_hits would find a hit for. A ray stops being
+    # traced as soon as one hit is found. skip is as in closest_hits. occluders, if given, is an OccluderCache: the triangles it holds are
+    # tested against every ray first and the meshes it holds are walked next, before the top-level tree, and it is updated with the
+    # triangles and meshes that blocked the rays of this query.
+    def occluded(self, origins, directions, skip=None, occluders=None):
+        origins = np.asarray(origins, dtype=np.float64)
+        directions = np.asarray(directions, dtype=np.float64)
+        triangles = self.triangles
+        vertices = triangles.vertices
+        edges = triangles.edges
+        # the triangle that blocked every ray, -1 while none has
+        blockers = np.full(len(origins), -1)
+        # rays that are blocked get a t_max below 0, which drops them from the rest of the walk
+        t_max = np.full(len(origins), np.inf)
+
+        def test_triangles(candidates, rays):
+            hits = Ray.intersect_edges(origins[rays, None], directions[rays, None], vertices[candidates, 0], edges[candidates, 0], edges[candidates, 1])[0]
+            if skip is not None:
+                hits &= skip[rays, None] != triangles.mesh_indices[candidates]
+            blocked = hits.any(axis=1)
+            blockers[rays[blocked]] = candidates[np.argmax(hits[blocked], axis=1)]
+            t_max[rays[blocked]] = -np.inf
+
+        def visit_meshes(mesh_indices, rays):
+            for mesh_index in mesh_indices:
+                mesh_rays = rays[t_max[rays] >= 0]
+                if skip is not None:
+                    mesh_rays = mesh_rays[skip[mesh_rays] != mesh_index]
+                if len(mesh_rays) == 0:
+                    continue
+                inverse = np.array(self.inverses[mesh_index])
+                local_origins = np.matmul(origins, inverse[0:3, 0:3].T) + inverse[0:3, 3]
+                local_directions = np.matmul(directions, inverse[0:3, 0:3].T)
+
+                def visit_faces(face_indices, rays):
+                    test_triangles(triangles.offsets[mesh_index] + np.array(face_indices), rays)
+
+                self.bottoms[mesh_index].traverse_packet(local_origins, local_directions, mesh_rays, t_max, visit_faces)
+
+        rays = np.arange(len(origins))
+        cached_meshes = []
+        if occluders is not None and len(rays) > 0:
+            candidates = occluders.candidates(len(vertices))
+            if candidates:
+                test_triangles(np.array(candidates), rays)
+            cached_meshes = [mesh_index for mesh_index in occluders.meshes if mesh_index < len(self.meshes)]
+            visit_meshes(cached_meshes, rays)
+
+        def visit_other_meshes(mesh_indices, rays):
+            visit_meshes([mesh_index for mesh_index in mesh_indices if mesh_index not in cached_meshes], rays)
+
+        self.top.traverse_packet(origins, directions, rays[t_max >= 0], t_max, visit_other_meshes)
+        if occluders is not None:
+            occluders.remember(blockers[blockers >= 0], triangles.mesh_indices)
+        return blockers >= 0
+
+
+class OccluderCache:
+    # The triangles that blocked the most shadow rays in the last SceneBVH.occluded query that blocked any (at most size of them, most
+    # frequent first) and the meshes they belong to. Neighbouring pixels are usually shadowed by the same few triangles, and nearly
+    # always by the same meshes, so testing these first settles most shadow rays without walking the whole scene. The triangles are
+    # indices into the WorldTriangles of the scene and the meshes indices into its meshes. They only decide the order things are tested
+    # in, so a cache can be kept across tiles and frames (out of range indices are ignored).
+    __slots__ = ('size', 'triangles', 'meshes')
+
+    def __init__(self, size=16):
+        self.size = size
+        self.triangles = []
+        self.meshes = []
+
+    # This method returns the cached triangles that exist in a scene with triangle_count triangles.
+    def candidates(self, triangle_count):
+        return [triangle for triangle in self.triangles if triangle < triangle_count]
+
+    # This method replaces the cached triangles with the ones that occur most often in blockers, the array of the triangle that blocked
+    # every blocked ray of a query, and the cached meshes with theirs (mesh_indices maps triangles to meshes). The cache is left as it
+    # is when no ray was blocked.
+    def remember(self, blockers, mesh_indices):
+        if len(blockers) == 0:
+            return
+        triangles, counts = np.unique(blockers, return_counts=True)
+        self.triangles = triangles[np.argsort(-counts, kind='stable')][:self.size].tolist()
+        meshes, counts = np.unique(mesh_indices[blockers], return_counts=True)
+        self.meshes = meshes[np.argsort(-counts, kind='stable')].tolist()
@@ -2,9 +2,9 @@ from transform import Transform
 import numpy as np
 
 
-class OrthoCamera:
-    # The constructor takes six floats as arguments: left , right, bottom, top, near, and far.
-    # These arguments define the orthographic projection of the camera used to construct ortho_transform.
+class Camera:
+    # What the orthographic and perspective cameras have in common. The constructor takes the six floats left, right, bottom, top, near
+    # and far that define the orthographic projection of the camera, used to construct ortho_transform.
     # The camera transform is initialized with the Transform default constructor.
     def __init__(self, left, right, bottom, top, near, far):
         self.left = left
@@ -17,15 +17,77 @@ class OrthoCamera:
                                           [0, (2 / (far - near)), 0, -((far + near) / (far - near))],
                                           [0, 0, (2 / (top - bottom)), -((top + bottom) / (top - bottom))],
                                           [0, 0, 0, 1]])
+        self.ortho_transform_inv = np.linalg.inv(self.ortho_transform)
 
-        # A Transform object exposed to set the orientation (position and rotation) of the camera.
+        # A Transform object exposed to set the orientation (position and rotation) of the camera. This should default to represent a position of (0, 0, 0) and no rotation.
         self.transform = Transform()
+        # Cached product of the projection matrix and the inverse camera transform, with the transform version it was built from
+        self.view_projection = None
+        self.view_projection_version = None
+        # Cached primary rays of every pixel (see primary_rays), with the transform version and screen size they were built for
+        self.ray_table = None
+        self.ray_table_key = None
 
     # This method simply returns a float that is the ratio of the camera projection plane's width to height.
     # That is, if the screen width is 6 in world space and the screen height is 3, then this method would return 2.0.
     def ratio(self):
         return (self.right - self.left) / (self.top - self.bottom)
 
+    # This method returns the 4x4 matrix that takes a homogeneous point in world space to screen space (before the divide by w), the product
+    # of projection_matrix and the inverse camera transform. It is cached and only rebuilt after the camera transform has changed.
+    def view_projection_matrix(self):
+        if self.view_projection_version != self.transform.version:
+            self.view_projection = np.matmul(self.projection_matrix(), self.transform.inverse_matrix())
+            self.view_projection_version = self.transform.version
+        return self.view_projection
+
+    # This method returns the six planes bounding the view frustum in world space as a (6, 4) Numpy array: the left, near, bottom, right,
+    # far and top planes, in that order. A point p is inside plane (a, b, c, d) when a * p[0] + b * p[1] + c * p[2] + d >= 0, and (a, b, c)
+    # has unit length so that sum is the distance of p from the plane. The planes are taken from the rows of view_projection_matrix.
+    def frustum_planes(self):
+        view_projection = self.view_projection_matrix()
+        planes = np.concatenate((view_projection[3] + view_projection[0:3], view_projection[3] - view_projection[0:3]))
+        return planes / np.linalg.norm(planes[:, 0:3], axis=1)[:, None]
+
+    # This method takes an (N, 3) Numpy array of points in world space and returns the (N, 3) Numpy array of the same points in screen space.
+    # It is the batched version of project_point. The w of an orthographic projection is always 1, so the divide leaves its points as they are.
+    def project_points(self, points):
+        view_projection = self.view_projection_matrix()
+        projected_points = np.matmul(points, view_projection[:, 0:3].T) + view_projection[:, 3]
+        return projected_points[:, 0:3] / projected_points[:, 3:4]
+
+    # This method returns the primary rays the ray tracers shoot through the pixels of screen, as a pair of (width, height, 3) arrays of
+    # ray origins and directions indexed [x, y]. A ray starts at the point of the near plane (screen space y of -1) under the pixel centre
+    # and goes along the world y axis. The table is built for the whole screen with one vectorized inverse projection (see
+    # inverse_project_points) and cached until the camera transform or the screen size changes, the arrays must not be written to.
+    def primary_rays(self, screen):
+        key = (self.transform.version, screen.width, screen.height)
+        if self.ray_table_key != key:
+            pix_x, pix_y = np.meshgrid(np.arange(screen.width), np.arange(screen.height), indexing='ij')
+            x_screen, z_screen = screen.pixels_to_screen(pix_x, pix_y)
+            points = np.stack((x_screen, np.full(x_screen.shape, -1.0), z_screen), axis=-1)
+            origins = self.inverse_project_points(points.reshape(-1, 3)).reshape(points.shape)
+            directions = np.broadcast_to(np.array([0.0, 1.0, 0.0]), points.shape)
+            self.ray_table = (origins, directions)
+            self.ray_table_key = key
+        return self.ray_table
+
+    # The cached ray table is left out when a camera is pickled (for example when it is sent to a worker process)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['ray_table'] = None
+        state['ray_table_key'] = None
+        return state
+
+
+class OrthoCamera(Camera):
+    # A camera with an orthographic projection, it is constructed like Camera from left, right, bottom, top, near and far.
+
+    # This method returns the 4x4 matrix that takes a homogeneous point in camera space to screen space (before the divide by w).
+    # For the orthographic camera this is the orthographic transformation matrix itself.
+    def projection_matrix(self):
+        return np.asarray(self.ortho_transform)
+
     # This method takes a 3 element Numpy array, p, that represents a 3D point in world space as input.
     # It then transforms p to the camera coordinate system before performing an orthographic projection using the orthographic
     # transformation matrix and returns the resulting 3 element Numpy array that represents the point in screen space.
@@ -44,48 +106,38 @@ class OrthoCamera:
     # orthographic transformation matrix and returns the resulting 3 element Numpy array.
     def inverse_project_point(self, p):
         # convert from screen space to camera space
-        inv_ortho_mat = np.linalg.inv(self.ortho_transform)
         working_point = np.append(np.transpose(np.asmatrix(p)), [[1]], axis=0)
-        temp0 = np.matmul(inv_ortho_mat, working_point)
+        temp0 = np.matmul(self.ortho_transform_inv, working_point)
         temp1 = np.delete(temp0, 3, 0)
         arrPoint = np.ravel(temp1)
         # convert from camera space to world space
         retVal = self.transform.apply_to_point(arrPoint)
         return retVal
 
+    # This method takes an (N, 3) Numpy array of points in screen space and returns the (N, 3) Numpy array of the same points in world space.
+    # It is the batched version of inverse_project_point.
+    def inverse_project_points(self, points):
+        inv_ortho_mat = np.asarray(self.ortho_transform_inv)
+        camera_space_points = np.matmul(points, inv_ortho_mat[0:3, 0:3].T) + inv_ortho_mat[0:3, 3]
+        return self.transform.apply_to_points(camera_space_points)
 
-class PerspectiveCamera:
+
+class PerspectiveCamera(Camera):
     # The constructor takes six floats as arguments: left , right, bottom, top, near, and far.
-    # These arguments define the orthographic projection of the camera used to construct the orthographic transformation.
+    # These arguments define the orthographic projection of the camera used to construct the orthographic transformation (see Camera).
     # The near and far values are also used to construct the perspective matrix.
     def __init__(self, left, right, bottom, top, near, far):
-        self.left = left
-        self.right = right
-        self.bottom = bottom
-        self.top = top
-        self.near = near
-        self.far = far
-
-        self.ortho_transform = np.matrix([[(2 / (right - left)), 0, 0, -((right + left) / (right - left))],
-                                          [0, (2 / (far - near)), 0, -((far + near) / (far - near))],
-                                          [0, 0, (2 / (top - bottom)), -((top + bottom) / (top - bottom))],
-                                          [0, 0, 0, 1]])
-
+        Camera.__init__(self, left, right, bottom, top, near, far)
         self.perspective_matrix = np.matrix([[near, 0, 0, 0],
                                              [0, near + far, 0, -(far * near)],
                                              [0, 0, near, 0],
                                              [0, 1, 0, 0]])
-
-        self.ortho_transform_inv = np.linalg.inv(self.ortho_transform)
         self.perspective_matrix_inv = np.linalg.inv(self.perspective_matrix)
 
-        # A Transform object exposed to set the orientation (position and rotation) of the camera. This should default to represent a position of (0, 0, 0) and no rotation.
-        self.transform = Transform()
-
-    # This method simply returns a float that is the ratio of the camera projection plane's width to height.
-    # That is, if the screen width is 6 in world space and the screen height is 3, then this method would return 2.0.
-    def ratio(self):
-        return (self.right - self.left) / (self.top - self.bottom)
+    # This method returns the 4x4 matrix that takes a homogeneous point in camera space to screen space. The perspective divide happens
+    # after it: dividing the result by its w component gives the same point as project_point, since the orthographic transform is linear.
+    def projection_matrix(self):
+        return np.asarray(np.matmul(self.ortho_transform, self.perspective_matrix))
 
     # This method takes a 3 element Numpy array, p, that represents a 3D point in world space as input.
     # It then transforms p to the camera coordinate system before performing the perspective projection into screen space and returns the resulting 3 element Numpy array.
@@ -118,6 +170,18 @@ class PerspectiveCamera:
         retVal = self.transform.apply_to_point(arrPoint)
         return retVal
 
+    # This method takes an (N, 3) Numpy array of points in screen space and returns the (N, 3) Numpy array of the same points in world space.
+    # It is the batched version of inverse_project_point.
+    def inverse_project_points(self, points):
+        # convert from screen space to camera space
+        ortho_transform_inv = np.asarray(self.ortho_transform_inv)
+        projected_points = np.matmul(points, ortho_transform_inv[:, 0:3].T) + ortho_transform_inv[:, 3]
+        # un-project the points
+        Yc = (self.far * self.near) / (self.near + self.far - projected_points[:, 1:2])
+        camera_space_points = np.matmul(projected_points * Yc, np.asarray(self.perspective_matrix_inv).T)
+        # convert from camera space to world space
+        return self.transform.apply_to_points(camera_space_points[:, 0:3])
+
     # fov is the camera's horizontal field of view in degrees, near is the distance to the near clipping plane,
     # far is the distance to the far clipping plane, and ratio is the pixel ratio of the final image (the value returned from screen.ratio()).
     # This static method will then compute left, right, top, and bottom to create a PerspectiveCamera object.
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+import time
+
+# Renders one frame of a small scene in a fresh Python process and prints how long it took from the start of the process to the frame
+# being drawn and saved, and whether pygame was loaded. The first argument picks a headless screen ('headless') or a window ('window'),
+# the second the file the frame is saved to.
+FIRST_FRAME = """
+import time
+start_time = time.perf_counter()
+import sys
+import numpy as np
+from screen import Screen
+from camera import PerspectiveCamera
+from mesh import Mesh
+from sequential_renderer import Renderer
+from light import PointLight
+import_time = time.perf_counter() - start_time
+
+screen = Screen(128, 128, headless=sys.argv[1] == 'headless')
+camera = PerspectiveCamera(-1.0, 1.0, -1.0, 1.0, 1.0, 20)
+camera.transform.set_position(0, -4, 0)
+mesh = Mesh.from_stl('suzanne.stl', np.array([1.0, 0.0, 1.0]), np.array([1.0, 1.0, 1.0]), 0.05, 1.0, 0.2, 100)
+mesh.transform.set_rotation(-15, 0, 215)
+light = PointLight(50.0, np.array([1, 1, 1]))
+light.transform.set_position(4, -4, -3)
+Renderer(screen, camera, [mesh], light).render('flat', [80, 80, 80], [0.2, 0.2, 0.2])
+screen.save(sys.argv[2])
+print('RESULT', import_time, time.perf_counter() - start_time, 'pygame' in sys.modules)
+"""
+
+
+# This function runs FIRST_FRAME in a new interpreter with the given screen mode and returns (seconds from launching the interpreter
+# to its exit, seconds spent importing the renderer, seconds from the first import to the saved frame, whether pygame was loaded).
+def measure(mode, path):
+    start_time = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', FIRST_FRAME, mode, path], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    total_time = time.perf_counter() - start_time
+    result = [line.split() for line in output.splitlines() if line.startswith('RESULT')][-1]
+    return total_time, float(result[1]), float(result[2]), result[3] == 'True'
+
+
+if __name__ == '__main__':
+    # the window mode needs a display, or SDL_VIDEODRIVER=dummy
+    modes = sys.argv[1:] or ['headless', 'window']
+    for mode in modes:
+        total_time, import_time, frame_time, loaded_pygame = measure(mode, os.path.abspath('cold_start_' + mode + '.png'))
+        print(mode + ': first frame saved ' + str(round(total_time, 3)) + 's after launch (imports ' + str(round(import_time, 3)) + 's, '
+              + 'imports to frame ' + str(round(frame_time, 3)) + 's), pygame ' + ('loaded' if loaded_pygame else 'not loaded'))
@@ -42,30 +42,16 @@ class ColorCalculation:
     def getMinMaxDepth(meshes, camera):
         min_depth = np.inf
         max_depth = -np.inf
-        all_vertices = []
+        camera_normal = camera.transform.apply_to_normal(np.array([0, 1, 0]))
         for mesh in meshes:
-            for face in mesh.faces:
-                # Normal culling
-                temp_face_normal = mesh.normals[mesh.faces.index(face)]
-                face_normal = mesh.transform.apply_to_normal(temp_face_normal)
-                camera_normal = camera.transform.apply_to_normal(np.array([0, 1, 0]))
-                if np.dot(face_normal, camera_normal) >= 0:
-                    continue
-
-                # convert vertices to world space
-                world_vertices = []
-                for vertIndex in face:
-                    world_vertices.append(mesh.transform.apply_to_point(mesh.verts[vertIndex]))
-
-                # convert world vertices to screen space
-                screen_vertices = []
-                for vert in world_vertices:
-                    all_vertices.append(camera.project_point(vert))
-        for vert in all_vertices:
-            if vert[1] > max_depth:
-                max_depth = vert[1]
-            if vert[1] < min_depth:
-                min_depth = vert[1]
+            # Normal culling, then project the vertices of the faces that are left all at once
+            front_facing = np.matmul(mesh.transform.apply_to_normals(mesh.normals), camera_normal) < 0
+            vertices = mesh.verts[np.unique(mesh.faces[front_facing])]
+            if len(vertices) == 0:
+                continue
+            depths = camera.project_points(mesh.transform.apply_to_points(vertices))[:, 1]
+            min_depth = min(min_depth, float(depths.min()))
+            max_depth = max(max_depth, float(depths.max()))
         return min_depth, max_depth
 
     @staticmethod
@@ -136,4 +122,81 @@ class ColorCalculation:
         # final Lambertian reflectance
         Lr = np.add(np.multiply(np.add(diffuse, specular), E), np.multiply(ambient_color, mesh.ka))
 
-        return ColorCalculation.calcFinalRGB(Lr)
\ No newline at end of file
+        return ColorCalculation.calcFinalRGB(Lr)
+
+    # The methods below are array versions of the shading methods above. They shade many points at once, taking (N, 3) numpy arrays of
+    # positions and normals, and return an (N, 3) uint8 array of final colors. The light position is only computed once per call.
+
+    # bulk version of magnitude, returns the length of every row of an (N, 3) numpy array
+    @staticmethod
+    def magnitudes(vectors):
+        return np.sqrt(vectors[:, 0] ** 2 + vectors[:, 1] ** 2 + vectors[:, 2] ** 2)
+
+    # bulk version of calcFinalRGB, converts an (N, 3) array of colors between 0.0 and 1.0 to an (N, 3) uint8 array
+    @staticmethod
+    def final_rgb_array(colors):
+        return np.clip(np.trunc(colors * 255), 0, 255).astype(np.uint8)
+
+    # array version of flat, face_vertices is an (N, 3, 3) array holding the three world space vertices of each face and
+    # face_normals an (N, 3) array of their world space normals
+    @staticmethod
+    def flat_array(face_vertices, face_normals, mesh, light, ambient_color):
+        # calculate intensity E = I * color * 1/d^2 * cos(theta)
+        light_position = light.transform.apply_to_point(np.array([0, 0, 0]))
+        points_world = face_vertices[:, 0] / 3 + face_vertices[:, 1] / 3 + face_vertices[:, 2] / 3
+        l = light_position - points_world
+        d = ColorCalculation.magnitudes(l)
+        cos_theta = np.maximum(0.0, (l[:, 0] * face_normals[:, 0] + l[:, 1] * face_normals[:, 1] + l[:, 2] * face_normals[:, 2]) / d)
+        E = light.intensity * light.color * (1 / d ** 2)[:, None] * cos_theta[:, None]
+
+        # calculate the diffuse shading component Cd/pi * Kd
+        diffuse = (mesh.kd / math.pi) * mesh.diffuse_color
+
+        # final Lambertian reflectance
+        Lr = diffuse * E + np.multiply(ambient_color, mesh.ka)
+        return ColorCalculation.final_rgb_array(Lr)
+
+    # array version of barycentric, alpha, beta and gamma are arrays of barycentric coordinates of the same length
+    @staticmethod
+    def barycentric_array(alpha, beta, gamma):
+        return np.trunc(np.stack((alpha, beta, gamma), axis=1) * 255).astype(np.uint8)
+
+    # array version of depth, screen_y is an array of screen space depths
+    @staticmethod
+    def depth_array(min_depth, max_depth, screen_y):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent = (screen_y - min_depth) / (max_depth - min_depth)
+        percent = np.where(screen_y == min_depth, 0.0, np.where(screen_y == max_depth, 1.0, percent))
+        return np.repeat(np.trunc(percent * 255).astype(np.uint8)[:, None], 3, axis=1)
+
+    # array version of phong, points_world and interpolated_normals are (N, 3) arrays of world space positions and unit normals
+    @staticmethod
+    def phong_array(points_world, interpolated_normals, mesh, light, ambient_color, camera_pos):
+        # calculate intensity E = I * color * 1/d^2 * cos(theta)
+        light_position = light.transform.apply_to_point(np.array([0, 0, 0]))
+        l = light_position - points_world
+        d = ColorCalculation.magnitudes(l)
+        l = l / d[:, None]
+        cos_theta = np.maximum(0.0, l[:, 0] * interpolated_normals[:, 0] + l[:, 1] * interpolated_normals[:, 1] + l[:, 2] * interpolated_normals[:, 2])
+        E = light.intensity * light.color * (1 / d ** 2)[:, None] * cos_theta[:, None]
+
+        # calculate the diffuse shading component Cd/pi * Kd
+        diffuse = (mesh.kd / math.pi) * mesh.diffuse_color
+
+        # calculate the specular shading component
+        v = camera_pos - points_world
+        v = v / ColorCalculation.magnitudes(v)[:, None]
+        h = l + v
+        h_norm = h / ColorCalculation.magnitudes(h)[:, None]
+        cos_alpha = np.maximum(0, h_norm[:, 0] * interpolated_normals[:, 0] + h_norm[:, 1] * interpolated_normals[:, 1] + h_norm[:, 2] * interpolated_normals[:, 2])
+        specular = mesh.ks * mesh.specular_color * (cos_alpha ** mesh.ke)[:, None]
+
+        # final Lambertian reflectance
+        Lr = (diffuse + specular) * E + np.multiply(ambient_color, mesh.ka)
+        return ColorCalculation.final_rgb_array(Lr)
+
+    # array version of gouraud, points_world and vertex_normals are (N, 3) arrays of world space vertices and their unit normals.
+    # The lighting model is the same as phong's, gouraud shading only differs in evaluating it at the vertices.
+    @staticmethod
+    def gouraud_array(points_world, vertex_normals, mesh, light, ambient_color, camera_pos):
+        return ColorCalculation.phong_array(points_world, vertex_normals, mesh, light, ambient_color, camera_pos)
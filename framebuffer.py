@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class Framebuffer:
+    # The output of a render: color is a contiguous (height, width, 3) uint8 array of 8-bit RGB rows from the top of the image down, the
+    # layout of a window surface or an image file, so it is shown and saved without being converted (see Screen.draw and ImageWriter).
+    # depth is a (height, width) float32 array in the same order, or None if the renderer did not keep the depths.
+    # The renderers index pixels [x, y] with y counting up from the bottom of the screen. pixels and z_buffer return views of the two
+    # planes in that order: writes through them land in color and depth directly, there is no image to copy over at the end.
+    # shared is set for planes that are frame buffers of a RenderPool (see RenderPool.frame_buffer), which are drawn into again by later
+    # frames and freed with the pool, so whoever keeps the image must copy it.
+    __slots__ = ('width', 'height', 'color', 'depth', 'shared')
+
+    # The constructor takes the size of the image and, optionally, the arrays to use as its planes (for example arrays in shared memory,
+    # see SharedBuffer). Planes that are not given are allocated, color black and depth at infinity. With depth set to False the
+    # framebuffer has no depth plane.
+    def __init__(self, width, height, color=None, depth=None, shared=False):
+        self.width = width
+        self.height = height
+        self.color = np.zeros((height, width, 3), dtype=np.uint8) if color is None else color
+        if depth is None:
+            depth = np.full((height, width), np.inf, dtype=np.float32)
+        self.depth = None if depth is False else depth
+        self.shared = shared
+
+    # This static method returns a view of a color plane indexed [x, y] like the image buffers of the renderers.
+    @staticmethod
+    def pixel_view(color):
+        return color[::-1].transpose(1, 0, 2)
+
+    # This static method returns a view of a depth plane indexed [x, y] like the z-buffers of the renderers.
+    @staticmethod
+    def depth_view(depth):
+        return depth[::-1].T
+
+    # This static method returns a framebuffer holding a copy of image_buffer, an image buffer indexed [x, y] like the ones the renderers
+    # draw into. Colors are clipped to 0 - 255.
+    @staticmethod
+    def from_pixels(image_buffer):
+        framebuffer = Framebuffer(image_buffer.shape[0], image_buffer.shape[1], depth=False)
+        framebuffer.pixels()[:] = np.clip(image_buffer, 0, 255)
+        return framebuffer
+
+    # This method returns the color plane indexed [x, y] (see pixel_view).
+    def pixels(self):
+        return Framebuffer.pixel_view(self.color)
+
+    # This method returns the depth plane indexed [x, y] (see depth_view).
+    def z_buffer(self):
+        return Framebuffer.depth_view(self.depth)
+
+    # This method fills the color plane with bg_color (clipped to 0 - 255) and the depth plane with infinity.
+    def clear(self, bg_color):
+        # one row is filled and copied to the others, broadcasting a single color over the short last axis is many times slower
+        self.color[0] = np.clip(bg_color, 0, 255)
+        self.color[1:] = self.color[0]
+        if self.depth is not None:
+            self.depth.fill(np.inf)
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# A geometry file starts with MAGIC followed by a 4 byte little endian header length and a JSON header. The header records the
+# source file the geometry was built from and the dtype, shape and byte offset of every array. The raw array data follows the
+# header, with every array starting on an ALIGNMENT byte boundary so that it can be read (or mapped) straight into a numpy array.
+MAGIC = b'MESHGEO1'
+ALIGNMENT = 64
+GEOMETRY_ARRAYS = ('verts', 'faces', 'normals', 'vertex_normals')
+
+
+class GeometryFile:
+    # This static method returns the hex sha1 digest of the contents of the file at path, reading it in 1MB blocks.
+    @staticmethod
+    def file_hash(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    # This static method returns a dictionary describing the source file at path (its sha1, modification time and size).
+    # It is stored in the header of a geometry file and used to decide whether the file is still valid.
+    @staticmethod
+    def describe_source(path):
+        stat = os.stat(path)
+        return {'path': os.path.abspath(path), 'sha1': GeometryFile.file_hash(path), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+    # This static method returns the path of the geometry file for stl_path inside cache_dir. The name depends on the source path
+    # and the import options, so meshes loaded from the same stl file with different options do not overwrite each other.
+    @staticmethod
+    def cache_path(cache_dir, stl_path, options):
+        key = json.dumps([os.path.abspath(stl_path), options], sort_keys=True)
+        name = os.path.basename(stl_path) + '.' + hashlib.sha1(key.encode()).hexdigest()[:16] + '.geo'
+        return os.path.join(cache_dir, name)
+
+    # This static method writes the arrays dictionary (name -> numpy array) to path together with the source and options dictionaries.
+    # The file is written next to its destination first and then moved into place, so a reader never sees a partially written file.
+    @staticmethod
+    def write(path, arrays, source, options):
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            offset = -(-offset // ALIGNMENT) * ALIGNMENT
+            layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset += array.nbytes
+        header = json.dumps({'source': source, 'options': options, 'arrays': layout}).encode()
+        data_start = -(-(len(MAGIC) + 4 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(4, 'little'))
+            f.write(header)
+            for name, array in arrays.items():
+                f.seek(data_start + layout[name]['offset'])
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(temp_path, path)
+
+    # This static method reads the header of the geometry file at path and returns it as a dictionary, with the byte offset of each
+    # array converted to an absolute position in the file. It raises a ValueError if path is not a geometry file.
+    @staticmethod
+    def read_header(path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(path + " is not a geometry file")
+            header_length = int.from_bytes(f.read(4), 'little')
+            header = json.loads(f.read(header_length))
+        data_start = -(-(len(MAGIC) + 4 + header_length) // ALIGNMENT) * ALIGNMENT
+        for layout in header['arrays'].values():
+            layout['offset'] += data_start
+        return header
+
+    # This static method reads the geometry file at path and returns its header and a dictionary of the arrays stored in it.
+    # With mmap set the arrays are read-only np.memmap views of the file, so their pages are only loaded when they are accessed
+    # and every process mapping the same file shares them through the page cache.
+    @staticmethod
+    def read(path, mmap=False):
+        header = GeometryFile.read_header(path)
+        arrays = {}
+        for name, layout in header['arrays'].items():
+            dtype = np.dtype(layout['dtype'])
+            shape = tuple(layout['shape'])
+            if mmap:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=layout['offset'], shape=shape)
+            else:
+                arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)), offset=layout['offset']).reshape(shape)
+        return header, arrays
+
+    # This static method returns True if the geometry file described by header was built from the current contents of stl_path with
+    # the given options. A matching modification time and size is trusted as is, otherwise the contents are compared by hash, so a
+    # source file that was only touched or copied still hits the cache.
+    @staticmethod
+    def is_valid(header, stl_path, options):
+        if header['options'] != options:
+            return False
+        source = header['source']
+        stat = os.stat(stl_path)
+        if stat.st_mtime_ns == source['mtime_ns'] and stat.st_size == source['size']:
+            return True
+        return stat.st_size == source['size'] and GeometryFile.file_hash(stl_path) == source['sha1']
+
+    # This static method returns the path of the valid geometry file cached for stl_path in cache_dir, or None if there is none.
+    @staticmethod
+    def find(cache_dir, stl_path, options):
+        path = GeometryFile.cache_path(cache_dir, stl_path, options)
+        if not os.path.exists(path):
+            return None
+        try:
+            header = GeometryFile.read_header(path)
+        except ValueError:
+            return None
+        if not GeometryFile.is_valid(header, stl_path, options):
+            return None
+        return path
+
+    # This static method writes the geometry arrays for stl_path to its cache file in cache_dir and returns the path of that file.
+    @staticmethod
+    def store(cache_dir, stl_path, options, arrays):
+        path = GeometryFile.cache_path(cache_dir, stl_path, options)
+        GeometryFile.write(path, arrays, GeometryFile.describe_source(stl_path), options)
+        return path
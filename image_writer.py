@@ -0,0 +1,62 @@
+import struct
+import zlib
+from framebuffer import Framebuffer
+
+
+class ImageWriter:
+    # This static method returns the pixels of image, a Framebuffer or an image buffer indexed [x, y] like the ones passed to Screen.draw
+    # (y counts up from the bottom of the image), as a contiguous (height, width, 3) uint8 array of rows from the top of the image down,
+    # the order image files store them in. That is the color plane of a Framebuffer itself, an image buffer is converted, with its
+    # colors clipped to 0 - 255.
+    @staticmethod
+    def rows(image):
+        if isinstance(image, Framebuffer):
+            return image.color
+        return Framebuffer.from_pixels(image).color
+
+    # This static method saves image (see rows) to path in the format given by the extension of path: png, ppm (binary P6) or raw (the
+    # bytes of rows, 8-bit RGB from the top left pixel, without a header). None of them need pygame or a display, and the color plane
+    # of a Framebuffer is written or compressed as it is, without a copy.
+    @staticmethod
+    def write(path, image):
+        extension = path.rsplit('.', 1)[-1].lower()
+        if extension == 'png':
+            ImageWriter.write_png(path, image)
+        elif extension == 'ppm':
+            ImageWriter.write_ppm(path, image)
+        elif extension == 'raw':
+            ImageWriter.write_raw(path, image)
+        else:
+            raise ValueError("unsupported image format: " + path)
+
+    # This static method saves image to path as an 8-bit RGB png file.
+    @staticmethod
+    def write_png(path, image, compression=6):
+        rows = ImageWriter.rows(image)
+        height, width, _ = rows.shape
+        # every row starts with its filter type, 0 (none), the rows are fed to the compressor one at a time straight from the image
+        compressor = zlib.compressobj(compression)
+        data = b''.join(compressor.compress(b'\x00') + compressor.compress(row) for row in rows) + compressor.flush()
+
+        def chunk(kind, payload):
+            return struct.pack('>I', len(payload)) + kind + payload + struct.pack('>I', zlib.crc32(kind + payload))
+
+        with open(path, 'wb') as file:
+            file.write(b'\x89PNG\r\n\x1a\n')
+            file.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+            file.write(chunk(b'IDAT', data))
+            file.write(chunk(b'IEND', b''))
+
+    # This static method saves image to path as a binary (P6) ppm file.
+    @staticmethod
+    def write_ppm(path, image):
+        rows = ImageWriter.rows(image)
+        with open(path, 'wb') as file:
+            file.write(b'P6\n' + str(rows.shape[1]).encode() + b' ' + str(rows.shape[0]).encode() + b'\n255\n')
+            file.write(memoryview(rows).cast('B'))
+
+    # This static method saves the bytes of image's rows (see rows) to path, with no header.
+    @staticmethod
+    def write_raw(path, image):
+        with open(path, 'wb') as file:
+            file.write(memoryview(ImageWriter.rows(image)).cast('B'))
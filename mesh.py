@@ -1,19 +1,40 @@
+import os
+import numpy as np
 from stl import mesh as numpyMesh
 import threeDVector as v
 from transform import Transform
+from geometry_file import GeometryFile, GEOMETRY_ARRAYS
+from shared_buffer import SharedBuffer
+
+# Geometry buffers loaded from stl files, keyed on the file and the import options and shared by every Mesh loaded from it
+_shared_geometry = {}
+# SharedBuffers this process attached to for meshes received with shared geometry, keyed on the names of their blocks
+_attached_geometry = {}
+# Number of faces in the blocks face_chunks yields, the vertex stage and the world space and BVH builds work on one block at a time
+FACE_CHUNK_SIZE = 65536
 
 
 class Mesh:
+    # Meshes only ever carry these members, declaring them keeps every instance free of a per-object attribute dictionary
+    __slots__ = ('verts', 'faces', 'normals', 'vertex_normals', 'geometry_path', 'shared_geometry', 'local_bounds', 'transform',
+                 'diffuse_color', 'specular_color', 'ka', 'kd', 'ks', 'ke')
+
     # The constructor takes diffuse and specular color as an 3 element np array with all three values between 0.0 and 1.0, as well as material properties ka, kd, ks, and ke.
     def __init__(self, diffuse_color, specular_color, ka, kd, ks, ke):
-        # List of 3D vertices <x,y,z> for the mesh.
+        # (V, 3) float32 array of 3D vertices <x,y,z> for the mesh.
         self.verts = None
-        # List of triangle faces for the mesh, with each face defined as a list of 3 vertex indices into verts in counterclockwise ordering.
+        # (F, 3) int32 array of triangle faces for the mesh, with each face defined as 3 vertex indices into verts in counterclockwise ordering.
         self.faces = None
-        # List of 3D face normals for the mesh. The elements of this list correspond to the same triangles defined in faces.
+        # (F, 3) float32 array of 3D face normals for the mesh. The rows of this array correspond to the same triangles defined in faces.
         self.normals = None
-        # List of vertex normals for the mesh. The elements of the list correspond to the same vertices defined in verts.
+        # (V, 3) float32 array of vertex normals for the mesh. The rows of this array correspond to the same vertices defined in verts.
         self.vertex_normals = None
+        # Path of the geometry file the buffers above are memory-mapped from, or None if they are held in memory.
+        self.geometry_path = None
+        # Descriptions of the SharedBuffers the buffers above live in (see set_shared_geometry), or None if they are not in shared memory.
+        self.shared_geometry = None
+        # Bounding box and sphere of verts in object space (see bounds), computed on first use.
+        self.local_bounds = None
         # Transform object member
         self.transform = Transform()
 
@@ -26,41 +47,192 @@ class Mesh:
 
     # This static method takes an stl file as input, initializes an empty Mesh object using the input material properties diffuse_color,
     # specular_color, ka, kd, ks, ke and populates the verts, faces, and normals member variables. The method returns the populated Mesh object.
+    # weld_epsilon is an optional tolerance used when merging triangle corners into shared vertices (see weld_vertices), and normal_weighting
+    # selects how face normals are combined into vertex normals ('uniform', 'area' or 'angle', see ThreeDVector.vertex_normals).
+    # If cache_dir is given the preprocessed geometry is written there on the first load and read back on later loads (see load_geometry).
+    # With mmap set the geometry is memory-mapped from that file instead of being read into memory, which requires a cache_dir.
     @staticmethod
-    def from_stl(stl_path, diffuse_color, specular_color, ka, kd, ks, ke):
-        # get mesh
-        meshInput = numpyMesh.Mesh.from_file(stl_path)
+    def from_stl(stl_path, diffuse_color, specular_color, ka, kd, ks, ke, weld_epsilon=0.0, normal_weighting='uniform', cache_dir=None, mmap=False):
         # initialize mesh object
         mesh = Mesh(diffuse_color, specular_color, ka, kd, ks, ke)
-        mesh.verts = []
-        mesh.faces = []
-        mesh.normals = []
-        mesh.vertex_normals = []
-
-        # for each triangle in the mesh parse out its vertices and store the faces and vertices in two separate lists
-        for triangle in meshInput:
-            facePoints = []
-            for i in range(0, len(triangle), 3):
-                vertex = tuple(triangle[i:i+3])  # grab numbers from the triangle 3 at a time, so you get one of the vertices of the triangle
-                if vertex not in mesh.verts:  # only add a vertex to the list once, if we encounter a vertex from a triangle that has already been added, ignore it
-                    mesh.verts.append(vertex)
-                facePoints.append(mesh.verts.index(vertex))
-            mesh.faces.append(tuple(facePoints))  # once we have looped through the whole triangle record the vertices that make up its face as indices into the vertex list
-
-        # calculate and store the normals for each of the triangles
-        for face in mesh.faces:
-            mesh.normals.append(v.ThreeDVector.find_normal([mesh.verts[face[0]], mesh.verts[face[1]], mesh.verts[face[2]]]))
-
-        # collect all the face normals for the faces that are touching a vertex for all vertices
-        face_normals_for_vertices = [ [] for _ in range(len(mesh.verts))]
-        for face in mesh.faces:
-            index_of_face = mesh.faces.index(face)
-            face_normals_for_vertices[face[0]].append(mesh.normals[index_of_face])
-            face_normals_for_vertices[face[1]].append(mesh.normals[index_of_face])
-            face_normals_for_vertices[face[2]].append(mesh.normals[index_of_face])
-
-        # calculate and store the normals for the vertices
-        for i in range(0, len(mesh.verts)):
-            mesh.vertex_normals.append(v.ThreeDVector.vertex_normal(face_normals_for_vertices[i]))
-
-        return mesh
\ No newline at end of file
+        if mmap:
+            if cache_dir is None:
+                raise ValueError("memory-mapping an stl file requires a cache_dir to write its geometry file to")
+            mesh.map_geometry_file(Mesh.geometry_file(stl_path, cache_dir, weld_epsilon, normal_weighting))
+        else:
+            mesh.set_geometry(*Mesh.load_geometry(stl_path, weld_epsilon, normal_weighting, cache_dir))
+        return mesh
+
+    # This static method creates a Mesh with the input material properties from a preprocessed geometry file (see geometry_file).
+    # By default the geometry is memory-mapped, so only the parts of the file the renderers touch are ever loaded.
+    @staticmethod
+    def from_geometry_file(path, diffuse_color, specular_color, ka, kd, ks, ke, mmap=True):
+        mesh = Mesh(diffuse_color, specular_color, ka, kd, ks, ke)
+        if mmap:
+            mesh.map_geometry_file(path)
+        else:
+            arrays = GeometryFile.read(path)[1]
+            mesh.set_geometry(*[arrays[name] for name in GEOMETRY_ARRAYS])
+        return mesh
+
+    # This static method returns the path of the geometry file for an stl file in cache_dir, building the geometry from the stl file and
+    # writing the file first if there is no valid one yet (see GeometryFile.is_valid).
+    @staticmethod
+    def geometry_file(stl_path, cache_dir, weld_epsilon=0.0, normal_weighting='uniform'):
+        options = {'weld_epsilon': weld_epsilon, 'normal_weighting': normal_weighting}
+        path = GeometryFile.find(cache_dir, stl_path, options)
+        if path is None:
+            arrays = dict(zip(GEOMETRY_ARRAYS, Mesh.typed_geometry(*Mesh.build_geometry(stl_path, weld_epsilon, normal_weighting))))
+            path = GeometryFile.store(cache_dir, stl_path, options, arrays)
+        return path
+
+    # This static method returns the verts, faces, normals and vertex_normals buffers for an stl file. Meshes loaded from the same
+    # unchanged file with the same options share one read-only copy of these buffers, so each Mesh only adds its own Transform and material.
+    # If cache_dir is given the buffers are read from the geometry file for the stl file in that directory (see geometry_file).
+    @staticmethod
+    def load_geometry(stl_path, weld_epsilon=0.0, normal_weighting='uniform', cache_dir=None):
+        stat = os.stat(stl_path)
+        key = (os.path.realpath(stl_path), stat.st_mtime_ns, stat.st_size, weld_epsilon, normal_weighting)
+        geometry = _shared_geometry.get(key)
+        if geometry is not None:
+            return geometry
+
+        if cache_dir is not None:
+            arrays = GeometryFile.read(Mesh.geometry_file(stl_path, cache_dir, weld_epsilon, normal_weighting))[1]
+            geometry = Mesh.typed_geometry(*[arrays[name] for name in GEOMETRY_ARRAYS])
+        else:
+            geometry = Mesh.typed_geometry(*Mesh.build_geometry(stl_path, weld_epsilon, normal_weighting))
+        for array in geometry:
+            array.flags.writeable = False
+        _shared_geometry[key] = geometry
+        return geometry
+
+    # This static method returns the verts, faces, normals and vertex_normals buffers memory-mapped from the geometry file at path.
+    # Every mesh mapping the same unchanged file within a process shares the same mapping.
+    @staticmethod
+    def map_geometry(path):
+        key = ('mmap', os.path.realpath(path), os.stat(path).st_mtime_ns)
+        geometry = _shared_geometry.get(key)
+        if geometry is None:
+            arrays = GeometryFile.read(path, mmap=True)[1]
+            geometry = Mesh.typed_geometry(*[arrays[name] for name in GEOMETRY_ARRAYS])
+            _shared_geometry[key] = geometry
+        return geometry
+
+    # This method memory-maps the geometry of the mesh from the geometry file at path.
+    def map_geometry_file(self, path):
+        self.set_geometry(*Mesh.map_geometry(path))
+        self.geometry_path = os.path.abspath(path)
+
+    # This static method drops the geometry buffers shared between meshes, so the next load of every stl file reads it again.
+    @staticmethod
+    def clear_geometry_cache():
+        _shared_geometry.clear()
+
+    # This method yields the faces of the mesh in blocks of at most chunk_size rows as (index of the first face, faces block) pairs.
+    # For a memory-mapped mesh each block is only read from the geometry file once it is reached, and the per face arrays built from a
+    # block (its corners, their outcodes or colors) never exist for the whole model at once.
+    def face_chunks(self, chunk_size=FACE_CHUNK_SIZE):
+        for start in range(0, len(self.faces), chunk_size):
+            yield start, np.asarray(self.faces[start:start + chunk_size])
+
+    # This method moves the mesh onto geometry buffers held in shared memory, buffers being the verts, faces, normals and vertex_normals
+    # SharedBuffers (see RenderPool.share_geometry).
+    def set_shared_geometry(self, buffers):
+        self.set_geometry(*[buffer.array for buffer in buffers])
+        self.shared_geometry = tuple(buffer.description() for buffer in buffers)
+
+    # This static method returns the verts, faces, normals and vertex_normals buffers from the SharedBuffers with the given descriptions,
+    # attaching to them the first time they are used in this process.
+    @staticmethod
+    def attach_geometry(descriptions):
+        key = tuple(description[0] for description in descriptions)
+        buffers = _attached_geometry.get(key)
+        if buffers is None:
+            buffers = [SharedBuffer.attach(description) for description in descriptions]
+            for buffer in buffers:
+                buffer.array.flags.writeable = False
+            _attached_geometry[key] = buffers
+        return tuple(buffer.array for buffer in buffers)
+
+    # A memory-mapped mesh or one with shared geometry is pickled without its geometry buffers (for example when it is sent to a worker
+    # process), the receiving process maps the same geometry file again or attaches to the same shared memory instead.
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in Mesh.__slots__}
+        if self.geometry_path is not None or self.shared_geometry is not None:
+            for name in GEOMETRY_ARRAYS:
+                state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        if self.geometry_path is not None:
+            self.map_geometry_file(self.geometry_path)
+        elif self.shared_geometry is not None:
+            self.verts, self.faces, self.normals, self.vertex_normals = Mesh.attach_geometry(self.shared_geometry)
+
+    # This static method parses an stl file and returns its welded verts and faces together with the face and vertex normals.
+    @staticmethod
+    def build_geometry(stl_path, weld_epsilon=0.0, normal_weighting='uniform'):
+        # get mesh
+        meshInput = numpyMesh.Mesh.from_file(stl_path)
+
+        # merge the corners of all triangles into one vertex array and store the faces as indices into it
+        verts, faces = Mesh.weld_vertices(meshInput.vectors, weld_epsilon)
+
+        # calculate the normals for all of the triangles, then combine them into the normals for the vertices
+        normals = v.ThreeDVector.find_normals(verts, faces)
+        vertex_normals = v.ThreeDVector.vertex_normals(verts, faces, normals, normal_weighting)
+        return verts, faces, normals, vertex_normals
+
+    # This static method returns verts, faces, normals and vertex_normals as contiguous typed buffers (float32 for the vertex and normal
+    # data, int32 for the face indices). Arrays that already have the right layout are returned as they are, without a copy.
+    @staticmethod
+    def typed_geometry(verts, faces, normals, vertex_normals):
+        return (np.ascontiguousarray(verts, dtype=np.float32), np.ascontiguousarray(faces, dtype=np.int32),
+                np.ascontiguousarray(normals, dtype=np.float32), np.ascontiguousarray(vertex_normals, dtype=np.float32))
+
+    # This method stores verts, faces, normals and vertex_normals on the mesh as typed buffers (see typed_geometry), so the renderers
+    # can index and slice them directly without converting per element.
+    def set_geometry(self, verts, faces, normals, vertex_normals):
+        self.verts, self.faces, self.normals, self.vertex_normals = Mesh.typed_geometry(verts, faces, normals, vertex_normals)
+        self.local_bounds = None
+
+    # This method returns the bounds of the mesh in object space as a (box_min, box_max, centre, radius) tuple: the corners of the axis
+    # aligned box around the vertices, and the centre of that box with the radius of the sphere around it holding every vertex. They
+    # are computed on first use and kept until the geometry changes. It returns None for a mesh without vertices.
+    def bounds(self):
+        if self.local_bounds is None and len(self.verts) > 0:
+            verts = np.asarray(self.verts, dtype=np.float64)
+            box_min = verts.min(axis=0)
+            box_max = verts.max(axis=0)
+            centre = (box_min + box_max) / 2
+            radius = float(np.sqrt(np.square(verts - centre).sum(axis=1).max()))
+            self.local_bounds = (box_min, box_max, centre, radius)
+        return self.local_bounds
+
+    # This static method takes an (F, 3, 3) array of triangle corner positions (the vectors array of a numpy-stl mesh) and merges corners
+    # that share a position into a single vertex. It returns a contiguous (V, 3) array of vertices, in the order they are first encountered,
+    # and a contiguous (F, 3) array of faces holding indices into that vertex array.
+    # With epsilon greater than 0.0 the corners are snapped to a grid with that spacing before being compared, so nearly coincident corners
+    # are merged as well. The welded vertex keeps the position of the first corner that landed in its grid cell.
+    @staticmethod
+    def weld_vertices(triangles, epsilon=0.0):
+        corners = np.ascontiguousarray(triangles).reshape(-1, 3)
+        if epsilon > 0.0:
+            keys = np.floor(corners / epsilon + 0.5).astype(np.int64)
+        else:
+            keys = corners
+
+        # a single sorted unique pass over all corners replaces the per-vertex list searches
+        _, first_index, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+
+        # np.unique returns the vertices in sorted order, renumber them in order of first appearance
+        order = np.argsort(first_index)
+        renumber = np.empty_like(order)
+        renumber[order] = np.arange(len(order))
+
+        verts = np.ascontiguousarray(corners[first_index[order]])
+        faces = np.ascontiguousarray(renumber[inverse.reshape(-1)].reshape(-1, 3))
+        return verts, faces
@@ -0,0 +1,252 @@
+import numpy as np
+from color import ColorCalculation
+from vertex_processing import VertexProcessor
+
+
+class Fragments:
+    # The pixels of one triangle that passed the coverage and depth tests. Every member is a 1D numpy array with one entry per fragment:
+    # the pixel coordinates x and y, the screen space position of the pixel centre (screen_x, depth, screen_z) and the barycentric
+    # coordinates alpha, beta and gamma of that position in the triangle.
+    __slots__ = ('x', 'y', 'screen_x', 'screen_z', 'depth', 'alpha', 'beta', 'gamma')
+
+    def __init__(self, x, y, screen_x, screen_z, depth, alpha, beta, gamma):
+        self.x = x
+        self.y = y
+        self.screen_x = screen_x
+        self.screen_z = screen_z
+        self.depth = depth
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+
+    def __len__(self):
+        return len(self.x)
+
+
+class GBuffer:
+    # The geometry buffer used for deferred shading, indexed [x, y] like the image buffer. For every pixel it holds the interpolated
+    # (not yet normalized) world space normal and the id of the mesh of the visible fragment, -1 where nothing was drawn.
+    # The depth of the fragment is kept in the rasterizer's z_buffer, and its world space position is reconstructed from that depth.
+    __slots__ = ('normals', 'mesh_ids')
+
+    def __init__(self, width, height):
+        self.normals = np.zeros((width, height, 3))
+        self.mesh_ids = np.full((width, height), -1)
+
+
+class DepthPyramid:
+    # A coarse level kept on top of a z-buffer (a hierarchical z-buffer with one level above the pixels): blocks holds the largest depth in
+    # every block_size x block_size block of pixels, inf for blocks that still have uncovered pixels. The largest depth over a rectangle
+    # of pixels is then the largest of a few blocks, so a triangle or mesh whose nearest depth lies behind it, and that therefore cannot
+    # have a visible pixel there, is rejected with one small lookup instead of being rasterized.
+    # dtype is the dtype of the z-buffer, the blocks hold its depths as they are stored.
+    __slots__ = ('block_size', 'blocks')
+
+    def __init__(self, width, height, block_size=8, dtype=np.float64):
+        self.block_size = block_size
+        self.blocks = np.full((-(-width // block_size), -(-height // block_size)), np.inf, dtype=dtype)
+
+    # This method recomputes the blocks touching the rectangle of pixels from min_x to max_x and min_y to max_y (inclusive, in z_buffer
+    # coordinates) after depths in it were written to z_buffer.
+    def update(self, z_buffer, min_x, max_x, min_y, max_y):
+        size = self.block_size
+        first_x, last_x = min_x // size, max_x // size
+        first_y, last_y = min_y // size, max_y // size
+        region = z_buffer[first_x * size:(last_x + 1) * size, first_y * size:(last_y + 1) * size]
+        region = np.maximum.reduceat(region, np.arange(0, region.shape[0], size), axis=0)
+        self.blocks[first_x:last_x + 1, first_y:last_y + 1] = np.maximum.reduceat(region, np.arange(0, region.shape[1], size), axis=1)
+
+    # This method returns True if no pixel in the rectangle from min_x to max_x and min_y to max_y (inclusive, in z_buffer coordinates) can
+    # pass the depth test with a depth of at least nearest_depth. The small margin covers the rounding in the depths interpolated inside
+    # a triangle, which can land a hair in front of its nearest vertex. Like the depth test, the comparison is made at the precision of
+    # the z-buffer: a depth a little behind a stored one can round to the same value and still win the test.
+    def occluded(self, min_x, max_x, min_y, max_y, nearest_depth):
+        size = self.block_size
+        farthest = self.blocks[min_x // size:max_x // size + 1, min_y // size:max_y // size + 1].max()
+        return self.blocks.dtype.type(nearest_depth - 1e-9) > farthest
+
+
+class Rasterizer:
+    # The constructor takes the screen being rendered to and the image and depth buffers to rasterize into, indexed [x, y] like the screen.
+    # The buffers are used as they are, so they can be views into shared memory. If a GBuffer is given, phong-blinn fragments are only
+    # written to it during rasterization and shaded later by resolve, once per visible pixel.
+    # The buffers may also cover only a rectangle of the screen (a tile), with origin the pixel coordinates of its first pixel.
+    # Triangles are then clipped to that rectangle.
+    # With occlusion_culling set, a DepthPyramid is kept next to the z_buffer, and triangles and meshes that lie entirely behind what has
+    # been drawn are skipped without being rasterized. draw_mesh then draws faces nearest first, so that more of them are skipped. Which
+    # of two fragments at the same depth wins is decided by the order faces were submitted to draw_mesh, (mesh id, face index) order
+    # (recorded per pixel in order_buffer), not by the order they are drawn in, so the image is the same as without culling.
+    def __init__(self, screen, image_buffer, z_buffer, g_buffer=None, origin=(0, 0), occlusion_culling=False):
+        self.screen = screen
+        self.image_buffer = image_buffer
+        self.z_buffer = z_buffer
+        self.g_buffer = g_buffer
+        self.origin_x, self.origin_y = origin
+        self.end_x = self.origin_x + z_buffer.shape[0] - 1
+        self.end_y = self.origin_y + z_buffer.shape[1] - 1
+        self.pyramid = None
+        self.order_buffer = None
+        if occlusion_culling:
+            self.pyramid = DepthPyramid(z_buffer.shape[0], z_buffer.shape[1], dtype=z_buffer.dtype)
+            self.order_buffer = np.full(z_buffer.shape, -1, dtype=np.int64)
+
+    # This method takes the three screen space vertices of a triangle and the same vertices in pixel space and returns the Fragments
+    # covered by the triangle that are inside the near and far planes and not behind the depth already in the z_buffer, or None if there
+    # are none. The whole bounding box of the triangle (clamped to the buffers) is tested at once with numpy array operations.
+    # order is the submission order key of the triangle (see Rasterizer.order), used when occlusion culling is on.
+    def fragments(self, screen_vertices, pixel_vertices, order=None):
+        pixel_vertices = np.asarray(pixel_vertices)
+        min_x = max(self.origin_x, pixel_vertices[:, 0].min())
+        max_x = min(self.end_x, pixel_vertices[:, 0].max())
+        min_y = max(self.origin_y, pixel_vertices[:, 1].min())
+        max_y = min(self.end_y, pixel_vertices[:, 1].max())
+        if min_x > max_x or min_y > max_y:
+            return None
+        if self.pyramid is not None and self.pyramid.occluded(min_x - self.origin_x, max_x - self.origin_x, min_y - self.origin_y, max_y - self.origin_y,
+                                                              min(vertex[1] for vertex in screen_vertices)):
+            return None
+
+        # screen space position of every pixel centre in the bounding box
+        pix_x, pix_y = np.meshgrid(np.arange(min_x, max_x + 1), np.arange(min_y, max_y + 1), indexing='ij')
+        screen_x, screen_z = self.screen.pixels_to_screen(pix_x, pix_y)
+
+        # barycentric coordinates and interpolated depth of every pixel centre
+        a, b, c = screen_vertices
+        gamma = ((a[2] - b[2]) * screen_x + (b[0] - a[0]) * screen_z + (a[0] * b[2]) - (b[0] * a[2])) / ((a[2] - b[2]) * c[0] + (b[0] - a[0]) * c[2] + (a[0] * b[2]) - (b[0] * a[2]))
+        beta = ((a[2] - c[2]) * screen_x + (c[0] - a[0]) * screen_z + (a[0] * c[2]) - (c[0] * a[2])) / ((a[2] - c[2]) * b[0] + (c[0] - a[0]) * b[2] + (a[0] * c[2]) - (c[0] * a[2]))
+        alpha = 1 - beta - gamma
+        depth = alpha * a[1] + beta * b[1] + gamma * c[1]
+
+        # keep the pixels inside the triangle, between the near and far planes and in front of the z_buffer, the depth test compares
+        # depths at the precision the z_buffer stores them in
+        z_buffer = self.z_buffer[min_x - self.origin_x:max_x - self.origin_x + 1, min_y - self.origin_y:max_y - self.origin_y + 1]
+        stored_depth = depth.astype(z_buffer.dtype, copy=False)
+        if self.order_buffer is None:
+            mask = (depth <= 1) & (depth >= -1) & (stored_depth <= z_buffer)
+        else:
+            # at the same depth the fragment of the face submitted later wins, whatever order the faces are drawn in
+            order_buffer = self.order_buffer[min_x - self.origin_x:max_x - self.origin_x + 1, min_y - self.origin_y:max_y - self.origin_y + 1]
+            mask = (depth <= 1) & (depth >= -1) & ((stored_depth < z_buffer) | ((stored_depth == z_buffer) & (order > order_buffer)))
+        mask &= (alpha >= 0) & (alpha <= 1) & (beta >= 0) & (beta <= 1) & (gamma >= 0) & (gamma <= 1)
+        if not mask.any():
+            return None
+        return Fragments(pix_x[mask], pix_y[mask], screen_x[mask], screen_z[mask], depth[mask], alpha[mask], beta[mask], gamma[mask])
+
+    # This method writes the depth of the fragments to the z_buffer and colors (one color for all fragments, or one row per fragment)
+    # to the image_buffer, using masked assignment.
+    def write(self, fragments, colors, order=None):
+        self.write_depth(fragments, order)
+        self.image_buffer[fragments.x - self.origin_x, fragments.y - self.origin_y] = colors
+
+    # This method writes the depth of the fragments to the z_buffer, keeping the order_buffer and the DepthPyramid up to date when
+    # occlusion culling is on.
+    def write_depth(self, fragments, order=None):
+        x = fragments.x - self.origin_x
+        y = fragments.y - self.origin_y
+        self.z_buffer[x, y] = fragments.depth
+        if self.pyramid is not None:
+            self.order_buffer[x, y] = order
+            self.pyramid.update(self.z_buffer, x.min(), x.max(), y.min(), y.max())
+
+    # This static method returns the submission order key of a face, which orders faces by mesh id and then face index.
+    @staticmethod
+    def order(processed, face_index):
+        return (processed.mesh_id << 32) + int(face_index)
+
+    # This method returns True if occlusion culling is on and no face of the processed mesh can have a visible pixel: the nearest depth
+    # of its faces lies behind everything drawn so far over their pixel bounds (see ProcessedMesh.bounds).
+    def mesh_occluded(self, processed):
+        if self.pyramid is None:
+            return False
+        if processed.bounds is None:
+            return True
+        min_x, max_x, min_y, max_y, nearest_depth, _ = processed.bounds
+        min_x = max(self.origin_x, min_x)
+        max_x = min(self.end_x, max_x)
+        min_y = max(self.origin_y, min_y)
+        max_y = min(self.end_y, max_y)
+        if min_x > max_x or min_y > max_y:
+            return True
+        return self.pyramid.occluded(min_x - self.origin_x, max_x - self.origin_x, min_y - self.origin_y, max_y - self.origin_y, nearest_depth)
+
+    # This method draws the front facing faces of a processed mesh (see vertex_processing.ProcessedMesh) using draw_face, in order, or
+    # nearest first when occlusion culling is on (see VertexProcessor.front_to_back), unless the whole mesh is occluded.
+    def draw_mesh(self, processed, shading, camera, light, ambient_light, depth_range=None):
+        if self.pyramid is None:
+            face_indices = np.flatnonzero(processed.front_facing)
+        elif self.mesh_occluded(processed):
+            return
+        else:
+            face_indices = VertexProcessor.front_to_back(processed)
+        for face_index in face_indices:
+            self.draw_face(processed, face_index, shading, camera, light, ambient_light, depth_range)
+
+    # This method rasterizes one face of a processed mesh and shades its fragments. For flat and gouraud shading the processed mesh must
+    # already have been lit with VertexProcessor.shade.
+    # shading, light and ambient_light are the same as for the renderers, and depth_range is the (min_depth, max_depth) pair used by the depth shader.
+    # If the depth shader is given no depth_range, only the depth of the fragments is written, and resolve_depth colors them at the end.
+    def draw_face(self, processed, face_index, shading, camera, light, ambient_light, depth_range=None):
+        mesh = processed.mesh
+        face = processed.faces[face_index]
+
+        # find the pixels of the face that pass the coverage and depth tests, all at once
+        order = None if self.pyramid is None else Rasterizer.order(processed, face_index)
+        fragments = self.fragments(processed.screen_verts[face], processed.pixel_verts[face], order)
+        if fragments is None:
+            return
+
+        # calculate fragment colors -> one color per fragment
+        if shading == 'flat':
+            display_colors = processed.face_colors[face_index]
+        elif shading == 'barycentric':
+            display_colors = ColorCalculation.barycentric_array(fragments.alpha, fragments.beta, fragments.gamma)
+        elif shading == 'depth':
+            if depth_range is None:
+                self.write_depth(fragments, order)
+                return
+            display_colors = ColorCalculation.depth_array(depth_range[0], depth_range[1], fragments.depth)
+        elif shading == 'phong-blinn':
+            vertex_normal_1, vertex_normal_2, vertex_normal_3 = processed.vertex_normals[face]
+            interpolated_normals = vertex_normal_1 * fragments.alpha[:, None] + vertex_normal_2 * fragments.beta[:, None] + vertex_normal_3 * fragments.gamma[:, None]
+            if self.g_buffer is not None:
+                # deferred, only record what resolve needs to shade the fragment if it is still visible at the end
+                self.write_depth(fragments, order)
+                x = fragments.x - self.origin_x
+                y = fragments.y - self.origin_y
+                self.g_buffer.normals[x, y] = interpolated_normals
+                self.g_buffer.mesh_ids[x, y] = processed.mesh_id
+                return
+            interpolated_normals /= ColorCalculation.magnitudes(interpolated_normals)[:, None]
+            points_world = camera.inverse_project_points(np.stack((fragments.screen_x, fragments.depth, fragments.screen_z), axis=1))
+            camera_position = camera.transform.apply_to_point(np.array([0, 0, 0]))
+            display_colors = ColorCalculation.phong_array(points_world, interpolated_normals, mesh, light, ambient_light, camera_position)
+        elif shading == 'gouraud':
+            vertex_colors = processed.vertex_colors[face]
+            display_colors = np.trunc(np.multiply(vertex_colors[0], fragments.alpha[:, None]) + np.multiply(vertex_colors[1], fragments.beta[:, None]) + np.multiply(vertex_colors[2], fragments.gamma[:, None]))
+
+        self.write(fragments, display_colors, order)
+
+    # This method runs the deferred phong-blinn shading pass over the GBuffer: every pixel that ended up covered is shaded exactly once,
+    # in one vectorized call per mesh. processed_meshes is the list of processed meshes, indexed by the mesh ids written to the GBuffer.
+    def resolve(self, processed_meshes, camera, light, ambient_light):
+        camera_position = camera.transform.apply_to_point(np.array([0, 0, 0]))
+        for mesh_id, processed in enumerate(processed_meshes):
+            x, y = np.nonzero(self.g_buffer.mesh_ids == mesh_id)
+            if len(x) == 0:
+                continue
+            normals = self.g_buffer.normals[x, y]
+            normals /= ColorCalculation.magnitudes(normals)[:, None]
+            screen_x, screen_z = self.screen.pixels_to_screen(x + self.origin_x, y + self.origin_y)
+            points_world = camera.inverse_project_points(np.stack((screen_x, self.z_buffer[x, y], screen_z), axis=1))
+            self.image_buffer[x, y] = ColorCalculation.phong_array(points_world, normals, processed.mesh, light, ambient_light, camera_position)
+
+    # This method runs the depth shader over the z_buffer after faces were drawn without a depth range: every pixel that ended up covered
+    # is colored by its depth. depth_range is the (min_depth, max_depth) pair to use, by default the range of the depths in the z_buffer,
+    # which stretches the visible depths over the whole range from black to white. It returns the range used.
+    def resolve_depth(self, depth_range=None):
+        covered = np.isfinite(self.z_buffer)
+        depths = self.z_buffer[covered]
+        if depth_range is None:
+            depth_range = (float(depths.min()), float(depths.max())) if len(depths) > 0 else (np.inf, -np.inf)
+        self.image_buffer[covered] = ColorCalculation.depth_array(depth_range[0], depth_range[1], depths)
+        return depth_range
@@ -1,3 +1,4 @@
+import numpy as np
 
 
 class Ray:
@@ -37,3 +38,51 @@ class Ray:
                     if beta + gamma < 1:
                         return True, t
         return False, t
+
+    # This method is the batched version of collide for one ray against many triangles: vert_a, vert_b and vert_c are (N, 3) arrays
+    # holding the corners of N triangles. It returns the hit mask, t, beta and gamma of every triangle (see intersect).
+    def collide_triangles(self, vert_a, vert_b, vert_c):
+        return Ray.intersect(np.asarray(self.e), np.asarray(self.d), vert_a, vert_b, vert_c)
+
+    # This static method is the batched version of collide for many rays against one triangle: origins and directions are (N, 3) arrays
+    # holding N rays and vert_a, vert_b and vert_c the corners of the triangle. It returns the hit mask, t, beta and gamma of every ray
+    # (see intersect).
+    @staticmethod
+    def collide_rays(origins, directions, vert_a, vert_b, vert_c):
+        return Ray.intersect(origins, directions, np.asarray(vert_a), np.asarray(vert_b), np.asarray(vert_c))
+
+    # This static method intersects rays with triangles with numpy array operations, using the same Cramer's rule arithmetic as collide
+    # (in the same order, so the results are identical). The ray origins and directions and the triangle corners are arrays whose last
+    # axis holds x, y and z, and the rest of their shapes broadcast against each other. It returns four arrays of the broadcast shape:
+    # the hit mask (True where collide would return True) and t, beta and gamma (only meaningful where the mask is set).
+    @staticmethod
+    def intersect(origins, directions, vert_a, vert_b, vert_c):
+        return Ray.intersect_edges(origins, directions, vert_a, vert_a - vert_b, vert_a - vert_c)
+
+    # This static method is intersect for triangles given by their first corner vert_a and the edge vectors edge_b (vert_a - vert_b) and
+    # edge_c (vert_a - vert_c), which can be computed once per triangle ahead of time (see WorldTriangles).
+    @staticmethod
+    def intersect_edges(origins, directions, vert_a, edge_b, edge_c):
+        a = edge_b[..., 0]
+        b = edge_b[..., 1]
+        c = edge_b[..., 2]
+
+        d = edge_c[..., 0]
+        e = edge_c[..., 1]
+        f = edge_c[..., 2]
+
+        g = directions[..., 0]
+        h = directions[..., 1]
+        i = directions[..., 2]
+
+        j = vert_a[..., 0] - origins[..., 0]
+        k = vert_a[..., 1] - origins[..., 1]
+        l = vert_a[..., 2] - origins[..., 2]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            M = a * (e*i - h*f) + b * (g*f - d*i) + c * (d*h - e*g)
+            t = -(f * (a*k - j*b) + e * (j*c - a*l) + d * (b*l - k*c)) / M
+            gamma = (i * (a*k - j*b) + h * (j*c - a*l) + g * (b*l - k*c)) / M
+            beta = (j * (e*i - h*f) + k * (g*f - d*i) + l * (d*h - e*g)) / M
+            hit = (M != 0) & (t > 0) & (gamma > 0) & (beta > 0) & (beta + gamma < 1)
+        return hit, t, beta, gamma
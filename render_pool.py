@@ -0,0 +1,268 @@
+import atexit
+import os
+import pickle
+import time
+import multiprocessing
+import queue
+from multiprocessing import resource_tracker
+import traceback
+from shared_buffer import SharedBuffer
+
+
+class WorkerState:
+    # What a worker process keeps between tasks: its index in the pool, the id and contents of the frame it is working on (see
+    # RenderPool.run), the frames it has received but not worked on yet, pickled and keyed on their id, the frame buffers it has
+    # attached, keyed on their description, and caches, a dictionary task functions can use to keep their own state from one task (and frame) to the next.
+    __slots__ = ('worker_id', 'frame_id', 'frame', 'frames', 'buffers', 'caches')
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.frame_id = None
+        self.frame = None
+        self.frames = {}
+        self.buffers = {}
+        self.caches = {}
+
+    # This method takes the frames waiting in frame_queue and keeps them in frames. With block set it waits for one frame if none is
+    # waiting.
+    def receive(self, frame_queue, block):
+        try:
+            frame_id, frame = frame_queue.get(block)
+            self.frames[frame_id] = frame
+            while True:
+                frame_id, frame = frame_queue.get_nowait()
+                self.frames[frame_id] = frame
+        except queue.Empty:
+            pass
+
+    # This method makes the frame with the given id the current one, waiting for it to arrive on frame_queue if needed. Tasks are taken
+    # in the order they were submitted, so the frames before it will not be worked on by this worker any more and are dropped.
+    def select(self, frame_id, frame_queue):
+        while frame_id not in self.frames:
+            self.receive(frame_queue, True)
+        for old_frame_id in [old_frame_id for old_frame_id in self.frames if old_frame_id < frame_id]:
+            del self.frames[old_frame_id]
+        self.frame_id = frame_id
+        self.frame = pickle.loads(self.frames.pop(frame_id))
+
+    # This method returns the array of the SharedBuffer with the given description, attaching to it on first use. Buffers are reused
+    # across frames by the pool, so a worker normally attaches to each of them once.
+    def buffer(self, description):
+        buffer = self.buffers.get(description)
+        if buffer is None:
+            buffer = SharedBuffer.attach(description)
+            self.buffers[description] = buffer
+        return buffer.array
+
+
+# The main loop of a worker process. Tasks are (frame id, task index, function, args) tuples taken from the task queue shared by all the
+# workers. Before running a task the worker takes frames from its own frame queue until it holds the one the task belongs to, then calls
+# function(state, args) and puts (frame id, task index, worker id, seconds spent, result, error) on the result queue. A None task stops
+# the worker.
+# Every frame is sent to every worker, including the ones that get no task of it, so a worker waiting for tasks keeps taking the frames
+# sent to it. Frames left unread would fill the pipe of the frame queue and pile up in the pool's process.
+def worker_loop(worker_id, frames, tasks, results):
+    state = WorkerState(worker_id)
+    while True:
+        try:
+            task = tasks.get(timeout=TASK_POLL_SECONDS)
+        except queue.Empty:
+            state.receive(frames, False)
+            continue
+        if task is None:
+            break
+        frame_id, index, function, args = task
+        if state.frame_id != frame_id:
+            state.select(frame_id, frames)
+        start_time = time.perf_counter()
+        try:
+            result = function(state, args)
+            error = None
+        except Exception:
+            result = None
+            error = traceback.format_exc()
+        results.put((frame_id, index, worker_id, time.perf_counter() - start_time, result, error))
+
+    for buffer in state.buffers.values():
+        buffer.close()
+
+
+# How long a waiting worker blocks on the task queue before taking the frames sent to it, and how long wait blocks on the result queue
+# before checking that the workers are still running
+TASK_POLL_SECONDS = 0.1
+RESULT_POLL_SECONDS = 1.0
+
+
+class RenderPool:
+    # A pool of worker processes that live as long as the pool, shared by every frame (and renderer) that uses it.
+    # processes is the number of workers, None starts one per CPU.
+    # Meshes passed to share_geometry have their geometry copied into shared memory once, after which sending them to the workers only
+    # sends their transform and material. Frame buffers (see frame_buffer) are allocated in shared memory once and reused for later
+    # frames of the same size. Work is sent to the workers over a queue with run. Idle workers take the next task as soon as they finish
+    # one, so a frame split into many small tasks keeps every worker busy until the end, however uneven the tasks are.
+    def __init__(self, processes=None):
+        self.size = processes or os.cpu_count()
+        # the workers must share this process's resource tracker, one started by a worker would unlink the shared memory it attached
+        # to when the worker exits
+        resource_tracker.ensure_running()
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.frame_queues = []
+        self.workers = []
+        for worker_id in range(self.size):
+            frame_queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=worker_loop, args=(worker_id, frame_queue, self.tasks, self.results), daemon=True)
+            worker.start()
+            self.frame_queues.append(frame_queue)
+            self.workers.append(worker)
+        self.frame_id = 0
+        # SharedBuffers holding geometry, keyed on the id of the verts array they were copied from, with the original arrays kept
+        # alongside so that id stays valid, and the meshes that were moved onto them
+        self.geometry = {}
+        self.shared_meshes = []
+        # SharedBuffers used as frame buffers, keyed on the name given to frame_buffer, and the key of the array last copied into each
+        # of them by share_array
+        self.buffers = {}
+        self.buffer_keys = {}
+        # (tasks run, seconds spent running them) of every worker during the last run
+        self.load = [(0, 0.0)] * self.size
+        # the frames submitted but not waited for yet, keyed on their frame id (see submit)
+        self.pending = {}
+        # the workers are stopped before multiprocessing's own exit handler would terminate them (see close)
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    # This method moves the geometry buffers of meshes into shared memory (see Mesh.set_shared_geometry). Meshes sharing the same buffers
+    # share the same blocks, and meshes that were already moved or are memory-mapped from a geometry file are left as they are, so it
+    # is cheap to call before every frame.
+    def share_geometry(self, meshes):
+        for mesh in meshes:
+            if mesh.geometry_path is not None or mesh.shared_geometry is not None:
+                continue
+            entry = self.geometry.get(id(mesh.verts))
+            if entry is None:
+                original = (mesh.verts, mesh.faces, mesh.normals, mesh.vertex_normals)
+                entry = (original, [SharedBuffer.from_array(array) for array in original])
+                self.geometry[id(mesh.verts)] = entry
+            self.shared_meshes.append((mesh, entry[0]))
+            mesh.set_shared_geometry(entry[1])
+
+    # This method returns a SharedBuffer of the given shape and dtype to be used as the frame buffer called name. The buffer from the
+    # previous call with the same name is returned again as long as its shape and dtype match, its contents are left as they are.
+    # Otherwise that buffer is freed, arrays of it must not be used any more.
+    def frame_buffer(self, name, shape, dtype):
+        buffer = self.buffers.get(name)
+        if buffer is not None and buffer.matches(shape, dtype):
+            return buffer
+        if buffer is not None:
+            buffer.close()
+            buffer.unlink()
+        buffer = SharedBuffer(shape, dtype)
+        self.buffers[name] = buffer
+        self.buffer_keys.pop(name, None)
+        return buffer
+
+    # This method copies array into the frame buffer called name and returns the description of the buffer. key stands for the contents
+    # of array (for example the version of what it was computed from): if the buffer still holds the array last copied with the same
+    # key the copy is skipped, so it is cheap to call before every frame. Buffers filled this way must not be written to otherwise.
+    def share_array(self, name, array, key):
+        buffer = self.frame_buffer(name, array.shape, array.dtype)
+        if self.buffer_keys.get(name) != key:
+            buffer.array[:] = array
+            self.buffer_keys[name] = key
+        return buffer.description()
+
+    # This method runs function(state, args) in the workers for every args in tasks and returns the results in the order of tasks.
+    # frame is sent to every worker once and is available to function as state.frame (see WorkerState). It should hold everything the
+    # tasks of this frame have in common, so that the tasks themselves stay small. function must be a module level function.
+    # An exception raised by a task is raised here as a RuntimeError carrying the worker's traceback. The work done by every worker is
+    # recorded in load (see load_report).
+    def run(self, frame, function, tasks):
+        return self.wait(self.submit(frame, function, tasks))
+
+    # This method is the first half of run: it hands the frame and its tasks to the workers and returns the frame id without waiting for
+    # them, so the caller can prepare the next frame in the meantime. Frames are worked on in the order they are submitted. wait must be
+    # called with the id to get the results.
+    # The frame is pickled here, once for all the workers. A queue only pickles what is put on it later, in a thread of its own, so the
+    # caller could already be changing the objects of the next frame (see AnimationRenderer.render) while this one is being sent.
+    def submit(self, frame, function, tasks):
+        self.frame_id += 1
+        frame = pickle.dumps(frame, pickle.HIGHEST_PROTOCOL)
+        for frame_queue in self.frame_queues:
+            frame_queue.put((self.frame_id, frame))
+        for index, args in enumerate(tasks):
+            self.tasks.put((self.frame_id, index, function, args))
+        # results, load, tasks remaining and first error of the frame
+        self.pending[self.frame_id] = [[None] * len(tasks), [[0, 0.0] for _ in range(self.size)], len(tasks), None]
+        return self.frame_id
+
+    # This method is the second half of run: it waits for the tasks of the submitted frame with the given id and returns their results.
+    # Results of other frames that arrive in the meantime are kept for their own wait. A RuntimeError is raised if a worker process
+    # exits while the frame is being worked on, its tasks would never finish.
+    def wait(self, frame_id):
+        entry = self.pending[frame_id]
+        while entry[2] > 0:
+            try:
+                result_frame_id, index, worker_id, seconds, result, task_error = self.results.get(timeout=RESULT_POLL_SECONDS)
+            except queue.Empty:
+                for worker_id, worker in enumerate(self.workers):
+                    if not worker.is_alive():
+                        del self.pending[frame_id]
+                        raise RuntimeError("worker process " + str(worker_id) + " exited with code " + str(worker.exitcode))
+                continue
+            result_entry = self.pending.get(result_frame_id)
+            if result_entry is None:
+                continue
+            result_entry[0][index] = result
+            result_entry[1][worker_id][0] += 1
+            result_entry[1][worker_id][1] += seconds
+            result_entry[2] -= 1
+            if task_error is not None and result_entry[3] is None:
+                result_entry[3] = task_error
+        del self.pending[frame_id]
+        results, load, _, error = entry
+        self.load = [tuple(worker_load) for worker_load in load]
+        if error is not None:
+            raise RuntimeError("render task failed in a worker process:\n" + error)
+        return results
+
+    # This method returns a printable summary of load, one line per worker with the number of tasks it ran in the last run and the time
+    # it spent on them.
+    def load_report(self):
+        return '\n'.join('worker ' + str(worker_id) + ': ' + str(tasks) + ' tasks, ' + str(round(seconds, 3)) + 's'
+                         for worker_id, (tasks, seconds) in enumerate(self.load))
+
+    # This method stops the workers and frees the shared memory of the pool. Meshes moved to shared memory by share_geometry get their
+    # original geometry buffers back. The workers are asked to exit rather than terminated, pygame catches SIGTERM in processes that
+    # import it. Calling close more than once does nothing.
+    def close(self):
+        if not self.workers:
+            return
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        # frames no worker read any more are dropped, otherwise the threads feeding the queues would wait for a reader at exit
+        for frame_queue in self.frame_queues:
+            frame_queue.cancel_join_thread()
+            frame_queue.close()
+        self.frame_queues = []
+        atexit.unregister(self.close)
+
+        for mesh, original in self.shared_meshes:
+            mesh.set_geometry(*original)
+            mesh.shared_geometry = None
+        self.shared_meshes = []
+        for buffers in [entry[1] for entry in self.geometry.values()] + [[buffer] for buffer in self.buffers.values()]:
+            for buffer in buffers:
+                buffer.close()
+                buffer.unlink()
+        self.geometry = {}
+        self.buffers = {}
+        self.buffer_keys = {}
@@ -1,20 +1,57 @@
 import numpy as np
-import color
+from framebuffer import Framebuffer
 from threeDVector import ThreeDVector
-from ray import Ray
-import multiprocessing
-from multiprocessing import shared_memory
+from bvh import SceneBVH, OccluderCache
+from render_pool import RenderPool
+from renderer_ray_traced_sequential import shade_hits
 import time
 
 
+class RayFrame:
+    # Everything a worker needs to trace its tiles of one frame: the screen, camera, meshes and light, the SceneBVH over the meshes,
+    # the normalized light position shadow rays are traced along, the shading parameters passed to render and the descriptions of the
+    # shared buffers holding the primary rays (see Camera.primary_rays) and the depth and color planes of the Framebuffer (see
+    # SharedBuffer). It is sent to every worker once per frame.
+    __slots__ = ('screen', 'camera', 'meshes', 'scene', 'light', 'light_direction', 'shading', 'ambient_light', 'ray_origins',
+                 'ray_directions', 'z_buffer', 'image_buffer')
+
+    def __init__(self, screen, camera, meshes, scene, light, light_direction, shading, ambient_light, ray_origins, ray_directions, z_buffer,
+                 image_buffer):
+        self.screen = screen
+        self.camera = camera
+        self.meshes = meshes
+        self.scene = scene
+        self.light = light
+        self.light_direction = light_direction
+        self.shading = shading
+        self.ambient_light = ambient_light
+        self.ray_origins = ray_origins
+        self.ray_directions = ray_directions
+        self.z_buffer = z_buffer
+        self.image_buffer = image_buffer
+
+
 class Renderer:
     # The class constructor takes a screen object (of type Screen), camera object (either of type OrthoCamera or PerspectiveCamera),
     # a list of mesh objects (of type Mesh), and a light source (of type PointLight) and stores them.
-    def __init__(self, screen, camera, meshes, light):
+    # The worker processes are started on the first render and kept for later ones until close is called. processes is the number of
+    # workers (None uses one per CPU), or a RenderPool can be passed as pool to share its workers with other renderers.
+    # The screen is traced in square tiles of tile_size pixels, handed out to the workers one at a time as they become free.
+    def __init__(self, screen, camera, meshes, light, processes=None, pool=None, tile_size=16):
         self.screen = screen
         self.camera = camera
         self.meshes = meshes
         self.light = light
+        self.processes = processes
+        self.tile_size = tile_size
+        self.pool = pool
+        self.owns_pool = pool is None
+
+    # This method stops the worker processes started by this renderer.
+    def close(self):
+        if self.owns_pool and self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     # This method will take three input arguments.
     # shading is a string parameter indicating which type of shading to apply, and barycentric should be implemented.
@@ -23,127 +60,74 @@ class Renderer:
     # render will execute the basic render loop and compute shading at each pixel fragment to update an image buffer.
     # It will then draw that image buffer to the screen object using the screen.draw method, but it will not run the pygame loop (the calling function will call screen.show)
     def render(self, shading, bg_color, ambient_light):
-        image_buffer = np.full((self.screen.width, self.screen.height, 3), bg_color)
-        z_buffer = np.full((self.screen.width, self.screen.height), np.inf)
         # check camera and image buffer ratios
         if self.camera.ratio() != self.screen.ratio():
             exit(1)
 
-        shared_z_buffer = shared_memory.SharedMemory(name='z_buffer', create=True, size=z_buffer.nbytes)
-        shared_image_buffer = shared_memory.SharedMemory(name='image_buffer', create=True, size=image_buffer.nbytes)
-
-        z_buf_shape = z_buffer.shape
-        z_buf_type = z_buffer.dtype
-        im_buf_shape = image_buffer.shape
-        im_buf_type = image_buffer.dtype
-
-        z_buffer_shared = np.ndarray(z_buf_shape, dtype=z_buf_type, buffer=shared_z_buffer.buf)
-        z_buffer_shared[:] = z_buffer[:]
-        image_buffer_shared = np.ndarray(im_buf_shape, dtype=im_buf_type, buffer=shared_image_buffer.buf)
-        image_buffer_shared[:] = image_buffer[:]
-
-        processes = []
-        for pix_y in range(0, self.screen.height, 18):
-            process = multiprocessing.Process(target=self.pixel_loop, args=(pix_y, pix_y+18, shading, ambient_light, z_buf_shape, z_buf_type, im_buf_shape, im_buf_type))
-            processes.append(process)
+        if self.pool is None:
+            self.pool = RenderPool(self.processes)
+        # only copies geometry the pool has not seen yet
+        self.pool.share_geometry(self.meshes)
+
+        shared_image_buffer = self.pool.frame_buffer('image_buffer', (self.screen.height, self.screen.width, 3), np.uint8)
+        shared_z_buffer = self.pool.frame_buffer('z_buffer', (self.screen.height, self.screen.width), np.float32)
+        framebuffer = Framebuffer(self.screen.width, self.screen.height, shared_image_buffer.array, shared_z_buffer.array, shared=True)
+        framebuffer.clear(bg_color)
+        # the camera only rebuilds its ray table after it has moved or the screen size has changed, and the pool only copies a table
+        # it does not hold yet (transform versions are never reused, so the key tells cameras apart as well)
+        ray_origins, ray_directions = self.camera.primary_rays(self.screen)
+        ray_buffers = [self.pool.share_array('ray_origins', ray_origins, self.camera.ray_table_key),
+                       self.pool.share_array('ray_directions', ray_directions, self.camera.ray_table_key)]
+
+        # the bottom-level trees of the meshes are only built the first time their geometry is seen, the world space triangles are
+        # computed once here and read by every worker from shared memory
+        scene = SceneBVH.build(self.meshes)
+        scene.triangles.share(self.pool)
+        light_direction = ThreeDVector.normalize(self.light.transform.apply_to_point(np.array([0, 0, 0])))
+        frame = RayFrame(self.screen, self.camera, self.meshes, scene, self.light, light_direction, shading, ambient_light, ray_buffers[0], ray_buffers[1],
+                         shared_z_buffer.description(), shared_image_buffer.description())
+        tiles = [(pix_x, pix_y, min(pix_x + self.tile_size, self.screen.width), min(pix_y + self.tile_size, self.screen.height))
+                 for pix_y in range(0, self.screen.height, self.tile_size) for pix_x in range(0, self.screen.width, self.tile_size)]
 
         start_time = time.time()
-        for p in processes:
-            p.start()
-
-        for p in processes:
-            p.join()
+        self.pool.run(frame, pixel_loop, tiles)
 
         end_time = time.time()
-        self.screen.draw(image_buffer_shared)
+        self.screen.draw(framebuffer)
         print(end_time - start_time)
-
-        shared_z_buffer.close()
-        shared_z_buffer.unlink()
-        shared_image_buffer.close()
-        shared_image_buffer.unlink()
-
-    def pixel_loop(self, start_range, end_range, shading, ambient_light, z_buf_shape, z_buf_type, im_buf_shape, im_buf_type):
-        existing_z_buffer = shared_memory.SharedMemory(name='z_buffer')
-        existing_image_buffer = shared_memory.SharedMemory(name='image_buffer')
-        z_buffer = np.ndarray(z_buf_shape, dtype=z_buf_type, buffer=existing_z_buffer.buf)
-        image_buffer = np.ndarray(im_buf_shape, dtype=im_buf_type, buffer=existing_image_buffer.buf)
-        for pix_y in range(start_range, end_range):
-            for pix_x in range(0, self.screen.width):
-                # create ray
-                point_screen = self.screen.pixel_to_screen(pix_x, pix_y)
-                point_screen[1] = -1
-                point_world = self.camera.inverse_project_point(point_screen)
-                direction = np.array([0, 1, 0])
-                ray = Ray(point_world, None, direction)
-
-                # for every triangle see if ray collides, if so color pixel
-                for mesh in self.meshes:
-                    for face in mesh.faces:
-                        # convert vertices to world
-                        world_vertices = []
-                        for vertIndex in face:
-                            world_vertices.append(mesh.transform.apply_to_point(mesh.verts[vertIndex]))
-
-                        collides, t = ray.collide(world_vertices[0], world_vertices[1], world_vertices[2])
-                        if collides:
-                            if t > z_buffer[pix_x, pix_y]:
-                                continue
-                            z_buffer[pix_x, pix_y] = t
-
-                            # calculate shadow, first get origin for new shadow ray
-                            p = np.add(ray.e, np.multiply(ray.d, t))
-                            # get normalized light vector
-                            light_position = ThreeDVector.normalize(self.light.transform.apply_to_point(np.array([0, 0, 0])))
-                            # move origin a small amount along light ray
-                            shadow_origin = np.add(p, np.multiply(light_position, 0.01))
-                            # create shadow ray
-                            shadow_ray = Ray(shadow_origin, None, light_position)
-                            # do shadow collision
-                            shadow_collided = False
-                            for shadow_mesh in self.meshes:
-                                if self.meshes.index(mesh) == self.meshes.index(shadow_mesh):
-                                    continue
-                                for shadow_face in shadow_mesh.faces:
-                                    # convert vertices to world
-                                    shadow_world_vertices = []
-                                    for shadow_vertIndex in shadow_face:
-                                        shadow_world_vertices.append(shadow_mesh.transform.apply_to_point(shadow_mesh.verts[shadow_vertIndex]))
-
-                                    shadow_collides, shadow_t = shadow_ray.collide(shadow_world_vertices[0], shadow_world_vertices[1], shadow_world_vertices[2])
-                                    if shadow_collides:
-                                        shadow_collided = True
-
-                            if not shadow_collided:
-                                if shading == 'flat':
-                                    temp_face_normal = mesh.normals[mesh.faces.index(face)]
-                                    face_normal = mesh.transform.apply_to_normal(temp_face_normal)
-                                    final_color = color.ColorCalculation.flat(world_vertices, face_normal, mesh, self.light, ambient_light)
-                                    display_color = color.ColorCalculation.calcFinalRGB(final_color)
-                                if shading == 'phong-blinn':
-                                    screen_vertices = []
-                                    for vert in world_vertices:
-                                        screen_vertices.append(self.camera.project_point(vert))
-                                    a = screen_vertices[0]
-                                    b = screen_vertices[1]
-                                    c = screen_vertices[2]
-
-                                    screen_x, screen_y, screen_z = self.screen.pixel_to_screen(pix_x, pix_y)
-                                    gamma = ((a[2] - b[2]) * screen_x + (b[0] - a[0]) * screen_z + (a[0] * b[2]) - (b[0] * a[2])) / ((a[2] - b[2]) * c[0] + (b[0] - a[0]) * c[2] + (a[0] * b[2]) - (b[0] * a[2]))
-                                    beta = ((a[2] - c[2]) * screen_x + (c[0] - a[0]) * screen_z + (a[0] * c[2]) - (c[0] * a[2])) / ((a[2] - c[2]) * b[0] + (c[0] - a[0]) * b[2] + (a[0] * c[2]) - (c[0] * a[2]))
-                                    alpha = 1 - beta - gamma
-                                    screen_y = alpha * a[1] + beta * b[1] + gamma * c[1]
-
-                                    vertex_normal_1 = mesh.transform.apply_to_normal(mesh.vertex_normals[face[0]])
-                                    vertex_normal_2 = mesh.transform.apply_to_normal(mesh.vertex_normals[face[1]])
-                                    vertex_normal_3 = mesh.transform.apply_to_normal(mesh.vertex_normals[face[2]])
-                                    interpolated_normal_temp = np.add(np.add(np.multiply(vertex_normal_1, alpha), np.multiply(vertex_normal_2, beta)), np.multiply(vertex_normal_3, gamma))
-                                    interpolated_normal = np.divide(interpolated_normal_temp, color.ColorCalculation.magnitude(interpolated_normal_temp))
-                                    point_world = self.camera.inverse_project_point((screen_x, screen_y, screen_z))
-                                    display_color = color.ColorCalculation.phong(point_world, interpolated_normal, mesh, self.light, ambient_light, self.camera.transform.apply_to_point(np.array([0, 0, 0])))
-                            else:
-                                display_color = color.ColorCalculation.calcFinalRGB(np.multiply(ambient_light, mesh.ka))
-
-                            image_buffer[pix_x, pix_y] = display_color
-        existing_z_buffer.close()
-        existing_image_buffer.close()
+        print(self.pool.load_report())
+
+
+# This function traces one tile of the frame (a RayFrame) in a worker process of a RenderPool, writing to the shared z and image buffers.
+# tile is a (start_x, start_y, end_x, end_y) tuple of pixel coordinates, the end coordinates are exclusive. The triangles that shadowed
+# the last tile a worker traced are kept in its caches (see OccluderCache) and tried first for the next one.
+def pixel_loop(worker, tile):
+    start_x, start_y, end_x, end_y = tile
+    frame = worker.frame
+    z_buffer = Framebuffer.depth_view(worker.buffer(frame.z_buffer))
+    image_buffer = Framebuffer.pixel_view(worker.buffer(frame.image_buffer))
+    scene = frame.scene
+    triangles = scene.triangles
+    # take the rays of every pixel in the tile from the ray table, row by row
+    origins = worker.buffer(frame.ray_origins)[start_x:end_x, start_y:end_y].transpose(1, 0, 2).reshape(-1, 3)
+    directions = worker.buffer(frame.ray_directions)[start_x:end_x, start_y:end_y].transpose(1, 0, 2).reshape(-1, 3)
+
+    # find the closest triangle hit by every ray at once (see SceneBVH.closest_hits), the pixels of the rays that hit nothing keep the background
+    distances, mesh_indices, face_indices = scene.closest_hits(origins, directions)
+    hits = np.flatnonzero(mesh_indices >= 0)
+
+    # calculate shadows, first get the origins of the shadow rays: the hit points moved a small amount along the normalized light vector
+    light_position = frame.light_direction
+    points = np.add(origins[hits], np.multiply(directions[hits], distances[hits, None]))
+    shadow_origins = np.add(points, np.multiply(light_position, 0.01))
+    # a shadow ray is blocked by any mesh except the one that was hit, it stops at the first triangle found (see SceneBVH.occluded)
+    occluders = worker.caches.setdefault('occluders', OccluderCache())
+    shadowed = scene.occluded(shadow_origins, np.tile(light_position, (len(hits), 1)), skip=mesh_indices[hits], occluders=occluders)
+
+    # the rays were taken row by row, so the pixel of ray i is (start_x + i % width, start_y + i // width)
+    hit_y, hit_x = np.divmod(hits, end_x - start_x)
+    hit_x += start_x
+    hit_y += start_y
+    z_buffer[hit_x, hit_y] = distances[hits]
+    image_buffer[hit_x, hit_y] = shade_hits(triangles, frame.meshes, frame.camera, frame.screen, frame.light, frame.shading, frame.ambient_light,
+                                            hit_x, hit_y, mesh_indices[hits], face_indices[hits], shadowed)
@@ -1,7 +1,8 @@
 import numpy as np
 import color
+from framebuffer import Framebuffer
 from threeDVector import ThreeDVector
-from ray import Ray
+from bvh import SceneBVH, OccluderCache
 import time
 
 
@@ -21,92 +22,83 @@ class Renderer:
     # render will execute the basic render loop and compute shading at each pixel fragment to update an image buffer.
     # It will then draw that image buffer to the screen object using the screen.draw method, but it will not run the pygame loop (the calling function will call screen.show)
     def render(self, shading, bg_color, ambient_light):
-        image_buffer = np.full((self.screen.width, self.screen.height, 3), bg_color)
-        z_buffer = np.full((self.screen.width, self.screen.height), np.inf)
+        framebuffer = Framebuffer(self.screen.width, self.screen.height)
+        framebuffer.clear(bg_color)
+        image_buffer = framebuffer.pixels()
+        z_buffer = framebuffer.z_buffer()
         # check camera and image buffer ratios
         if self.camera.ratio() != self.screen.ratio():
             exit(1)
 
         start_time = time.time()
+        # the world space triangles of every mesh are computed once per frame (see WorldTriangles)
+        scene = SceneBVH.build(self.meshes)
+        triangles = scene.triangles
+        # the shadow rays are traced along the normalized light position, the triangles that shadowed a row are tried first for the next
+        light_position = ThreeDVector.normalize(self.light.transform.apply_to_point(np.array([0, 0, 0])))
+        occluders = OccluderCache()
+        # the primary rays of every pixel, only rebuilt by the camera after it has moved or the screen size has changed
+        ray_origins, ray_directions = self.camera.primary_rays(self.screen)
         for pix_y in range(0, self.screen.height):
             print(f'y: {pix_y}')
-            for pix_x in range(0, self.screen.width):
-                # create ray
-                point_screen = self.screen.pixel_to_screen(pix_x, pix_y)
-                point_screen[1] = -1
-                point_world = self.camera.inverse_project_point(point_screen)
-                direction = np.array([0, 1, 0])
-                ray = Ray(point_world, None, direction)
+            # take the rays of every pixel in the row from the ray table
+            origins = ray_origins[:, pix_y]
+            directions = ray_directions[:, pix_y]
 
-                # for every triangle see if ray collides, if so color pixel
-                for mesh in self.meshes:
-                    for face in mesh.faces:
-                        # convert vertices to world
-                        world_vertices = []
-                        for vertIndex in face:
-                            world_vertices.append(mesh.transform.apply_to_point(mesh.verts[vertIndex]))
+            # find the closest triangle hit by every ray at once (see SceneBVH.closest_hits), the pixels of the rays that hit nothing keep the background
+            distances, mesh_indices, face_indices = scene.closest_hits(origins, directions)
+            hits = np.flatnonzero(mesh_indices >= 0)
 
-                        collides, t = ray.collide(world_vertices[0], world_vertices[1], world_vertices[2])
-                        if collides:
-                            if t > z_buffer[pix_x, pix_y]:
-                                continue
-                            z_buffer[pix_x, pix_y] = t
+            # calculate shadows, first get the origins of the shadow rays: the hit points moved a small amount along the normalized light vector
+            points = np.add(origins[hits], np.multiply(directions[hits], distances[hits, None]))
+            shadow_origins = np.add(points, np.multiply(light_position, 0.01))
+            # a shadow ray is blocked by any mesh except the one that was hit, it stops at the first triangle found (see SceneBVH.occluded)
+            shadowed = scene.occluded(shadow_origins, np.tile(light_position, (len(hits), 1)), skip=mesh_indices[hits], occluders=occluders)
 
-                            # calculate shadow, first get origin for new shadow ray
-                            p = np.add(ray.e, np.multiply(ray.d, t))
-                            # get normalized light vector
-                            light_position = ThreeDVector.normalize(self.light.transform.apply_to_point(np.array([0, 0, 0])))
-                            # move origin a small amount along light ray
-                            shadow_origin = np.add(p, np.multiply(light_position, 0.01))
-                            # create shadow ray
-                            shadow_ray = Ray(shadow_origin, None, light_position)
-                            # do shadow collision
-                            shadow_collided = False
-                            for shadow_mesh in self.meshes:
-                                if self.meshes.index(mesh) == self.meshes.index(shadow_mesh):
-                                    continue
-                                for shadow_face in shadow_mesh.faces:
-                                    # convert vertices to world
-                                    shadow_world_vertices = []
-                                    for shadow_vertIndex in shadow_face:
-                                        shadow_world_vertices.append(shadow_mesh.transform.apply_to_point(shadow_mesh.verts[shadow_vertIndex]))
+            z_buffer[hits, pix_y] = distances[hits]
+            image_buffer[hits, pix_y] = shade_hits(triangles, self.meshes, self.camera, self.screen, self.light, shading, ambient_light, hits,
+                                                   np.full(len(hits), pix_y), mesh_indices[hits], face_indices[hits], shadowed)
 
-                                    shadow_collides, shadow_t = shadow_ray.collide(shadow_world_vertices[0], shadow_world_vertices[1], shadow_world_vertices[2])
-                                    if shadow_collides:
-                                        shadow_collided = True
+        end_time = time.time()
+        print(end_time - start_time)
+        self.screen.draw(image_buffer)
 
-                            if not shadow_collided:
-                                if shading == 'flat':
-                                    temp_face_normal = mesh.normals[mesh.faces.index(face)]
-                                    face_normal = mesh.transform.apply_to_normal(temp_face_normal)
-                                    final_color = color.ColorCalculation.flat(world_vertices, face_normal, mesh, self.light, ambient_light)
-                                    display_color = color.ColorCalculation.calcFinalRGB(final_color)
-                                if shading == 'phong-blinn':
-                                    screen_vertices = []
-                                    for vert in world_vertices:
-                                        screen_vertices.append(self.camera.project_point(vert))
-                                    a = screen_vertices[0]
-                                    b = screen_vertices[1]
-                                    c = screen_vertices[2]
 
-                                    screen_x, screen_y, screen_z = self.screen.pixel_to_screen(pix_x, pix_y)
-                                    gamma = ((a[2] - b[2]) * screen_x + (b[0] - a[0]) * screen_z + (a[0] * b[2]) - (b[0] * a[2])) / ((a[2] - b[2]) * c[0] + (b[0] - a[0]) * c[2] + (a[0] * b[2]) - (b[0] * a[2]))
-                                    beta = ((a[2] - c[2]) * screen_x + (c[0] - a[0]) * screen_z + (a[0] * c[2]) - (c[0] * a[2])) / ((a[2] - c[2]) * b[0] + (c[0] - a[0]) * b[2] + (a[0] * c[2]) - (c[0] * a[2]))
-                                    alpha = 1 - beta - gamma
-                                    screen_y = alpha * a[1] + beta * b[1] + gamma * c[1]
+# This function returns the colors of the pixels (pix_x, pix_y) of screen whose rays hit the faces face_indices of the meshes mesh_indices
+# (see SceneBVH.closest_hits), as an (N, 3) uint8 array. shadowed tells which of the hit points are in shadow, those only get the
+# ambient light. The hits are shaded together, with one call to the array version of the shading method per mesh (see
+# ColorCalculation.flat_array and ColorCalculation.phong_array), shading is 'flat' or 'phong-blinn'.
+def shade_hits(triangles, meshes, camera, screen, light, shading, ambient_light, pix_x, pix_y, mesh_indices, face_indices, shadowed):
+    if shading not in ('flat', 'phong-blinn'):
+        raise ValueError("unsupported shading for the ray tracer: " + str(shading))
+    triangle_indices = np.asarray(triangles.offsets)[mesh_indices] + face_indices
+    colors = np.empty((len(triangle_indices), 3), dtype=np.uint8)
+    lit = np.logical_not(shadowed)
 
-                                    vertex_normal_1 = mesh.transform.apply_to_normal(mesh.vertex_normals[face[0]])
-                                    vertex_normal_2 = mesh.transform.apply_to_normal(mesh.vertex_normals[face[1]])
-                                    vertex_normal_3 = mesh.transform.apply_to_normal(mesh.vertex_normals[face[2]])
-                                    interpolated_normal_temp = np.add(np.add(np.multiply(vertex_normal_1, alpha), np.multiply(vertex_normal_2, beta)), np.multiply(vertex_normal_3, gamma))
-                                    interpolated_normal = np.divide(interpolated_normal_temp, color.ColorCalculation.magnitude(interpolated_normal_temp))
-                                    point_world = self.camera.inverse_project_point((screen_x, screen_y, screen_z))
-                                    display_color = color.ColorCalculation.phong(point_world, interpolated_normal, mesh, self.light, ambient_light, self.camera.transform.apply_to_point(np.array([0, 0, 0])))
-                            else:
-                                display_color = color.ColorCalculation.calcFinalRGB(np.multiply(ambient_light, mesh.ka))
+    if shading == 'phong-blinn':
+        # interpolate the screen space depth and the vertex normals of every hit with the barycentric coordinates of its pixel centre in
+        # the projected triangle, then take the point at that depth back to world space
+        a, b, c = np.moveaxis(camera.project_points(triangles.vertices[triangle_indices].reshape(-1, 3)).reshape(-1, 3, 3), 1, 0)
+        screen_x, screen_z = screen.pixels_to_screen(pix_x, pix_y)
+        gamma = ((a[:, 2] - b[:, 2]) * screen_x + (b[:, 0] - a[:, 0]) * screen_z + (a[:, 0] * b[:, 2]) - (b[:, 0] * a[:, 2])) / ((a[:, 2] - b[:, 2]) * c[:, 0] + (b[:, 0] - a[:, 0]) * c[:, 2] + (a[:, 0] * b[:, 2]) - (b[:, 0] * a[:, 2]))
+        beta = ((a[:, 2] - c[:, 2]) * screen_x + (c[:, 0] - a[:, 0]) * screen_z + (a[:, 0] * c[:, 2]) - (c[:, 0] * a[:, 2])) / ((a[:, 2] - c[:, 2]) * b[:, 0] + (c[:, 0] - a[:, 0]) * b[:, 2] + (a[:, 0] * c[:, 2]) - (c[:, 0] * a[:, 2]))
+        alpha = 1 - beta - gamma
+        screen_y = alpha * a[:, 1] + beta * b[:, 1] + gamma * c[:, 1]
 
-                            image_buffer[pix_x, pix_y] = display_color
+        vertex_normals = triangles.vertex_normals[triangle_indices]
+        normals = vertex_normals[:, 0] * alpha[:, None] + vertex_normals[:, 1] * beta[:, None] + vertex_normals[:, 2] * gamma[:, None]
+        normals /= color.ColorCalculation.magnitudes(normals)[:, None]
+        points_world = camera.inverse_project_points(np.stack((screen_x, screen_y, screen_z), axis=1))
+        camera_position = camera.transform.apply_to_point(np.array([0, 0, 0]))
 
-        end_time = time.time()
-        print(end_time - start_time)
-        self.screen.draw(image_buffer)
+    for mesh_index in np.unique(mesh_indices):
+        mesh = meshes[mesh_index]
+        of_mesh = mesh_indices == mesh_index
+        shaded = np.flatnonzero(of_mesh & lit)
+        if shading == 'flat':
+            colors[shaded] = color.ColorCalculation.flat_array(triangles.vertices[triangle_indices[shaded]], triangles.normals[triangle_indices[shaded]],
+                                                               mesh, light, ambient_light)
+        else:
+            colors[shaded] = color.ColorCalculation.phong_array(points_world[shaded], normals[shaded], mesh, light, ambient_light, camera_position)
+        colors[of_mesh & shadowed] = color.ColorCalculation.final_rgb_array(np.multiply(ambient_light, mesh.ka))
+    return colors
@@ -1,19 +1,94 @@
 import numpy as np
-from color import ColorCalculation
-import multiprocessing
-from multiprocessing import shared_memory
-import concurrent.futures as cf
+from framebuffer import Framebuffer
+from rasterizer import Rasterizer, GBuffer
+from vertex_processing import VertexProcessor, VertexCache
+from render_pool import RenderPool
 import time
 
 
+class TileFrame:
+    # Everything a tile worker needs to render its tiles of one frame: the screen, camera and light, the processed meshes (indexed by mesh
+    # id, their arrays are shared through frame buffers of the pool, see ProcessedMesh.share), the shading parameters passed to render,
+    # the depth range for the depth shader, and the description of the shared color plane of the Framebuffer the finished tiles are
+    # written to (see SharedBuffer). z_buffer is the description of its shared depth plane the depths of the tiles are copied to as well,
+    # or None if they are not needed after the tiles are done. occlusion_culling turns on the occlusion culling of the tile rasterizers
+    # (see Rasterizer). It is sent to every worker once per frame, and only read from there.
+    __slots__ = ('screen', 'camera', 'light', 'processed_meshes', 'shading', 'bg_color', 'ambient_light', 'depth_range', 'deferred',
+                 'image_buffer', 'z_buffer', 'occlusion_culling')
+
+    def __init__(self, screen, camera, light, processed_meshes, shading, bg_color, ambient_light, depth_range, deferred, image_buffer,
+                 z_buffer=None, occlusion_culling=False):
+        self.screen = screen
+        self.camera = camera
+        self.light = light
+        self.processed_meshes = processed_meshes
+        self.shading = shading
+        self.bg_color = bg_color
+        self.ambient_light = ambient_light
+        self.depth_range = depth_range
+        self.deferred = deferred
+        self.image_buffer = image_buffer
+        self.z_buffer = z_buffer
+        self.occlusion_culling = occlusion_culling
+
+
+# This function renders one tile of the frame (a TileFrame) in a worker process of a RenderPool. tile is an (x, y, width, height, triangles) tuple, where triangles is a
+# (K, 2) array of (mesh id, face index) pairs in the order they were submitted. The worker owns the color and depth buffers of the tile
+# outright, and copies the finished tile into its own rectangle of the shared framebuffer, which no other worker writes to.
+# With occlusion culling on, the faces of each mesh come nearest first and a mesh hidden in the tile by the faces before it is skipped.
+def render_tile(worker, tile):
+    x, y, width, height, triangles = tile
+    frame = worker.frame
+    image_buffer = np.full((width, height, 3), np.clip(frame.bg_color, 0, 255), dtype=np.uint8)
+    z_buffer = np.full((width, height), np.inf, dtype=np.float32)
+    g_buffer = None
+    if frame.deferred and frame.shading == 'phong-blinn':
+        g_buffer = GBuffer(width, height)
+
+    rasterizer = Rasterizer(frame.screen, image_buffer, z_buffer, g_buffer, origin=(x, y), occlusion_culling=frame.occlusion_culling)
+    current_mesh_id = None
+    for mesh_id, face_index in triangles:
+        processed = frame.processed_meshes[mesh_id]
+        if mesh_id != current_mesh_id:
+            current_mesh_id = mesh_id
+            mesh_occluded = rasterizer.mesh_occluded(processed)
+        if not mesh_occluded:
+            rasterizer.draw_face(processed, face_index, frame.shading, frame.camera, frame.light, frame.ambient_light, frame.depth_range)
+    if g_buffer is not None:
+        rasterizer.resolve(frame.processed_meshes, frame.camera, frame.light, frame.ambient_light)
+
+    Framebuffer.pixel_view(worker.buffer(frame.image_buffer))[x:x + width, y:y + height] = image_buffer
+    if frame.z_buffer is not None:
+        Framebuffer.depth_view(worker.buffer(frame.z_buffer))[x:x + width, y:y + height] = z_buffer
+
+
 class Renderer:
     # The class constructor takes a screen object (of type Screen), camera object (either of type OrthoCamera or PerspectiveCamera),
     # a list of mesh objects (of type Mesh), and a light source (of type PointLight) and stores them.
-    def __init__(self, screen, camera, meshes, light):
+    # tile_size is the width and height in pixels of the screen tiles the triangles are binned into, and processes the number of worker
+    # processes rendering them (None uses one per CPU).
+    # The workers are started on the first render and kept for later ones until close is called. To share them with other renderers,
+    # pass a RenderPool as pool instead, processes is then ignored and the pool is left running by close.
+    # The vertex stage results of the meshes are kept between frames (see VertexCache), so meshes that have not moved are not processed
+    # again.
+    def __init__(self, screen, camera, meshes, light, tile_size=64, processes=None, pool=None):
         self.screen = screen
         self.camera = camera
         self.meshes = meshes
         self.light = light
+        self.tile_size = tile_size
+        self.processes = processes
+        self.pool = pool
+        self.owns_pool = pool is None
+        self.vertex_cache = VertexCache()
+        # (settings, mesh bounds, image) of the last incremental render, see render
+        self.last_frame = None
+
+    # This method stops the worker processes started by this renderer.
+    def close(self):
+        if self.owns_pool and self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     # This method will take three input arguments.
     # shading is a string parameter indicating which type of shading to apply, and barycentric should be implemented.
@@ -21,147 +96,162 @@ class Renderer:
     # ambient_light defines the intensity and color of any ambient lighting to add within the scene.
     # render will execute the basic render loop and compute shading at each pixel fragment to update an image buffer.
     # It will then draw that image buffer to the screen object using the screen.draw method, but it will not run the pygame loop (the calling function will call screen.show)
-    def render(self, shading, bg_color, ambient_light):
-        image_buffer = np.full((self.screen.width, self.screen.height, 3), bg_color)
-        z_buffer = np.full((self.screen.width, self.screen.height), np.inf)
+    # With deferred set, phong-blinn fragments are first written to a GBuffer and only the visible ones are shaded (see Rasterizer.resolve).
+    # The vertex stage runs once in this process, the faces are then binned into screen tiles and a pool of workers rasterizes the tiles.
+    # Every tile keeps the submission order of its faces, so the output is deterministic and the same as the sequential renderer's.
+    # With incremental set, the image of the last incremental render is kept, and if nothing but mesh transforms has changed since then
+    # only the screen regions covered by the moved meshes, where they were and where they are now, are rasterized again. The image is
+    # the same as a full render's.
+    # depth_source picks the depth range the depth shader maps to black and white: 'vertices' takes it from the projected vertices of
+    # the front facing faces before rasterization, 'z_buffer' from the depths left in the z-buffer afterwards (see Rasterizer.resolve_depth),
+    # any other value raises a ValueError. Frames taking the range from the z-buffer are always rendered in full.
+    # With occlusion_culling set, every tile draws meshes and faces nearest first and skips those hidden behind what it has already
+    # drawn (see DepthPyramid), the image is the same. It is off by default: sorting the faces and testing them against the pyramid
+    # costs more than it saves on scenes with little overdraw, like the stock ones. It pays off on deep scenes, where many meshes or
+    # layers of faces lie behind each other.
+    def render(self, shading, bg_color, ambient_light, deferred=True, incremental=False, depth_source='vertices', occlusion_culling=False):
+        if depth_source not in ('vertices', 'z_buffer'):
+            raise ValueError("unknown depth source: " + str(depth_source))
         # check camera and image buffer ratios
         if self.camera.ratio() != self.screen.ratio():
             exit(1)
+        self.start_pool()
 
-        shared_z_buffer = shared_memory.SharedMemory(name='z_buffer', create=True, size=z_buffer.nbytes)
-        shared_image_buffer = shared_memory.SharedMemory(name='image_buffer', create=True, size=image_buffer.nbytes)
+        start_time = time.time()
+        framebuffer = self.finish_frame(self.begin_frame(shading, bg_color, ambient_light, deferred, incremental, depth_source=depth_source,
+                                                         occlusion_culling=occlusion_culling))
 
-        z_buf_shape = z_buffer.shape
-        z_buf_type = z_buffer.dtype
-        im_buf_shape = image_buffer.shape
-        im_buf_type = image_buffer.dtype
+        end_time = time.time()
+        self.screen.draw(framebuffer)
+        print(end_time - start_time)
 
-        z_buffer_shared = np.ndarray(z_buf_shape, dtype=z_buf_type, buffer=shared_z_buffer.buf)
-        z_buffer_shared[:] = z_buffer[:]
-        image_buffer_shared = np.ndarray(im_buf_shape, dtype=im_buf_type, buffer=shared_image_buffer.buf)
-        image_buffer_shared[:] = image_buffer[:]
+    # This method starts the worker processes if they are not running yet and moves the geometry of the meshes to shared memory.
+    def start_pool(self):
+        if self.pool is None:
+            self.pool = RenderPool(self.processes)
+        # only copies geometry the pool has not seen yet
+        self.pool.share_geometry(self.meshes)
 
-        processes = []
-        for mesh in self.meshes:
-            process = multiprocessing.Process(target=self.mesh_calculations, args=(shading, mesh, ambient_light, z_buf_shape, z_buf_type, im_buf_shape, im_buf_type))
-            processes.append(process)
+    # This method is the first half of render, without drawing to the screen: it runs the vertex stage for the meshes in their current
+    # positions, bins the faces and hands the tiles to the workers, then returns a handle for finish_frame without waiting for them. The
+    # image is rendered into a Framebuffer whose planes are the pool frame buffers called buffer_name (color) and buffer_name + '_z'
+    # (depth, only kept for depth shading from the z-buffer), and the arrays of the processed meshes are copied to pool frame buffers
+    # named after buffer_name as well (see ProcessedMesh.share), so frames using different names can be in flight at once, for
+    # example one being rasterized while the vertex stage of the next runs (see AnimationRenderer). An incremental frame must be
+    # finished before the next frame is begun.
+    def begin_frame(self, shading, bg_color, ambient_light, deferred=True, incremental=False, buffer_name='image_buffer', depth_source='vertices',
+                    occlusion_culling=False):
+        if depth_source not in ('vertices', 'z_buffer'):
+            raise ValueError("unknown depth source: " + str(depth_source))
+        self.start_pool()
+        shared_image_buffer = self.pool.frame_buffer(buffer_name, (self.screen.height, self.screen.width, 3), np.uint8)
+        shared_z_buffer = None
+        if shading == 'depth' and depth_source == 'z_buffer':
+            shared_z_buffer = self.pool.frame_buffer(buffer_name + '_z', (self.screen.height, self.screen.width), np.float32)
+            incremental = False
+        framebuffer = Framebuffer(self.screen.width, self.screen.height, shared_image_buffer.array,
+                                  False if shared_z_buffer is None else shared_z_buffer.array, shared=True)
+        framebuffer.clear(bg_color)
 
-        start_time = time.time()
-        for p in processes:
-            p.start()
+        # transform and project all vertices of every mesh once, meshes that have not changed since the last frame are taken from the cache
+        processed_meshes = []
+        moved = []
+        for mesh_id, mesh in enumerate(self.meshes):
+            processed, changed = self.vertex_cache.process(mesh, self.camera, self.screen, mesh_id, shading, self.light, ambient_light)
+            processed_meshes.append(processed)
+            if changed:
+                moved.append(mesh_id)
 
-        for p in processes:
-            p.join()
+        # depth shader, the range is found once for the whole frame
+        depth_range = None
+        if shading == 'depth' and shared_z_buffer is None:
+            depth_range = VertexProcessor.depth_range(processed_meshes)
 
-        end_time = time.time()
-        self.screen.draw(image_buffer_shared)
-        print(end_time - start_time)
+        # everything except the mesh transforms the last image depends on
+        settings = (id(self.camera), self.camera.transform.version, id(self.light), self.light.transform.version, self.screen.width,
+                    self.screen.height, self.tile_size, shading, tuple(np.ravel(bg_color)), tuple(np.ravel(ambient_light)), depth_range, deferred,
+                    tuple(id(mesh) for mesh in self.meshes))
+        regions = None
+        incremental_state = None
+        if incremental:
+            bounds = [VertexProcessor.mesh_bounds(processed, self.screen) for processed in processed_meshes]
+            if self.last_frame is not None and self.last_frame[0] == settings:
+                last_bounds = self.last_frame[1]
+                regions = [rect for mesh_id in moved for rect in (last_bounds[mesh_id], bounds[mesh_id]) if rect is not None]
+                framebuffer.color[:] = self.last_frame[2]
+            incremental_state = (settings, bounds)
 
-        shared_z_buffer.close()
-        shared_z_buffer.unlink()
-        shared_image_buffer.close()
-        shared_image_buffer.unlink()
-
-    def mesh_calculations(self, shading, mesh, ambient_light, z_buf_shape, z_buf_type, im_buf_shape, im_buf_type):
-        with cf.ThreadPoolExecutor(max_workers=10) as executor:
-            futures = [executor.submit(self.face_calculations, shading, face, mesh, ambient_light, z_buf_shape, z_buf_type, im_buf_shape, im_buf_type) for face in mesh.faces]
-
-    def face_calculations(self, shading, face, mesh, ambient_light, z_buf_shape, z_buf_type, im_buf_shape, im_buf_type):
-        existing_z_buffer = shared_memory.SharedMemory(name='z_buffer')
-        existing_image_buffer = shared_memory.SharedMemory(name='image_buffer')
-        z_buffer = np.ndarray(z_buf_shape, dtype=z_buf_type, buffer=existing_z_buffer.buf)
-        image_buffer = np.ndarray(im_buf_shape, dtype=im_buf_type, buffer=existing_image_buffer.buf)
-        # depth shader
-        if shading == 'depth':
-            min_depth, max_depth = ColorCalculation.getMinMaxDepth(self.meshes, self.camera)
-
-        # Normal culling
-        temp_face_normal = mesh.normals[mesh.faces.index(face)]
-        face_normal = mesh.transform.apply_to_normal(temp_face_normal)
-        camera_normal = self.camera.transform.apply_to_normal(np.array([0, 1, 0]))
-        if np.dot(face_normal, camera_normal) >= 0:
-            existing_z_buffer.close()
-            existing_image_buffer.close()
-            return
-
-        # convert vertices to world space
-        world_vertices = []
-        for vertIndex in face:
-            world_vertices.append(mesh.transform.apply_to_point(mesh.verts[vertIndex]))
-
-        # convert world vertices to screen space
-        screen_vertices = []
-        for vert in world_vertices:
-            screen_vertices.append(self.camera.project_point(vert))
-
-        # convert to pixel space
-        pixel_vertices = []
-        for vert in screen_vertices:
-            pixel_vertices.append(self.screen.screen_to_pixel(vert))
-
-        # A - pre-fragment shading calculations
-        if shading == 'flat':
-            final_color = ColorCalculation.flat(world_vertices, face_normal, mesh, self.light, ambient_light)
-        if shading == 'gouraud':
-            vertex_colors = [ColorCalculation.gouraud(world_vertices[0], mesh.transform.apply_to_normal(mesh.vertex_normals[face[0]]), mesh, self.light, ambient_light, self.camera.transform.apply_to_point(np.array([0, 0, 0]))),
-                             ColorCalculation.gouraud(world_vertices[1], mesh.transform.apply_to_normal(mesh.vertex_normals[face[1]]), mesh, self.light, ambient_light, self.camera.transform.apply_to_point(np.array([0, 0, 0]))),
-                             ColorCalculation.gouraud(world_vertices[2], mesh.transform.apply_to_normal(mesh.vertex_normals[face[2]]), mesh, self.light, ambient_light, self.camera.transform.apply_to_point(np.array([0, 0, 0])))]
-
-        # find rectangular bounds of face (in pixel space)
-        min_x = self.screen.width
-        min_y = self.screen.height
-        max_x = 0
-        max_y = 0
-        for vert in pixel_vertices:
-            if vert[0] > max_x:
-                max_x = vert[0]
-            if vert[0] < min_x:
-                min_x = vert[0]
-            if vert[1] > max_y:
-                max_y = vert[1]
-            if vert[1] < min_y:
-                min_y = vert[1]
-
-        # for valid pixel in bounds
-        a = screen_vertices[0]
-        b = screen_vertices[1]
-        c = screen_vertices[2]
-
-        for pix_y in range(min_y, max_y + 1):
-            for pix_x in range(min_x, max_x + 1):
-                screen_x, screen_y, screen_z = self.screen.pixel_to_screen(pix_x, pix_y)
-                gamma = ((a[2] - b[2]) * screen_x + (b[0] - a[0]) * screen_z + (a[0] * b[2]) - (b[0] * a[2])) / ((a[2] - b[2]) * c[0] + (b[0] - a[0]) * c[2] + (a[0] * b[2]) - (b[0] * a[2]))
-                beta = ((a[2] - c[2]) * screen_x + (c[0] - a[0]) * screen_z + (a[0] * c[2]) - (c[0] * a[2])) / ((a[2] - c[2]) * b[0] + (c[0] - a[0]) * b[2] + (a[0] * c[2]) - (c[0] * a[2]))
-                alpha = 1 - beta - gamma
-                screen_y = alpha * a[1] + beta * b[1] + gamma * c[1]
-                if screen_y > 1 or screen_y < -1:
-                    continue
-                if screen_y > z_buffer[pix_x, pix_y]:
+        tiles = self.bin_faces(processed_meshes, regions, occlusion_culling)
+        for processed in processed_meshes:
+            processed.share(self.pool, buffer_name + '_mesh' + str(processed.mesh_id))
+        frame = TileFrame(self.screen, self.camera, self.light, processed_meshes, shading, bg_color, ambient_light, depth_range, deferred,
+                          shared_image_buffer.description(), None if shared_z_buffer is None else shared_z_buffer.description(),
+                          occlusion_culling)
+        return self.pool.submit(frame, render_tile, tiles), framebuffer, incremental_state
+
+    # This method is the second half of render: it waits for the workers to finish the frame begun with the given handle and returns its
+    # Framebuffer. The planes are reused by later frames with the same buffer name, so they have to be copied to be kept.
+    def finish_frame(self, handle):
+        frame_id, framebuffer, incremental_state = handle
+        self.pool.wait(frame_id)
+        if framebuffer.depth is not None:
+            # the depth range can only be found once every tile is done
+            Rasterizer(self.screen, framebuffer.pixels(), framebuffer.z_buffer()).resolve_depth()
+        self.last_frame = None if incremental_state is None else incremental_state + (framebuffer.color.copy(),)
+        return framebuffer
+
+    # This method sorts the front facing faces of the processed meshes into the screen tiles their pixel bounds overlap. It returns the
+    # tiles that received any faces as (x, y, width, height, triangles) tuples (see render_tile), with the faces of each tile in mesh order
+    # and then face order. Faces whose bounds are entirely off screen are dropped.
+    # If regions, a list of (x, y, width, height) pixel rectangles, is given only the parts of the screen they cover are returned instead:
+    # every tile overlapping them, cut down to the rectangle around its overlap with them, whether it received any faces or not.
+    # With front_to_back set, the meshes and the faces of each mesh are put in nearest first order instead.
+    def bin_faces(self, processed_meshes, regions=None, front_to_back=False):
+        tiles_x = -(-self.screen.width // self.tile_size)
+        tiles_y = -(-self.screen.height // self.tile_size)
+        bins = [[] for _ in range(tiles_x * tiles_y)]
+        if front_to_back:
+            processed_meshes = VertexProcessor.meshes_front_to_back(processed_meshes)
+        for processed in processed_meshes:
+            face_indices = VertexProcessor.front_to_back(processed) if front_to_back else None
+            face_indices, min_x, max_x, min_y, max_y = VertexProcessor.face_bounds(processed, self.screen, face_indices)
+            tile_bounds = zip(face_indices, min_x // self.tile_size, max_x // self.tile_size, min_y // self.tile_size, max_y // self.tile_size)
+            for face_index, first_x, last_x, first_y, last_y in tile_bounds:
+                for tile_y in range(first_y, last_y + 1):
+                    for tile_x in range(first_x, last_x + 1):
+                        bins[tile_y * tiles_x + tile_x].append((processed.mesh_id, face_index))
+
+        tiles = []
+        for index, triangles in enumerate(bins):
+            x = (index % tiles_x) * self.tile_size
+            y = (index // tiles_x) * self.tile_size
+            tile = (x, y, min(self.tile_size, self.screen.width - x), min(self.tile_size, self.screen.height - y))
+            if regions is not None:
+                tile = Renderer.clip(tile, regions)
+                if tile is None:
                     continue
-                if (0 <= alpha <= 1) and (0 <= beta <= 1) and (0 <= gamma <= 1):
-                    z_buffer[pix_x, pix_y] = screen_y
-                    # B - calculate fragment color -> color
-                    if shading == 'flat':
-                        display_color = ColorCalculation.calcFinalRGB(final_color)
-                    elif shading == 'barycentric':
-                        display_color = ColorCalculation.barycentric(alpha, beta, gamma)
-                    elif shading == 'depth':
-                        display_color = ColorCalculation.depth(min_depth, max_depth, screen_y)
-                    elif shading == 'phong-blinn':
-                        vertex_normal_1 = mesh.transform.apply_to_normal(mesh.vertex_normals[face[0]])
-                        vertex_normal_2 = mesh.transform.apply_to_normal(mesh.vertex_normals[face[1]])
-                        vertex_normal_3 = mesh.transform.apply_to_normal(mesh.vertex_normals[face[2]])
-                        interpolated_normal_temp = np.add(np.add(np.multiply(vertex_normal_1, alpha), np.multiply(vertex_normal_2, beta)), np.multiply(vertex_normal_3, gamma))
-                        interpolated_normal = np.divide(interpolated_normal_temp, ColorCalculation.magnitude(interpolated_normal_temp))
-                        point_world = self.camera.inverse_project_point((screen_x, screen_y, screen_z))
-                        display_color = ColorCalculation.phong(point_world, interpolated_normal, mesh, self.light, ambient_light, self.camera.transform.apply_to_point(np.array([0, 0, 0])))
-                    elif shading == 'gouraud':
-                        display_color = np.add(np.add(np.multiply(vertex_colors[0], alpha), np.multiply(vertex_colors[1], beta)), np.multiply(vertex_colors[2], gamma))
-                        display_color[0] = int(display_color[0])
-                        display_color[1] = int(display_color[1])
-                        display_color[2] = int(display_color[2])
-
-                    image_buffer[pix_x, pix_y] = display_color
-
-        existing_z_buffer.close()
-        existing_image_buffer.close()
+            elif len(triangles) == 0:
+                continue
+            tiles.append(tile + (np.array(triangles, dtype=int).reshape(-1, 2),))
+        return tiles
+
+    # This static method returns the rectangle around the overlap of the (x, y, width, height) rectangle tile with the rectangles in
+    # regions, or None if it overlaps none of them.
+    @staticmethod
+    def clip(tile, regions):
+        x, y, width, height = tile
+        start_x = start_y = np.inf
+        end_x = end_y = -np.inf
+        for region_x, region_y, region_width, region_height in regions:
+            overlap_start_x = max(x, region_x)
+            overlap_start_y = max(y, region_y)
+            overlap_end_x = min(x + width, region_x + region_width)
+            overlap_end_y = min(y + height, region_y + region_height)
+            if overlap_start_x < overlap_end_x and overlap_start_y < overlap_end_y:
+                start_x = min(start_x, overlap_start_x)
+                start_y = min(start_y, overlap_start_y)
+                end_x = max(end_x, overlap_end_x)
+                end_y = max(end_y, overlap_end_y)
+        if start_x > end_x:
+            return None
+        return start_x, start_y, end_x - start_x, end_y - start_y
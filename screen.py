@@ -1,8 +1,20 @@
-# Import and initialize the pygame library
-import pygame
 import numpy as np
+from framebuffer import Framebuffer
+from image_writer import ImageWriter
 
-pygame.init()
+# The pygame module, imported and initialized the first time a window is opened (see load_pygame). Screens that are never shown in a
+# window, and the render workers, never load it.
+_pygame = None
+
+
+# This function returns the pygame module, importing and initializing it on first use.
+def load_pygame():
+    global _pygame
+    if _pygame is None:
+        import pygame
+        pygame.init()
+        _pygame = pygame
+    return _pygame
 
 
 class Screen:
@@ -10,23 +22,53 @@ class Screen:
     height = None
     screen = None
 
-    def __init__(self, width, height):
+    # With headless set the screen never opens a window: draw only keeps the image in memory, where it can be read from image or
+    # written to a file with save, and show returns at once. This needs neither pygame nor a display.
+    def __init__(self, width, height, headless=False):
         self.width = width
         self.height = height
+        self.headless = headless
+        # The Framebuffer last drawn
+        self.image = None
+
+    # A Screen sent to another process (a render worker) only takes its size along, not the pygame window or the image.
+    def __getstate__(self):
+        return {'width': self.width, 'height': self.height, 'headless': True, 'image': None}
 
     def ratio(self):
         return self.width / self.height
 
+    # buffer is either a Framebuffer, which already has the layout of the window surface, or an image buffer indexed [x, y], which is
+    # converted into a new Framebuffer. A Framebuffer is kept as it is, unless its planes are shared frame buffers of a RenderPool: those
+    # are drawn into again by later frames and freed with the pool, so the screen keeps a copy of the color plane instead.
     def draw(self, buffer):
-        if buffer.shape != (self.width, self.height, 3):
-            raise Exception("buffer shape incorrect")
+        if isinstance(buffer, Framebuffer):
+            if (buffer.width, buffer.height) != (self.width, self.height):
+                raise Exception("framebuffer size incorrect")
+            self.image = Framebuffer(self.width, self.height, buffer.color.copy(), False) if buffer.shared else buffer
+        else:
+            if buffer.shape != (self.width, self.height, 3):
+                raise Exception("buffer shape incorrect")
+            self.image = Framebuffer.from_pixels(buffer)
+        if self.headless:
+            return
+
+        # Set up the drawing window, the color plane of the image is wrapped in a surface without copying it and blitted straight to the window
+        pygame = load_pygame()
+        if self.screen is None:
+            self.screen = pygame.display.set_mode([self.width, self.height])
+        self.screen.blit(pygame.image.frombuffer(self.image.color, (self.width, self.height), 'RGB'), (0, 0))
 
-        # Set up the drawing window
-        self.screen = pygame.display.set_mode([self.width, self.height])
-        buffer = np.fliplr(buffer)
-        pygame.pixelcopy.array_to_surface(self.screen, buffer)
+    # This method writes the last image drawn to path, as a png, ppm or raw file depending on its extension (see ImageWriter.write).
+    def save(self, path):
+        if self.image is None:
+            raise Exception("nothing has been drawn to the screen")
+        ImageWriter.write(path, self.image)
 
     def show(self):
+        if self.headless:
+            return
+        pygame = load_pygame()
         # Run until the user asks to quit
         running = True
         while running:
@@ -41,6 +83,7 @@ class Screen:
 
         # Done! Time to quit.
         pygame.quit()
+        self.screen = None
 
     def screen_to_pixel(self, p):
         x = int(((p[0] + 1) * self.width) / 2)
@@ -48,8 +91,21 @@ class Screen:
         retVal = np.array([x, y])
         return retVal
 
+    # batched version of screen_to_pixel, points is an (N, 3) numpy array of screen space points and an (N, 2) int array of pixels is returned
+    def screen_to_pixels(self, points):
+        x = np.trunc(((points[:, 0] + 1) * self.width) / 2)
+        y = np.trunc(((points[:, 2] + 1) * self.height) / 2)
+        return np.stack((x, y), axis=1).astype(int)
+
     def pixel_to_screen(self, x, y):
         x_screen = (2 * (x + 0.5) / self.width) - 1.0
         y_screen = 0.0
         z_screen = (2 * (y + 0.5) / self.height) - 1.0
         return np.array([x_screen, y_screen, z_screen])
+
+    # batched version of pixel_to_screen, x and y are numpy arrays of pixel coordinates and the screen space x and z coordinates of the
+    # pixel centres are returned as two arrays of the same shape (the screen space y of a pixel is always 0.0)
+    def pixels_to_screen(self, x, y):
+        x_screen = (2 * (x + 0.5) / self.width) - 1.0
+        z_screen = (2 * (y + 0.5) / self.height) - 1.0
+        return x_screen, z_screen
@@ -0,0 +1,52 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class SharedBuffer:
+    # A numpy array stored in its own block of shared memory. Blocks get a unique name from the operating system, so any number of
+    # renders can have buffers alive at the same time. A buffer is sent to another process as its description (see description) and
+    # attached there with attach, both processes then read and write the same memory.
+    __slots__ = ('memory', 'array')
+
+    # The constructor creates a new block big enough for an array of the given shape and dtype. The contents start out as zeros.
+    def __init__(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.memory.buf)
+
+    # This static method creates a SharedBuffer holding a copy of array.
+    @staticmethod
+    def from_array(array):
+        buffer = SharedBuffer(array.shape, array.dtype)
+        buffer.array[:] = array
+        return buffer
+
+    # This static method attaches to the block of an existing SharedBuffer from its description and returns a SharedBuffer for it.
+    @staticmethod
+    def attach(description):
+        name, shape, dtype = description
+        buffer = SharedBuffer.__new__(SharedBuffer)
+        buffer.memory = shared_memory.SharedMemory(name=name)
+        buffer.array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=buffer.memory.buf)
+        return buffer
+
+    # This method returns the (name, shape, dtype) tuple another process needs to attach to the buffer.
+    def description(self):
+        return self.memory.name, self.array.shape, self.array.dtype.str
+
+    # This method returns True if the buffer holds an array of the given shape and dtype.
+    def matches(self, shape, dtype):
+        return self.array.shape == tuple(shape) and self.array.dtype == np.dtype(dtype)
+
+    # This method closes this process's view of the block. The memory is unmapped even if arrays created from the buffer are still alive,
+    # they must not be used after it, anything kept longer has to be copied out first. unlink removes the block itself once every
+    # process has closed it, it is only called by the process that created it.
+    def close(self):
+        self.array = None
+        try:
+            self.memory.close()
+        except BufferError:
+            pass
+
+    def unlink(self):
+        self.memory.unlink()
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+from animation import Animation, AnimationRenderer
+from camera import PerspectiveCamera
+from light import PointLight
+from mesh import Mesh
+from renderer_shared_mem import Renderer
+from screen import Screen
+
+
+# This function returns the screen, camera, meshes and light of a small scene of two Suzanne heads, and an animation moving the camera,
+# the light and one of the heads a long way on every frame.
+def animated_scene():
+    screen = Screen(64, 64, headless=True)
+    camera = PerspectiveCamera(-1.0, 1.0, -1.0, 1.0, 1.0, 20)
+    meshes = []
+    for position in [(-0.8, 0, 0.4), (0.8, 1, -0.4)]:
+        mesh = Mesh.from_stl(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'suzanne.stl'), np.array([1.0, 0.0, 1.0]),
+                             np.array([1.0, 1.0, 1.0]), 0.05, 1.0, 0.2, 100)
+        mesh.transform.set_rotation(-15, 0, 215)
+        mesh.transform.set_position(*position)
+        meshes.append(mesh)
+    light = PointLight(50.0, np.array([1, 1, 1]))
+
+    animation = Animation()
+    animation.add(camera.transform, 0, position=(-1, -5, 0), rotation=(0, 0, -10))
+    animation.add(camera.transform, 5, position=(1, -4, 0.5), rotation=(0, 0, 10))
+    animation.add(light.transform, 0, position=(4, -4, -3))
+    animation.add(light.transform, 5, position=(-4, -4, 3))
+    animation.add(meshes[0].transform, 0, rotation=(-15, 0, 215))
+    animation.add(meshes[0].transform, 5, rotation=(-15, 0, 395))
+    return screen, camera, meshes, light, animation
+
+
+# Frames rendered pipelined, with the next frame set up as soon as a frame has been handed to the workers and finished after that, must be
+# the same as frames rendered one at a time. The camera and light sent to the workers with a frame must not see the changes made for the
+# next one.
+def test_pipelined_frames_match_frames_rendered_one_at_a_time():
+    screen, camera, meshes, light, animation = animated_scene()
+    renderer = Renderer(screen, camera, meshes, light, tile_size=16, processes=2)
+    try:
+        pipelined = []
+        in_flight = None
+        animation.apply(0)
+        for frame in range(animation.frame_count()):
+            handle = renderer.begin_frame('phong-blinn', [80, 80, 80], [0.2, 0.2, 0.2], buffer_name='pipelined_' + str(frame % 2))
+            animation.apply(frame + 1)
+            if in_flight is not None:
+                pipelined.append(renderer.finish_frame(in_flight).color.copy())
+            in_flight = handle
+        pipelined.append(renderer.finish_frame(in_flight).color.copy())
+
+        for frame in range(animation.frame_count()):
+            animation.apply(frame)
+            framebuffer = renderer.finish_frame(renderer.begin_frame('phong-blinn', [80, 80, 80], [0.2, 0.2, 0.2]))
+            assert np.array_equal(pipelined[frame], framebuffer.color), 'frame ' + str(frame)
+    finally:
+        renderer.close()
+
+
+# The frames saved by AnimationRenderer must be the same as frames rendered one at a time.
+def test_animation_frames_match_frames_rendered_one_at_a_time(tmp_path):
+    screen, camera, meshes, light, animation = animated_scene()
+    animation_renderer = AnimationRenderer(screen, camera, meshes, light, tile_size=16, processes=2)
+    try:
+        animation_renderer.render(animation, 'phong-blinn', [80, 80, 80], [0.2, 0.2, 0.2], output_dir=str(tmp_path),
+                                  file_pattern='frame_{:04d}.raw')
+        renderer = Renderer(screen, camera, meshes, light, tile_size=16, pool=animation_renderer.renderer.pool)
+        for frame in range(animation.frame_count()):
+            animation.apply(frame)
+            framebuffer = renderer.finish_frame(renderer.begin_frame('phong-blinn', [80, 80, 80], [0.2, 0.2, 0.2]))
+            saved = np.fromfile(str(tmp_path / 'frame_{:04d}.raw'.format(frame)), dtype=np.uint8).reshape(framebuffer.color.shape)
+            assert np.array_equal(saved, framebuffer.color), 'frame ' + str(frame)
+    finally:
+        animation_renderer.close()
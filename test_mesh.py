@@ -0,0 +1,103 @@
+import os
+import numpy as np
+import pytest
+from stl import mesh as numpyMesh, Mode
+from geometry_file import GeometryFile
+from mesh import Mesh
+from threeDVector import ThreeDVector
+
+
+# This function writes the (F, 3, 3) array of triangle corners triangles to path as a binary stl file.
+def write_stl(path, triangles):
+    stl_mesh = numpyMesh.Mesh(np.zeros(len(triangles), dtype=numpyMesh.Mesh.dtype))
+    stl_mesh.vectors[:] = triangles
+    stl_mesh.save(str(path), mode=Mode.BINARY)
+
+
+# This function loads the stl file at path with its geometry cached in cache_dir, the way a new process would: the geometry shared
+# between meshes of this process is dropped first.
+def load_cached(path, cache_dir):
+    Mesh.clear_geometry_cache()
+    return Mesh.from_stl(str(path), np.array([1.0, 1.0, 1.0]), np.array([1.0, 1.0, 1.0]), 0.1, 1.0, 0.2, 10, cache_dir=str(cache_dir))
+
+
+# Two triangles of a square, sharing the corners of its diagonal
+SQUARE = np.array([[[0, 0, 0], [1, 0, 0], [1, 1, 0]],
+                   [[0, 0, 0], [1, 1, 0], [0, 1, 0]]], dtype=np.float32)
+
+
+# Corners at the same position become one vertex, numbered in the order they are first met.
+def test_weld_merges_shared_corners():
+    verts, faces = Mesh.weld_vertices(SQUARE)
+    assert np.array_equal(verts, [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]])
+    assert np.array_equal(faces, [[0, 1, 2], [0, 2, 3]])
+
+
+# With an epsilon, corners closer than it are merged as well and keep the position of the first one. Without it they stay apart.
+def test_weld_epsilon_merges_nearly_coincident_corners():
+    triangles = SQUARE.copy()
+    triangles[1, 0] = [0.001, 0, 0]
+    assert len(Mesh.weld_vertices(triangles)[0]) == 5
+    verts, faces = Mesh.weld_vertices(triangles, 0.01)
+    assert np.array_equal(verts, [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]])
+    assert np.array_equal(faces, [[0, 1, 2], [0, 2, 3]])
+
+
+# The normal of a vertex shared by a large face in the xy plane and a small face in the yz plane, where the corners at the vertex are a
+# right angle and half of one: uniform weighting takes the two face normals equally, area weighting by the face areas (2 and 0.5) and
+# angle weighting by the angles at the vertex.
+@pytest.mark.parametrize('weighting, expected', [('uniform', [-1, 0, 1]), ('area', [-0.5, 0, 2]), ('angle', [-np.pi / 4, 0, np.pi / 2])])
+def test_vertex_normal_weighting(weighting, expected):
+    verts = np.array([[0, 0, 0], [2, 0, 0], [0, 2, 0], [0, 0, 1], [0, 1, 1]], dtype=float)
+    faces = np.array([[0, 1, 2], [0, 3, 4]])
+    normals = ThreeDVector.find_normals(verts, faces)
+    vertex_normals = ThreeDVector.vertex_normals(verts, faces, normals, weighting)
+    assert np.allclose(vertex_normals[0], np.array(expected) / np.linalg.norm(expected))
+    # the other vertices only touch one face
+    assert np.allclose(vertex_normals[1:3], [0, 0, 1])
+    assert np.allclose(vertex_normals[3:5], [-1, 0, 0])
+
+
+def test_unknown_vertex_normal_weighting_is_rejected():
+    with pytest.raises(ValueError):
+        ThreeDVector.vertex_normals(SQUARE.reshape(-1, 3), np.array([[0, 1, 2]]), np.array([[0, 0, 1.0]]), 'volume')
+
+
+# The first load writes the geometry file and later loads read it back without parsing the stl file, also after the stl file was only
+# touched.
+def test_geometry_file_is_reused(tmp_path, monkeypatch):
+    stl_path = tmp_path / 'square.stl'
+    write_stl(stl_path, SQUARE)
+    mesh = load_cached(stl_path, tmp_path / 'cache')
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 1
+
+    def build_geometry(*args):
+        raise AssertionError("the stl file was parsed again")
+    monkeypatch.setattr(Mesh, 'build_geometry', build_geometry)
+    os.utime(str(stl_path), ns=(1, 1))
+    cached = load_cached(stl_path, tmp_path / 'cache')
+    for name in ('verts', 'faces', 'normals', 'vertex_normals'):
+        assert np.array_equal(getattr(cached, name), getattr(mesh, name))
+
+
+# A geometry file built from an older version of the stl file (here of the same size, so only the hash tells them apart) or from
+# different options is not used, the geometry is built again. A file that is not a geometry file is replaced as well.
+def test_stale_geometry_file_is_rebuilt(tmp_path):
+    stl_path = tmp_path / 'square.stl'
+    write_stl(stl_path, SQUARE)
+    load_cached(stl_path, tmp_path / 'cache')
+    geometry_path = str(tmp_path / 'cache' / os.listdir(str(tmp_path / 'cache'))[0])
+
+    moved = SQUARE + np.array([0, 0, 1], dtype=np.float32)
+    write_stl(stl_path, moved)
+    os.utime(str(stl_path), ns=(1, 1))
+    mesh = load_cached(stl_path, tmp_path / 'cache')
+    assert np.array_equal(mesh.verts[:, 2], [1, 1, 1, 1])
+    assert GeometryFile.read_header(geometry_path)['source']['sha1'] == GeometryFile.file_hash(str(stl_path))
+
+    with open(geometry_path, 'wb') as f:
+        f.write(b'not a geometry file')
+    mesh = load_cached(stl_path, tmp_path / 'cache')
+    assert np.array_equal(mesh.verts[:, 2], [1, 1, 1, 1])
+    assert GeometryFile.find(str(tmp_path / 'cache'), str(stl_path), {'weld_epsilon': 0.0, 'normal_weighting': 'uniform'}) == geometry_path
+    assert GeometryFile.find(str(tmp_path / 'cache'), str(stl_path), {'weld_epsilon': 0.0, 'normal_weighting': 'area'}) is None
@@ -0,0 +1,31 @@
+import numpy as np
+from camera import OrthoCamera
+from light import PointLight
+from renderer_ray_traced import Renderer
+from renderer_ray_traced_sequential import Renderer as SequentialRenderer
+from screen import Screen
+
+
+# This function returns a small screen, camera and light for the ray tracers.
+def ray_traced_scene():
+    screen = Screen(16, 16, headless=True)
+    camera = OrthoCamera(-1.5, 1.5, -1.5, 1.5, 1.0, 10)
+    camera.transform.set_position(0, -8, 0)
+    light = PointLight(50.0, np.array([1, 1, 1]))
+    light.transform.set_position(-3, 4, -3)
+    return screen, camera, light
+
+
+# A scene without meshes is drawn as the background by both ray tracers.
+def test_empty_scene_renders_the_background():
+    screen, camera, light = ray_traced_scene()
+    SequentialRenderer(screen, camera, [], light).render('flat', [80, 90, 100], [0.2, 0.2, 0.2])
+    assert (screen.image.color == [80, 90, 100]).all()
+
+    screen, camera, light = ray_traced_scene()
+    renderer = Renderer(screen, camera, [], light, processes=1)
+    try:
+        renderer.render('phong-blinn', [80, 90, 100], [0.2, 0.2, 0.2])
+    finally:
+        renderer.close()
+    assert (screen.image.color == [80, 90, 100]).all()
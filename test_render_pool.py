@@ -0,0 +1,97 @@
+import os
+import numpy as np
+import pytest
+from mesh import Mesh
+from render_pool import RenderPool
+from shared_buffer import SharedBuffer
+
+
+# Task functions run by the workers of the tests below, they must be module level functions to be sent to them.
+def add_to_frame(worker, value):
+    return worker.frame + value
+
+
+def write_index(worker, index):
+    worker.buffer(worker.frame)[index] = index * 10
+
+
+def fail(worker, args):
+    raise KeyError("missing tile")
+
+
+def exit_worker(worker, args):
+    os._exit(3)
+
+
+# A buffer attached from its description in another SharedBuffer shares the same memory.
+def test_shared_buffer_attach_shares_memory():
+    buffer = SharedBuffer.from_array(np.arange(6, dtype=np.float32).reshape(2, 3))
+    attached = SharedBuffer.attach(buffer.description())
+    try:
+        assert attached.matches((2, 3), np.float32)
+        assert not attached.matches((3, 2), np.float32)
+        attached.array[1, 2] = 42
+        assert buffer.array[1, 2] == 42
+    finally:
+        attached.close()
+        buffer.close()
+        buffer.unlink()
+
+
+# Every task sees the frame it was submitted with, the results come back in the order of the tasks, and frames can be in flight at
+# the same time.
+def test_results_come_back_in_task_order():
+    with RenderPool(2) as pool:
+        assert pool.run(100, add_to_frame, list(range(20))) == list(range(100, 120))
+        first = pool.submit(1000, add_to_frame, [1, 2])
+        second = pool.submit(2000, add_to_frame, [3])
+        assert pool.wait(second) == [2003]
+        assert pool.wait(first) == [1001, 1002]
+
+
+# Frame buffers are kept for later frames of the same shape and written to by the workers in place. share_array only copies an array
+# with a new key.
+def test_frame_buffers_are_reused():
+    with RenderPool(2) as pool:
+        buffer = pool.frame_buffer('values', (8,), np.int64)
+        pool.run(buffer.description(), write_index, list(range(8)))
+        assert np.array_equal(buffer.array, np.arange(8) * 10)
+        assert pool.frame_buffer('values', (8,), np.int64) is buffer
+        assert pool.frame_buffer('values', (9,), np.int64) is not buffer
+
+        description = pool.share_array('shared', np.ones(4), 1)
+        assert pool.share_array('shared', np.zeros(4), 1) == description
+        assert np.array_equal(pool.buffers['shared'].array, np.ones(4))
+        pool.share_array('shared', np.zeros(4), 2)
+        assert np.array_equal(pool.buffers['shared'].array, np.zeros(4))
+
+
+# Geometry moved to shared memory is given back to the mesh when the pool is closed, and closing again does nothing.
+def test_close_restores_shared_geometry():
+    mesh = Mesh(np.array([1.0, 1.0, 1.0]), np.array([1.0, 1.0, 1.0]), 0.1, 1.0, 0.2, 10)
+    mesh.set_geometry(np.eye(3), np.array([[0, 1, 2]]), np.array([[1.0, 1.0, 1.0]]), np.ones((3, 3)))
+    verts = mesh.verts
+    pool = RenderPool(1)
+    pool.share_geometry([mesh])
+    assert mesh.shared_geometry is not None and mesh.verts is not verts
+    pool.close()
+    assert mesh.shared_geometry is None and mesh.verts is verts
+    pool.close()
+
+
+# An exception in a task is raised by wait with the worker's traceback, and the pool keeps working.
+def test_task_error_is_raised():
+    with RenderPool(2) as pool:
+        with pytest.raises(RuntimeError, match='missing tile'):
+            pool.run(None, fail, [None, None])
+        assert pool.run(1, add_to_frame, [1]) == [2]
+
+
+# A worker that exits in the middle of a frame is noticed instead of waiting for its tasks forever, and the pool can still be closed.
+def test_dead_worker_is_detected():
+    pool = RenderPool(2)
+    try:
+        with pytest.raises(RuntimeError, match='exited with code 3'):
+            pool.run(None, exit_worker, [None])
+    finally:
+        pool.close()
@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import pytest
+from camera import PerspectiveCamera
+from light import PointLight
+from mesh import Mesh
+from render_pool import RenderPool
+from renderer_shared_mem import Renderer
+from screen import Screen
+from sequential_renderer import Renderer as SequentialRenderer
+
+
+# This function returns the camera, meshes and light of a small scene of two overlapping Suzanne heads.
+def two_heads():
+    camera = PerspectiveCamera(-1.0, 1.0, -1.0, 1.0, 1.0, 20)
+    camera.transform.set_position(0, -4, 0)
+    meshes = []
+    for position in [(-0.5, 0, 0.2), (0.5, 1, -0.2)]:
+        mesh = Mesh.from_stl(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'suzanne.stl'), np.array([1.0, 0.0, 1.0]),
+                             np.array([1.0, 1.0, 1.0]), 0.05, 1.0, 0.2, 100)
+        mesh.transform.set_rotation(-15, 0, 215)
+        mesh.transform.set_position(*position)
+        meshes.append(mesh)
+    light = PointLight(50.0, np.array([1, 1, 1]))
+    light.transform.set_position(4, -4, -3)
+    return camera, meshes, light
+
+
+# The tiled renderer draws the same image as the sequential renderer, for every shading and with occlusion culling on or off.
+@pytest.mark.parametrize('shading, options', [('flat', {}), ('gouraud', {}), ('barycentric', {}), ('phong-blinn', {}),
+                                              ('phong-blinn', {'deferred': False}), ('depth', {}), ('depth', {'depth_source': 'z_buffer'}),
+                                              ('flat', {'occlusion_culling': True}), ('phong-blinn', {'occlusion_culling': True})])
+def test_tiles_match_sequential_render(shading, options):
+    camera, meshes, light = two_heads()
+    screen = Screen(64, 64, headless=True)
+    SequentialRenderer(screen, camera, meshes, light).render(shading, [80, 80, 80], [0.2, 0.2, 0.2], **options)
+    expected = screen.image.color
+
+    renderer = Renderer(screen, camera, meshes, light, tile_size=16, processes=2)
+    try:
+        renderer.render(shading, [80, 80, 80], [0.2, 0.2, 0.2], **options)
+    finally:
+        renderer.close()
+    assert np.array_equal(screen.image.color, expected)
+
+
+# Incremental frames, which only redraw the parts of the screen where meshes moved, are the same as full renders.
+def test_incremental_frames_match_full_renders():
+    camera, meshes, light = two_heads()
+    screen = Screen(64, 64, headless=True)
+    full_screen = Screen(64, 64, headless=True)
+    with RenderPool(2) as pool:
+        renderer = Renderer(screen, camera, meshes, light, tile_size=16, pool=pool)
+        full_renderer = Renderer(full_screen, camera, meshes, light, tile_size=16, pool=pool)
+        for frame in range(4):
+            meshes[frame % 2].transform.set_position(-0.5 + 0.3 * frame, 0, 0.3 * frame - 0.4)
+            renderer.render('phong-blinn', [80, 80, 80], [0.2, 0.2, 0.2], incremental=True)
+            full_renderer.render('phong-blinn', [80, 80, 80], [0.2, 0.2, 0.2])
+            assert np.array_equal(screen.image.color, full_screen.image.color), 'frame ' + str(frame)
+
+
+# A depth source other than the vertices or the z-buffer is rejected by both renderers, before the tiled one starts its workers.
+def test_unknown_depth_source_is_rejected():
+    camera, meshes, light = two_heads()
+    screen = Screen(64, 64, headless=True)
+    with pytest.raises(ValueError):
+        SequentialRenderer(screen, camera, meshes, light).render('depth', [80, 80, 80], [0.2, 0.2, 0.2], depth_source='zbuffer')
+    renderer = Renderer(screen, camera, meshes, light)
+    with pytest.raises(ValueError):
+        renderer.render('depth', [80, 80, 80], [0.2, 0.2, 0.2], depth_source='zbuffer')
+    assert renderer.pool is None
@@ -0,0 +1,56 @@
+import numpy as np
+from camera import PerspectiveCamera
+from light import PointLight
+from mesh import Mesh
+from screen import Screen
+from sequential_renderer import Renderer
+from threeDVector import ThreeDVector
+from vertex_processing import VertexProcessor
+
+
+# This function returns a mesh of the triangles given as an (F, 3, 3) array of corners.
+def triangle_mesh(triangles):
+    verts, faces = Mesh.weld_vertices(np.array(triangles, dtype=float))
+    normals = ThreeDVector.find_normals(verts, faces)
+    mesh = Mesh(np.array([1.0, 0.5, 0.0]), np.array([1.0, 1.0, 1.0]), 0.2, 1.0, 0.2, 10)
+    mesh.set_geometry(verts, faces, normals, ThreeDVector.vertex_normals(verts, faces, normals))
+    return mesh
+
+
+# This function renders mesh seen from the origin along the y axis, with the near plane at y = 1, and returns the Framebuffer.
+def render(mesh):
+    screen = Screen(30, 30, headless=True)
+    light = PointLight(50.0, np.array([1, 1, 1]))
+    light.transform.set_position(0, -2, 0)
+    Renderer(screen, PerspectiveCamera(-1.0, 1.0, -1.0, 1.0, 1.0, 20), [mesh], light).render('flat', [0, 0, 0], [0.2, 0.2, 0.2])
+    return screen.image
+
+
+# A triangle with two corners in front of the camera and one behind it. The near plane cuts its edges to the corner behind at
+# (-0.5, 1, 0) and (0.5, 1, 0).
+CROSSING = [[[-1.5, 5, -2], [1.5, 5, -2], [0, -1, 1]]]
+# The part of it beyond the near plane
+CLIPPED = [[[-1.5, 5, -2], [1.5, 5, -2], [0.5, 1, 0]], [[-1.5, 5, -2], [0.5, 1, 0], [-0.5, 1, 0]]]
+
+
+# The face crossing the near plane is replaced by the two triangles of the quad left beyond it, whose new corners lie on the near plane.
+def test_face_crossing_the_near_plane_is_cut():
+    mesh = triangle_mesh(CROSSING)
+    processed = VertexProcessor.process(mesh, PerspectiveCamera(-1.0, 1.0, -1.0, 1.0, 1.0, 20), Screen(30, 30, headless=True))
+    assert np.array_equal(processed.front_facing, [False, True, True])
+    assert np.array_equal(processed.face_parents, [0, 0, 0])
+    new_verts = processed.world_verts[3:]
+    assert np.allclose(new_verts[np.argsort(new_verts[:, 0])], [[-0.5, 1, 0], [0.5, 1, 0]])
+    assert np.allclose(processed.screen_verts[3:, 1], -1)
+
+
+# The fragments of the cut face, the pixels it covers and their depths, are those of the part of it beyond the near plane drawn as a
+# mesh of its own. Its colors differ: the pieces of a cut face are lit like the whole face.
+def test_clipped_face_covers_the_part_beyond_the_near_plane():
+    image = render(triangle_mesh(CROSSING))
+    expected = render(triangle_mesh(CLIPPED))
+    covered = np.isfinite(image.depth)
+    assert covered.sum() > 50
+    assert np.array_equal(covered, np.isfinite(expected.depth))
+    assert np.array_equal(covered, image.color.any(axis=2))
+    assert np.allclose(image.depth[covered], expected.depth[covered])
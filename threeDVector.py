@@ -34,4 +34,48 @@ class ThreeDVector:
         for norm in face_normals:
             result = np.add(result, norm)
         retVal = ThreeDVector.normalize(result)
-        return retVal
\ No newline at end of file
+        return retVal
+
+    # normalize every row of an (N, 3) numpy array so that each vector is of distance 1, rows of length 0 are left as zero vectors
+    @staticmethod
+    def normalize_rows(vectors):
+        mag = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+        mag[mag == 0] = 1.0
+        return vectors / mag[:, None]
+
+    # return the normals of all faces at once as an (F, 3) numpy array, verts is a (V, 3) array of vertices and faces an (F, 3) array of
+    # vertex indices in counterclockwise ordering. This is the batched version of find_normal and uses one cross product for every face.
+    @staticmethod
+    def find_normals(verts, faces):
+        triangles = np.asarray(verts, dtype=np.float64)[faces]
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        return ThreeDVector.normalize_rows(normals)
+
+    # return the normals of all vertices at once as a (V, 3) numpy array by adding up the normals of the faces touching each vertex.
+    # weighting selects how much each face contributes: 'uniform' adds the unit face normals (the same result as vertex_normal),
+    # 'area' weights them by the face area and 'angle' by the angle of the face at that vertex.
+    @staticmethod
+    def vertex_normals(verts, faces, face_normals, weighting='uniform'):
+        triangles = np.asarray(verts, dtype=np.float64)[faces]
+        if weighting == 'uniform':
+            weights = np.ones(faces.shape)
+        elif weighting == 'area':
+            cross = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+            area = np.sqrt(np.einsum('ij,ij->i', cross, cross)) / 2
+            weights = np.repeat(area[:, None], 3, axis=1)
+        elif weighting == 'angle':
+            weights = np.empty(faces.shape)
+            for corner in range(0, 3):
+                edge1 = ThreeDVector.normalize_rows(triangles[:, (corner + 1) % 3] - triangles[:, corner])
+                edge2 = ThreeDVector.normalize_rows(triangles[:, (corner + 2) % 3] - triangles[:, corner])
+                weights[:, corner] = np.arccos(np.clip(np.einsum('ij,ij->i', edge1, edge2), -1.0, 1.0))
+        else:
+            raise ValueError("unknown vertex normal weighting: " + str(weighting))
+
+        # scatter-add the weighted face normals onto the vertices of each face
+        corner_indices = faces.reshape(-1)
+        contributions = (face_normals[:, None, :] * weights[:, :, None]).reshape(-1, 3)
+        result = np.empty((len(verts), 3))
+        for axis in range(0, 3):
+            result[:, axis] = np.bincount(corner_indices, weights=contributions[:, axis], minlength=len(verts))
+        return ThreeDVector.normalize_rows(result)
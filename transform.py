@@ -1,11 +1,25 @@
+import itertools
 import numpy as np
 
 
 class Transform:
+    # Source of the versions of every transform, so a version is never shared by two transforms and a cache keyed on it is also stale
+    # when the transform it was built from is replaced by another one
+    versions = itertools.count()
+
     # The constructor takes no required arguments.
     def __init__(self):
-        # Matrix to store transform
+        # Matrix to store transform, it should only be changed through the set_ methods below so the cached inverse stays valid
         self.transformMatrix = np.identity(4)
+        # Version of the transform, replaced on every change, other objects compare it to know when matrices they derived from it are stale
+        self.version = next(Transform.versions)
+        # Inverse of transformMatrix, computed on first use after each change
+        self.cachedInverseMatrix = None
+
+    # Called by the set_ methods after they change transformMatrix
+    def changed(self):
+        self.version = next(Transform.versions)
+        self.cachedInverseMatrix = None
 
     # Returns a 4x4 Numpy matrix that represents the transformation matrix
     def transformation_matrix(self):
@@ -16,6 +30,7 @@ class Transform:
         self.transformMatrix[0, 3] = x
         self.transformMatrix[1, 3] = y
         self.transformMatrix[2, 3] = z
+        self.changed()
 
     # This method takes three scalars (x, y, and z) as input, and updates the Transform object's internal rotation state.
     # The input values x, y, and z are expected to be degrees values between 0.0 and 360.0 (there is no need to check this),
@@ -29,9 +44,16 @@ class Transform:
         for row in range(0, 3):
             for col in range(0, 3):
                 self.transformMatrix[row, col] = rotMat[row, col]
+        self.changed()
 
     # This method returns a 4x4 Numpy matrix that is the inverse of the transformation matrix.
+    # The inverse is only recomputed after the transform has changed.
     def inverse_matrix(self):
+        if self.cachedInverseMatrix is None:
+            self.cachedInverseMatrix = self.compute_inverse_matrix()
+        return self.cachedInverseMatrix
+
+    def compute_inverse_matrix(self):
         # get matrix parts:
         A = self.transformMatrix[0:3:1, 0:3:1]
         t = self.transformMatrix[0:3:1, 3]
@@ -85,4 +107,21 @@ class Transform:
 
         for row in range(0, 3):
             for col in range(0, 3):
-                self.transformMatrix[row, col] = v_rot[row, col]
\ No newline at end of file
+                self.transformMatrix[row, col] = v_rot[row, col]
+        self.changed()
+
+    # This method takes an (N, 3) Numpy array of 3D points and applies the transformation matrix to all of them at once,
+    # returning the resulting (N, 3) Numpy array. It is the batched version of apply_to_point.
+    def apply_to_points(self, points):
+        return np.matmul(points, self.transformMatrix[0:3, 0:3].T) + self.transformMatrix[0:3, 3]
+
+    # This method takes an (N, 3) Numpy array of 3D points and applies the inverse transformation matrix to all of them at once,
+    # returning the resulting (N, 3) Numpy array. It is the batched version of apply_inverse_to_point.
+    def apply_inverse_to_points(self, points):
+        inverse = self.inverse_matrix()
+        return np.matmul(points, inverse[0:3, 0:3].T) + inverse[0:3, 3]
+
+    # This method takes an (N, 3) Numpy array of normal vectors and applies the transform's rotation to all of them at once,
+    # returning the resulting (N, 3) Numpy array. It is the batched version of apply_to_normal.
+    def apply_to_normals(self, normals):
+        return np.matmul(normals, self.transformMatrix[0:3, 0:3].T)
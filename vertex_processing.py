@@ -0,0 +1,342 @@
+import itertools
+import numpy as np
+from color import ColorCalculation
+from mesh import FACE_CHUNK_SIZE
+from shared_buffer import SharedBuffer
+
+
+# The names of the per face and per vertex arrays of a ProcessedMesh, the ones it shares with the workers of a RenderPool (see
+# ProcessedMesh.share)
+PROCESSED_ARRAYS = ('faces', 'face_parents', 'world_verts', 'screen_verts', 'pixel_verts', 'face_normals', 'vertex_normals', 'front_facing',
+                    'face_colors', 'vertex_colors')
+
+# (description, SharedBuffer) of the blocks attached to by this process for the arrays of processed meshes, keyed on the name of the
+# frame buffer they were shared as. Only the last block of every frame buffer is kept, the pool reuses the same blocks from frame to frame.
+_attached_arrays = {}
+
+
+class ProcessedMesh:
+    # The output of the vertex stage for one mesh and one frame. faces holds the faces to rasterize, the faces of the mesh followed by the
+    # pieces of the faces cut by the near plane (see VertexProcessor.clip_near), face_parents gives the face of the mesh every one of
+    # them came from and clipped_vertices the (edges, weights) the vertices made by the cuts are interpolated with (both None if no
+    # face was cut). world_verts, screen_verts and pixel_verts hold every vertex of faces in world, screen and pixel space, with the
+    # vertices of the mesh first, face_normals and vertex_normals hold the normals rotated into world space, and front_facing is a
+    # boolean array marking the faces that survive back face and frustum culling. bounds is the (min x, max x, min y, max y, min depth,
+    # max depth) range of the pixel coordinates and screen space depths of the vertices of those faces, or None if there are none.
+    # face_colors and vertex_colors are filled in by VertexProcessor.shade for the shading modes that light whole faces (flat) or
+    # vertices (gouraud) before rasterization. mesh_id identifies the mesh in the GBuffer when shading is deferred.
+    # Once shared (see share) the arrays are pickled as the descriptions of the frame buffers of a RenderPool holding copies of them, so the
+    # workers attach to them read-only instead of receiving copies with every frame. version tells processed meshes apart.
+    __slots__ = ('mesh', 'mesh_id', 'faces', 'face_parents', 'clipped_vertices', 'world_verts', 'screen_verts', 'pixel_verts', 'face_normals',
+                 'vertex_normals', 'front_facing', 'bounds', 'face_colors', 'vertex_colors', 'version', 'descriptions')
+    # Source of the versions of every processed mesh, so a version is never shared by two of them
+    versions = itertools.count()
+
+    def __init__(self, mesh, mesh_id, world_verts, screen_verts, pixel_verts, face_normals, vertex_normals, front_facing, faces=None,
+                 face_parents=None, clipped_vertices=None):
+        self.mesh = mesh
+        self.mesh_id = mesh_id
+        self.faces = mesh.faces if faces is None else faces
+        self.face_parents = face_parents
+        self.clipped_vertices = clipped_vertices
+        self.world_verts = world_verts
+        self.screen_verts = screen_verts
+        self.pixel_verts = pixel_verts
+        self.face_normals = face_normals
+        self.vertex_normals = vertex_normals
+        self.front_facing = front_facing
+        self.bounds = None
+        # the vertices used by the faces left, marked a block of faces at a time
+        used = np.zeros(len(screen_verts), dtype=bool)
+        for start in range(0, len(self.faces), FACE_CHUNK_SIZE):
+            used[self.faces[start:start + FACE_CHUNK_SIZE][front_facing[start:start + FACE_CHUNK_SIZE]]] = True
+        if used.any():
+            pixel_vertices = pixel_verts[used]
+            depths = screen_verts[used, 1]
+            self.bounds = (int(pixel_vertices[:, 0].min()), int(pixel_vertices[:, 0].max()), int(pixel_vertices[:, 1].min()),
+                           int(pixel_vertices[:, 1].max()), float(depths.min()), float(depths.max()))
+        self.face_colors = None
+        self.vertex_colors = None
+        self.version = next(ProcessedMesh.versions)
+        self.descriptions = None
+
+    # This method copies the arrays into frame buffers of pool (a RenderPool) whose names start with name, and pickles the processed mesh
+    # as their descriptions from now on. The copies are skipped for buffers still holding the arrays of this processed mesh (see
+    # RenderPool.share_array), so a mesh taken from the VertexCache is not copied again. Faces that are the faces of the mesh itself are
+    # not copied at all, they are sent along with its geometry (see RenderPool.share_geometry). The arrays in this process are left as
+    # they are.
+    def share(self, pool, name):
+        descriptions = []
+        for array_name in PROCESSED_ARRAYS:
+            array = getattr(self, array_name)
+            if array is None or array is self.mesh.faces:
+                descriptions.append(None)
+            else:
+                buffer_name = name + '_' + array_name
+                descriptions.append((buffer_name, pool.share_array(buffer_name, array, self.version)))
+        self.descriptions = tuple(descriptions)
+
+    # This static method returns the array of the shared buffer with the given description, shared as the frame buffer called name (see
+    # share), attaching to it read-only on first use. A frame buffer the pool has reallocated comes with a new block, the block
+    # attached for it before is closed then.
+    @staticmethod
+    def attach(name, description):
+        entry = _attached_arrays.get(name)
+        if entry is None or entry[0] != description:
+            if entry is not None:
+                entry[1].close()
+            buffer = SharedBuffer.attach(description)
+            buffer.array.flags.writeable = False
+            entry = (description, buffer)
+            _attached_arrays[name] = entry
+        return entry[1].array
+
+    # A shared processed mesh is pickled without its arrays (for example when it is sent to a worker process), the receiving process
+    # attaches to the same shared memory instead.
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in ProcessedMesh.__slots__}
+        if self.descriptions is not None:
+            for name in PROCESSED_ARRAYS:
+                state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        if self.descriptions is not None:
+            for name, description in zip(PROCESSED_ARRAYS, self.descriptions):
+                if description is not None:
+                    setattr(self, name, ProcessedMesh.attach(*description))
+            if self.faces is None:
+                self.faces = self.mesh.faces
+
+
+class VertexProcessor:
+    # This static method returns the 4x4 model-view-projection matrix that takes a homogeneous point in the object space of mesh to the
+    # screen space of camera (before the divide by w).
+    @staticmethod
+    def model_view_projection(mesh, camera):
+        return np.matmul(camera.view_projection_matrix(), mesh.transform.transformation_matrix())
+
+    # This static method runs the vertex stage for mesh: every vertex is transformed to world space and projected to screen and pixel space
+    # with one matrix product each, and the face and vertex normals are rotated into world space. Vertices shared by several faces are
+    # only processed once. It returns a ProcessedMesh, mesh_id is stored on it to tell meshes apart when shading is deferred.
+    # A mesh outside the view frustum (see in_frustum) is not processed at all and has no faces. Otherwise faces lying entirely outside
+    # the frustum are culled along with the back faces, and faces crossing the near plane are replaced by their pieces in front of it
+    # (see clip_near). The rest of the clipping happens per fragment, where the depth test drops fragments outside the near and far
+    # planes and the bounds of every face are clamped to the screen. The per face tests run on one block of faces at a time (see
+    # Mesh.face_chunks), only the per vertex arrays and one flag per face are kept for the whole mesh.
+    @staticmethod
+    def process(mesh, camera, screen, mesh_id=0):
+        if not VertexProcessor.in_frustum(mesh, camera):
+            return ProcessedMesh(mesh, mesh_id, np.empty((0, 3)), np.empty((0, 3)), np.empty((0, 2), dtype=int), np.empty((0, 3)),
+                                 np.empty((0, 3)), np.zeros(0, dtype=bool), np.empty((0, 3), dtype=mesh.faces.dtype))
+        world_verts = mesh.transform.apply_to_points(mesh.verts)
+
+        model_view_projection = VertexProcessor.model_view_projection(mesh, camera)
+        clip_verts = np.matmul(mesh.verts, model_view_projection[:, 0:3].T) + model_view_projection[:, 3]
+
+        face_normals = mesh.transform.apply_to_normals(mesh.normals)
+        vertex_normals = mesh.transform.apply_to_normals(mesh.vertex_normals)
+
+        # Normal culling
+        camera_normal = camera.transform.apply_to_normal(np.array([0, 1, 0]))
+        front_facing = np.matmul(face_normals, camera_normal) < 0
+
+        # Frustum culling, a face is outside if all three of its vertices are outside the same plane (in clip space, where the plane
+        # x = -w is the left one and so on)
+        x, y, z, w = clip_verts.T
+        outside = np.stack((x < -w, y < -w, z < -w, x > w, y > w, z > w), axis=1)
+        near_outside = np.zeros(len(mesh.faces), dtype=bool)
+        for start, faces in mesh.face_chunks():
+            face_outside = outside[faces]
+            front_facing[start:start + len(faces)] &= ~face_outside.all(axis=1).any(axis=1)
+            near_outside[start:start + len(faces)] = face_outside[:, :, 1].any(axis=1)
+
+        # Near plane clipping, the faces left with a vertex in front of the near plane cross it
+        faces = None
+        face_parents = None
+        clipped_vertices = None
+        crossing = np.flatnonzero(front_facing & near_outside)
+        if len(crossing) > 0:
+            new_faces, parents, edges, weights = VertexProcessor.clip_near(mesh.faces, clip_verts, crossing)
+            clip_verts = np.concatenate((clip_verts, VertexProcessor.interpolate(clip_verts, edges, weights)))
+            world_verts = np.concatenate((world_verts, VertexProcessor.interpolate(world_verts, edges, weights)))
+            vertex_normals = np.concatenate((vertex_normals, VertexProcessor.interpolate(vertex_normals, edges, weights)))
+            clipped_vertices = (edges, weights)
+            faces = np.concatenate((mesh.faces, new_faces)).astype(mesh.faces.dtype)
+            face_parents = np.concatenate((np.arange(len(mesh.faces)), parents))
+            face_normals = face_normals[face_parents]
+            front_facing[crossing] = False
+            front_facing = np.concatenate((front_facing, np.ones(len(new_faces), dtype=bool)))
+
+        # vertices behind the camera only belong to culled or clipped faces, their projections are never used
+        with np.errstate(divide='ignore', invalid='ignore'):
+            screen_verts = clip_verts[:, 0:3] / clip_verts[:, 3:4]
+            pixel_verts = screen.screen_to_pixels(np.nan_to_num(screen_verts))
+
+        return ProcessedMesh(mesh, mesh_id, world_verts, screen_verts, pixel_verts, face_normals, vertex_normals, front_facing, faces, face_parents,
+                             clipped_vertices)
+
+    # This static method returns False if mesh lies entirely outside the view frustum of camera (see frustum_planes), which only takes a
+    # few dot products with its precomputed bounds (see Mesh.bounds): its bounding sphere and then the corners of its bounding box,
+    # both moved into world space, are tested against every plane of the frustum.
+    @staticmethod
+    def in_frustum(mesh, camera):
+        bounds = mesh.bounds()
+        if bounds is None:
+            return False
+        box_min, box_max, centre, radius = bounds
+        planes = camera.frustum_planes()
+        centre = mesh.transform.apply_to_points(centre[None, :])[0]
+        radius = radius * np.linalg.norm(mesh.transform.transformation_matrix()[0:3, 0:3], axis=0).max()
+        if (np.matmul(planes[:, 0:3], centre) + planes[:, 3] < -radius).any():
+            return False
+        corners = np.array([[x, y, z] for x in (box_min[0], box_max[0]) for y in (box_min[1], box_max[1]) for z in (box_min[2], box_max[2])])
+        distances = np.matmul(mesh.transform.apply_to_points(corners), planes[:, 0:3].T) + planes[:, 3]
+        return not (distances < 0).all(axis=0).any()
+
+    # This static method cuts the faces with the given indices, which cross the near plane, along it. clip_verts are the clip space
+    # vertices of the mesh, a vertex is in front of the near plane where y + w < 0. The part of a face behind the plane is a triangle
+    # or a quad, which is split into two triangles with the same winding. Neighbouring faces share the vertices made on their common
+    # edge. It returns the new faces and the face each of them came from, and the new vertices as the (E, 2) pairs of vertices whose
+    # edge they lie on and the (E,) weights of the second vertex of each pair (see interpolate). The new vertices are numbered after
+    # the vertices of the mesh.
+    @staticmethod
+    def clip_near(faces, clip_verts, face_indices):
+        distances = clip_verts[:, 1] + clip_verts[:, 3]
+        new_faces = []
+        parents = []
+        edges = {}
+        for face_index in face_indices:
+            face = faces[face_index]
+            polygon = []
+            for corner in range(3):
+                start = face[corner]
+                end = face[(corner + 1) % 3]
+                if distances[start] >= 0:
+                    polygon.append(start)
+                if (distances[start] >= 0) != (distances[end] >= 0):
+                    edge = (min(start, end), max(start, end))
+                    polygon.append(edges.setdefault(edge, len(clip_verts) + len(edges)))
+            for corner in range(1, len(polygon) - 1):
+                new_faces.append((polygon[0], polygon[corner], polygon[corner + 1]))
+                parents.append(face_index)
+        edges = np.array(list(edges), dtype=np.int64).reshape(-1, 2)
+        weights = distances[edges[:, 0]] / (distances[edges[:, 0]] - distances[edges[:, 1]])
+        return np.array(new_faces, dtype=np.int64).reshape(-1, 3), np.array(parents, dtype=np.int64), edges, weights
+
+    # This static method returns the values (an (N, ...) array with one row per vertex) of the vertices made by clip_near: the values of
+    # the two ends of their edges, mixed by their weights. Every value that varies linearly over a face is cut the same way as the face.
+    @staticmethod
+    def interpolate(values, edges, weights):
+        weights = weights.reshape((-1,) + (1,) * (values.ndim - 1))
+        return values[edges[:, 0]] * (1 - weights) + values[edges[:, 1]] * weights
+
+    # This static method runs the per face and per vertex lighting of a processed mesh for the shading modes that need it, in one
+    # vectorized pass: flat shading lights every face (face_colors) and gouraud shading every vertex (vertex_colors). The pieces of a face
+    # cut by the near plane get the color of the whole face, and the vertices made by the cut the color interpolated along their edge.
+    # Faces are lit a block at a time (see Mesh.face_chunks).
+    @staticmethod
+    def shade(processed, shading, camera, light, ambient_light):
+        mesh = processed.mesh
+        if processed.bounds is None:
+            return
+        if shading == 'flat':
+            processed.face_colors = np.empty((len(mesh.faces), 3), dtype=np.uint8)
+            for start, faces in mesh.face_chunks():
+                processed.face_colors[start:start + len(faces)] = ColorCalculation.flat_array(processed.world_verts[faces], processed.face_normals[start:start + len(faces)],
+                                                                                           mesh, light, ambient_light)
+            if processed.face_parents is not None:
+                processed.face_colors = processed.face_colors[processed.face_parents]
+        elif shading == 'gouraud':
+            camera_position = camera.transform.apply_to_point(np.array([0, 0, 0]))
+            vertex_count = len(mesh.verts)
+            processed.vertex_colors = ColorCalculation.gouraud_array(processed.world_verts[:vertex_count], processed.vertex_normals[:vertex_count], mesh, light, ambient_light, camera_position)
+            if processed.clipped_vertices is not None:
+                processed.vertex_colors = np.concatenate((processed.vertex_colors, VertexProcessor.interpolate(processed.vertex_colors, *processed.clipped_vertices)))
+
+    # This static method returns the pixel bounds of the front facing faces of a processed mesh that are at least partly on screen,
+    # clamped to the screen, as five arrays: the face indices and their min x, max x, min y and max y pixel coordinates. Every pixel a
+    # face can cover lies inside its bounds. face_indices can give the front facing faces to look at, in the order they are returned in.
+    @staticmethod
+    def face_bounds(processed, screen, face_indices=None):
+        if face_indices is None:
+            face_indices = np.flatnonzero(processed.front_facing)
+        pixel_vertices = processed.pixel_verts[processed.faces[face_indices]]
+        min_x = np.maximum(0, pixel_vertices[:, :, 0].min(axis=1, initial=screen.width))
+        max_x = np.minimum(screen.width - 1, pixel_vertices[:, :, 0].max(axis=1, initial=-1))
+        min_y = np.maximum(0, pixel_vertices[:, :, 1].min(axis=1, initial=screen.height))
+        max_y = np.minimum(screen.height - 1, pixel_vertices[:, :, 1].max(axis=1, initial=-1))
+        on_screen = (min_x <= max_x) & (min_y <= max_y)
+        return face_indices[on_screen], min_x[on_screen], max_x[on_screen], min_y[on_screen], max_y[on_screen]
+
+    # This static method returns the pixel rectangle covering every face of a processed mesh (see face_bounds) as an (x, y, width, height)
+    # tuple, or None if none of its faces are on screen.
+    @staticmethod
+    def mesh_bounds(processed, screen):
+        _, min_x, max_x, min_y, max_y = VertexProcessor.face_bounds(processed, screen)
+        if len(min_x) == 0:
+            return None
+        x = int(min_x.min())
+        y = int(min_y.min())
+        return x, y, int(max_x.max()) - x + 1, int(max_y.max()) - y + 1
+
+
+    # This static method returns the (min_depth, max_depth) pair the depth shader maps to black and white: the smallest and largest
+    # screen space depth (y) of any vertex of a front facing face of the processed meshes that survived frustum culling, taken from
+    # their bounds. Without faces outside the frustum it is the same range ColorCalculation.getMinMaxDepth finds, (inf, -inf) if no face
+    # is left.
+    @staticmethod
+    def depth_range(processed_meshes):
+        min_depth = np.inf
+        max_depth = -np.inf
+        for processed in processed_meshes:
+            if processed.bounds is not None:
+                min_depth = min(min_depth, processed.bounds[4])
+                max_depth = max(max_depth, processed.bounds[5])
+        return min_depth, max_depth
+
+    # This static method returns the indices of the front facing faces of a processed mesh sorted nearest first, by the depth of their
+    # nearest vertex. Faces at the same depth keep their order.
+    @staticmethod
+    def front_to_back(processed):
+        face_indices = np.flatnonzero(processed.front_facing)
+        nearest = processed.screen_verts[processed.faces[face_indices], 1].min(axis=1, initial=np.inf)
+        return face_indices[np.argsort(nearest, kind='stable')]
+
+    # This static method returns the processed meshes sorted nearest first, by the depth of the nearest vertex of their front facing faces.
+    # Meshes at the same depth, or without front facing faces, keep their order.
+    @staticmethod
+    def meshes_front_to_back(processed_meshes):
+        nearest = [np.inf if processed.bounds is None else processed.bounds[4] for processed in processed_meshes]
+        return [processed_meshes[index] for index in np.argsort(nearest, kind='stable')]
+
+
+class VertexCache:
+    # The vertex stage results (ProcessedMesh, shaded) of the meshes of a renderer, kept from one frame to the next. A mesh is only
+    # processed again when its transform, the camera or light transform, the screen size or the shading parameters have changed, the
+    # transforms are compared by their version (see Transform.changed). Changing a mesh's geometry replaces its vertex array and is
+    # noticed too, changes to materials or to the light's intensity or color are not, call clear after them.
+    __slots__ = ('entries',)
+
+    def __init__(self):
+        # (key, ProcessedMesh) of every mesh, keyed on the id of the mesh
+        self.entries = {}
+
+    # This method returns the processed and shaded mesh (see VertexProcessor.process and VertexProcessor.shade), running the vertex stage
+    # only if the cached result is out of date. The second value returned is True if it had to run.
+    def process(self, mesh, camera, screen, mesh_id, shading, light, ambient_light):
+        key = (id(mesh.verts), mesh.transform.version, id(camera), camera.transform.version, screen.width, screen.height, mesh_id, shading,
+               id(light), light.transform.version, tuple(np.ravel(ambient_light)))
+        entry = self.entries.get(id(mesh))
+        if entry is not None and entry[0] == key and entry[1].mesh is mesh:
+            return entry[1], False
+        processed = VertexProcessor.process(mesh, camera, screen, mesh_id)
+        VertexProcessor.shade(processed, shading, camera, light, ambient_light)
+        self.entries[id(mesh)] = (key, processed)
+        return processed, True
+
+    # This method drops every cached result.
+    def clear(self):
+        self.entries.clear()
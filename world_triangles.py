@@ -0,0 +1,108 @@
+import numpy as np
+from shared_buffer import SharedBuffer
+
+
+# The names of the arrays of a WorldTriangles, in the order they are shared in
+TRIANGLE_ARRAYS = ('vertices', 'edges', 'normals', 'vertex_normals', 'mesh_indices', 'face_indices')
+
+# SharedBuffers attached to by this process for the triangles of the frame being traced, keyed on the names of their blocks. Only the
+# buffers of the last frame are kept, the pool reuses the same blocks for every frame of the same scene.
+_attached_triangles = {}
+
+
+class WorldTriangles:
+    # The triangles of every mesh of a scene in world space, in flat arrays indexed by triangle. The triangles of mesh i are stored in
+    # mesh and face order from offsets[i] to offsets[i + 1], so the triangle of a face is offsets[mesh index] + face index.
+    # vertices is a (T, 3, 3) array of the three corners of every triangle, edges a (T, 2, 3) array of the two edge vectors corner 0 - corner
+    # 1 and corner 0 - corner 2 used by the ray-triangle test (see Ray.intersect_edges), normals a (T, 3) array of the face normals and
+    # vertex_normals a (T, 3, 3) array of the normals at the three corners, all rotated into world space. mesh_indices and face_indices
+    # give the mesh (which holds the material) and face every triangle came from.
+    # Once shared (see share) the arrays live in frame buffers of a RenderPool and are pickled as their descriptions, so the workers
+    # attach to them read-only instead of receiving copies.
+    __slots__ = TRIANGLE_ARRAYS + ('offsets', 'descriptions')
+
+    def __init__(self, vertices, edges, normals, vertex_normals, mesh_indices, face_indices, offsets):
+        self.vertices = vertices
+        self.edges = edges
+        self.normals = normals
+        self.vertex_normals = vertex_normals
+        self.mesh_indices = mesh_indices
+        self.face_indices = face_indices
+        self.offsets = offsets
+        self.descriptions = None
+
+    # This static method transforms the meshes in their current positions into world space once, with one matrix product per mesh for
+    # the vertices and normals, and returns their WorldTriangles. The arrays are allocated once for the whole scene and filled block by
+    # block of faces (see Mesh.face_chunks), so no other per triangle array of the scene's size is built along the way.
+    @staticmethod
+    def build(meshes):
+        offsets = [0]
+        for mesh in meshes:
+            offsets.append(offsets[-1] + len(mesh.faces))
+        vertices = np.empty((offsets[-1], 3, 3))
+        normals = np.empty((offsets[-1], 3))
+        vertex_normals = np.empty((offsets[-1], 3, 3))
+        mesh_indices = np.empty(offsets[-1], dtype=np.int32)
+        face_indices = np.empty(offsets[-1], dtype=np.int32)
+        for mesh_index, mesh in enumerate(meshes):
+            world_verts = mesh.transform.apply_to_points(mesh.verts)
+            world_vertex_normals = mesh.transform.apply_to_normals(mesh.vertex_normals)
+            for start, faces in mesh.face_chunks():
+                triangles = slice(offsets[mesh_index] + start, offsets[mesh_index] + start + len(faces))
+                vertices[triangles] = world_verts[faces]
+                normals[triangles] = mesh.transform.apply_to_normals(mesh.normals[start:start + len(faces)])
+                vertex_normals[triangles] = world_vertex_normals[faces]
+            mesh_indices[offsets[mesh_index]:offsets[mesh_index + 1]] = mesh_index
+            face_indices[offsets[mesh_index]:offsets[mesh_index + 1]] = np.arange(len(mesh.faces))
+
+        edges = np.empty((offsets[-1], 2, 3))
+        np.subtract(vertices[:, 0], vertices[:, 1], out=edges[:, 0])
+        np.subtract(vertices[:, 0], vertices[:, 2], out=edges[:, 1])
+        return WorldTriangles(vertices, edges, normals, vertex_normals, mesh_indices, face_indices, offsets)
+
+    # This method returns the index of the triangle of a face of the mesh with index mesh_index.
+    def triangle(self, mesh_index, face_index):
+        return self.offsets[mesh_index] + face_index
+
+    # This method copies the arrays into frame buffers of pool (a RenderPool) and uses those from now on. The buffers are reused by the
+    # next frame as long as the scene has the same number of triangles.
+    def share(self, pool):
+        descriptions = []
+        for name in TRIANGLE_ARRAYS:
+            array = getattr(self, name)
+            buffer = pool.frame_buffer('triangle_' + name, array.shape, array.dtype)
+            buffer.array[:] = array
+            setattr(self, name, buffer.array)
+            descriptions.append(buffer.description())
+        self.descriptions = tuple(descriptions)
+
+    # This static method returns the arrays of the shared buffers with the given descriptions (see share), attaching to them read-only
+    # on first use.
+    @staticmethod
+    def attach(descriptions):
+        key = tuple(description[0] for description in descriptions)
+        buffers = _attached_triangles.get(key)
+        if buffers is None:
+            for old_buffers in _attached_triangles.values():
+                for buffer in old_buffers:
+                    buffer.close()
+            _attached_triangles.clear()
+            buffers = [SharedBuffer.attach(description) for description in descriptions]
+            for buffer in buffers:
+                buffer.array.flags.writeable = False
+            _attached_triangles[key] = buffers
+        return tuple(buffer.array for buffer in buffers)
+
+    # Shared triangles are pickled without their arrays (for example when they are sent to a worker process), the receiving process
+    # attaches to the same shared memory instead.
+    def __getstate__(self):
+        if self.descriptions is None:
+            return {name: getattr(self, name) for name in WorldTriangles.__slots__}
+        return {'offsets': self.offsets, 'descriptions': self.descriptions}
+
+    def __setstate__(self, state):
+        for name in WorldTriangles.__slots__:
+            setattr(self, name, state.get(name))
+        if self.descriptions is not None:
+            for name, array in zip(TRIANGLE_ARRAYS, WorldTriangles.attach(self.descriptions)):
+                setattr(self, name, array)